@@ -40,6 +40,8 @@ from modules.lib import mp_module
 from modules.lib import dumpstacks
 from modules.lib import mp_substitute
 from modules.lib import multiproc
+from modules.lib.idle_scheduler import IdleScheduler
+from modules.lib.link_selector import LinkSelector, fd_identity
 from modules.mavproxy_link import preferred_ports
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -51,6 +53,9 @@ try:
 except Exception:
       pass
 
+# largest write flush_outputs() makes to an output, below a typical MTU
+FWD_BATCH_MAX = 1400
+
 # screensaver dbus syntax swiped from
 # https://stackoverflow.com/questions/10885337/inhibit-screensaver-with-python
 screensaver_interface = None
@@ -237,17 +242,20 @@ class MPState(object):
               MPSetting('streamrate2', int, 4, 'Stream rate link2', range=(-1,500), increment=1),
               MPSetting('heartbeat', float, 1, 'Heartbeat rate (Hz)', range=(0,100), increment=0.1),
               MPSetting('mavfwd', bool, True, 'Allow forwarded control'),
+              MPSetting('fastfwd', bool, True, 'Forward whole reads instead of single packets'),
+              MPSetting('rawfwd', bool, False, 'Pass UDP slave data to a single master without validating it'),
               MPSetting('mavfwd_rate', bool, False, 'Allow forwarded rate control'),
               MPSetting('shownoise', bool, True, 'Show non-MAVLink data'),
               MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0,10000000), increment=1),
               MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
-              MPSetting('select_timeout', float, 0.01, 'select timeout'),
+              MPSetting('select_timeout', float, 0.01, 'maximum select timeout'),
 
               MPSetting('altreadout', int, 10, 'Altitude Readout',
                         range=(0,100), increment=1, tab='Announcements'),
               MPSetting('distreadout', int, 200, 'Distance Readout', range=(0,10000), increment=1),
 
               MPSetting('moddebug', int, opts.moddebug, 'Module Debug Level', range=(0,3), increment=1, tab='Debug'),
+              MPSetting('modtiming', bool, False, 'Time module packet handlers'),
               MPSetting('script_fatal', bool, False, 'fatal error on bad script', tab='Debug'),
               MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0,3), tab='Debug'),
               MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
@@ -312,9 +320,20 @@ class MPState(object):
         self.mav_param_by_sysid[(self.settings.target_system,self.settings.target_component)] = mavparm.MAVParmDict()
         self.modules = []
         self.public_modules = {}
+        # message type -> modules to pass it to, filled in as types are seen
+        self.mavlink_routes = {}
+        # module name -> [calls, seconds] spent in mavlink_packet
+        self.module_timing = {}
+        self.idle_scheduler = IdleScheduler()
+        self.link_selector = LinkSelector()
+        # packets from the master waiting to go to mav_outputs, see forward_to_outputs()
+        self.fwd_pending = []
         self.functions = MAVFunctions()
         self.select_extra = {}
         self.continue_mode = False
+        self.web_backend = 'auto'
+        # None for the server's default
+        self.web_threads = None
         self.aliases = {}
         import platform
         self.system = platform.system()
@@ -341,6 +360,52 @@ class MPState(object):
             return self.public_modules[name]
         return None
 
+    def mavlink_route(self, mtype):
+        '''list of modules that want messages of type mtype, in load order'''
+        route = self.mavlink_routes.get(mtype)
+        if route is None:
+            route = [m for (m,pm) in self.modules if m.wants_mavlink(mtype)]
+            self.mavlink_routes[mtype] = route
+        return route
+
+    def forward_to_outputs(self, msgbuf):
+        '''send a packet from the master to all outputs. With fastfwd set the
+        packets from one read are collected and written to each output in
+        one go by flush_outputs()'''
+        if self.settings.fastfwd:
+            self.fwd_pending.append(msgbuf)
+        else:
+            for r in self.mav_outputs:
+                r.write(msgbuf)
+
+    def flush_outputs(self):
+        '''write the packets collected by forward_to_outputs(), joined into
+        writes of at most FWD_BATCH_MAX bytes so a UDP output never gets a
+        datagram larger than the MTU'''
+        if not self.fwd_pending:
+            return
+        batches = []
+        batch = bytearray()
+        for msgbuf in self.fwd_pending:
+            if batch and len(batch) + len(msgbuf) > FWD_BATCH_MAX:
+                batches.append(batch)
+                batch = bytearray()
+            batch += msgbuf
+        batches.append(batch)
+        self.fwd_pending = []
+        for r in self.mav_outputs:
+            for batch in batches:
+                r.write(batch)
+
+    def links_changed(self):
+        '''must be called whenever mav_master, mav_outputs or sysid_outputs change'''
+        self.link_selector.changed()
+
+    def modules_changed(self):
+        '''must be called whenever the module list changes'''
+        self.mavlink_routes = {}
+        self.idle_scheduler.clear()
+
     def master(self, target_sysid = -1):
         '''return the currently chosen mavlink master object'''
         if len(self.mav_master) == 0:
@@ -490,6 +555,7 @@ def load_module(modname, quiet=False, **kwargs):
             module = m.init(mpstate, **kwargs)
             if isinstance(module, mp_module.MPModule):
                 mpstate.modules.append((module, m))
+                mpstate.modules_changed()
                 if not quiet:
                     if kwargs:
                         print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -521,8 +587,10 @@ def unload_module(modname):
                 if t.is_alive():
                     print("unload on module %s did not complete" % m.name)
                     mpstate.modules.remove((m,pm))
+                    mpstate.modules_changed()
                     return False
             mpstate.modules.remove((m,pm))
+            mpstate.modules_changed()
             if modname in mpstate.public_modules:
                 del mpstate.public_modules[modname]
             print("Unloaded module %s" % modname)
@@ -532,7 +600,7 @@ def unload_module(modname):
 
 def cmd_module(args):
     '''module commands'''
-    usage = "usage: module <list|load|reload|unload>"
+    usage = "usage: module <list|load|reload|unload|timing>"
     if len(args) < 1:
         print(usage)
         return
@@ -584,6 +652,15 @@ def cmd_module(args):
             return
         modname = os.path.basename(args[1])
         unload_module(modname)
+    elif args[0] == "timing":
+        if len(args) > 1 and args[1] == "reset":
+            mpstate.module_timing.clear()
+            return
+        if not mpstate.settings.modtiming:
+            print("Use 'set modtiming 1' to time module packet handlers")
+        timing = sorted(mpstate.module_timing.items(), key=lambda t : t[1][1], reverse=True)
+        for (name, (calls, total)) in timing:
+            print("%-16s calls=%-8u total=%.3fs avg=%.1fus" % (name, calls, total, 1.0e6 * total / calls))
     else:
         print(usage)
 
@@ -792,18 +869,38 @@ def process_master(m):
                 if opts.show_errors:
                     mpstate.console.writeln("MAV error: %s" % msg)
                 mpstate.status.mav_error += 1
+    mpstate.flush_outputs()
+
 
 
+def raw_forward_ok(slave):
+    '''true if whatever slave sends can be passed to the master without
+    parsing it first. Needs a single master, so there is no routing to do,
+    and a datagram link, so every read is made of whole packets that can't
+    interleave with our own writes to the master'''
+    return (mpstate.settings.rawfwd and
+            len(mpstate.mav_master) == 1 and
+            isinstance(slave, mavutil.mavudp))
 
 def process_mavlink(slave):
     '''process packets from MAVLink slaves, forwarding to the master'''
+    global mavversion
     try:
         buf = slave.recv()
     except socket.error:
         return
+    forwarding = mpstate.settings.mavfwd and not mpstate.status.setup_mode
+    detecting_version = slave.first_byte and mavversion is None
+    raw_forwarded = False
+    if forwarding and not detecting_version and raw_forward_ok(slave):
+        mpstate.master().write(buf)
+        raw_forwarded = True
+        if not mpstate.logqueue and not mpstate.status.watch:
+            # nothing else needs the packets parsed
+            mpstate.status.counters['Slave'] += 1
+            return
     try:
-        global mavversion
-        if slave.first_byte and mavversion is None:
+        if detecting_version:
             slave.auto_mavlink_version(buf)
         msgs = slave.mav.parse_buffer(buf)
     except mavutil.mavlink.MAVError as e:
@@ -811,14 +908,15 @@ def process_mavlink(slave):
         return
     if msgs is None:
         return
-    if mpstate.settings.mavfwd and not mpstate.status.setup_mode:
+    if forwarding:
         for m in msgs:
-            target_sysid = getattr(m, 'target_system', -1)
             mbuf = m.get_msgbuf()
-            mpstate.master(target_sysid).write(mbuf)
+            if not raw_forwarded:
+                target_sysid = getattr(m, 'target_system', -1)
+                mpstate.master(target_sysid).write(mbuf)
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + mbuf))
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -989,20 +1087,21 @@ def periodic_tasks():
 
     mpstate.status.update_bytecounters()
 
-    # call optional module idle tasks. These are called at several hundred Hz
-    for (m,pm) in mpstate.modules:
-        if hasattr(m, 'idle_task'):
-            try:
-                m.idle_task()
-            except Exception as msg:
-                if mpstate.settings.moddebug == 1:
-                    print(msg)
-                elif mpstate.settings.moddebug > 1:
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                              limit=2, file=sys.stdout)
-
-        # also see if the module should be unloaded:
+    # call module idle tasks that are due. Modules without an idle_rate are
+    # called on every pass, which is several hundred Hz
+    for m in mpstate.idle_scheduler.due(mpstate.modules, time.time()):
+        try:
+            m.idle_task()
+        except Exception as msg:
+            if mpstate.settings.moddebug == 1:
+                print(msg)
+            elif mpstate.settings.moddebug > 1:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                          limit=2, file=sys.stdout)
+
+    # also see if any module should be unloaded:
+    for (m,pm) in list(mpstate.modules):
         if m.needs_unloading:
             unload_module(m.name)
 
@@ -1051,67 +1150,67 @@ def main_loop():
                     process_master(master)
 
         periodic_tasks()
+        # anything queued for the outputs outside process_master
+        mpstate.flush_outputs()
 
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
+        update_link_selector()
+        if len(mpstate.link_selector) == 0:
             time.sleep(0.0001)
             continue
 
-        for fd in mpstate.select_extra:
-            rin.append(fd)
         try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
+            timeout = mpstate.idle_scheduler.timeout(time.time(), mpstate.settings.select_timeout)
+            ready = mpstate.link_selector.select(timeout)
         except select.error:
             continue
 
         if mpstate is None:
             return
 
-        for fd in rin:
+        for (kind, obj, callback) in ready:
             if mpstate is None:
-                  return
-            for master in mpstate.mav_master:
-                  if fd == master.fd:
-                        process_master(master)
-                        if mpstate is None:
-                              return
-                        continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+                return
+            callback(obj)
 
+def process_select_extra(fd):
+    '''call the read function a module registered for fd in select_extra.
+    This allow modules to register their own file descriptors for the main
+    select loop'''
+    if fd not in mpstate.select_extra:
+        return
+    try:
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd)
+
+def link_handlers():
+    '''fd -> (kind, object, callback) for everything the main loop reads'''
+    handlers = {}
+    for master in mpstate.mav_master:
+        if master.fd is not None and not master.portdead:
+            handlers[master.fd] = ('master', master, process_master)
+    for m in mpstate.mav_outputs:
+        handlers[m.fd] = ('output', m, process_mavlink)
+    for sysid in mpstate.sysid_outputs:
+        m = mpstate.sysid_outputs[sysid]
+        handlers[m.fd] = ('sysid', m, process_mavlink)
+    for fd in mpstate.select_extra:
+        handlers[fd] = ('extra', fd, process_select_extra)
+    return handlers
+
+def update_link_selector():
+    '''re-register fds if links were added or removed. Masters reconnect
+    inside recv(), often onto the same fd number, and modules edit
+    select_extra directly, so those are checked on every pass'''
+    state = ([(master.fd, master.portdead, fd_identity(master.fd) if master.fd is not None else None)
+              for master in mpstate.mav_master],
+             list(mpstate.select_extra.keys()))
+    if mpstate.link_selector.needs_update(state):
+        mpstate.link_selector.update(link_handlers(), state)
 
 
 def input_loop():
@@ -1241,6 +1340,9 @@ if __name__ == '__main__':
     parser.add_option("--default-modules", default="log,signing,wp,rally,fence,ftp,param,relay,tuneopt,arm,mode,calibration,rc,auxopt,misc,cmdlong,battery,terrain,output,adsb,layout,interop,database,gimbal,mission,webserver", help='default module list')
 
     parser.add_option("--airapi", action='store_true', default=False, help="Activate MAVProxy in AirAPI mode")
+    parser.add_option("--web-backend", type='choice', choices=['auto', 'waitress', 'pool', 'dev'], default='auto',
+                      help="web API server: waitress, pool (werkzeug with a worker pool), dev (Flask development server) or auto")
+    parser.add_option("--web-threads", type=int, default=None, help="web API worker threads")
 
     (opts, args) = parser.parse_args()
     if opts.airapi:
@@ -1278,6 +1380,8 @@ if __name__ == '__main__':
     # global mavproxy state
     mpstate = MPState()
     mpstate.airapi = opts.airapi
+    mpstate.web_backend = opts.web_backend
+    mpstate.web_threads = opts.web_threads
     mpstate.status.exit = False
     mpstate.command_map = command_map
     mpstate.continue_mode = opts.continue_mode
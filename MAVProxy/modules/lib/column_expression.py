@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+'''
+evaluate graph expressions over log columns
+
+Graph expressions such as "degrees(ATT.Roll)*2" are normally evaluated
+with eval() once per message. Here they are compiled once into NumPy
+operations over the column arrays of a log (see log_columns.py).
+
+The results match per-message evaluation. An expression is evaluated each
+time a message of one of its sample types arrives. Each TYPE.field takes
+the value of the latest message of that type read up to that point, found
+with searchsorted on the messages' positions in the log. Timestamps can't
+be used for this, as messages of different types often share one.
+Samples are dropped when a referenced type
+hasn't arrived yet, when a division is by zero, or when an
+EXPRESSION{CONDITION} condition is false.
+
+Anything else raises Unsupported, so the caller can fall back to reading
+the log: other names, helpers that take whole messages such as
+expected_mag(), and fields that aren't stored in the columns.
+'''
+
+import ast
+
+import numpy as np
+
+
+class Unsupported(Exception):
+    '''the expression can't be evaluated over columns'''
+    pass
+
+
+def wrap_180(angle):
+    return np.where(angle > 180, angle - 360.0, np.where(angle < -180, angle + 360.0, angle))
+
+
+def wrap_360(angle):
+    return np.where(angle > 360, angle - 360.0, np.where(angle < 0, angle + 360.0, angle))
+
+
+def kmh(mps):
+    return mps * 3.6
+
+
+# function name -> (numpy function, number of arguments)
+FUNCTIONS = {
+    'degrees': (np.degrees, 1),
+    'radians': (np.radians, 1),
+    'sqrt': (np.sqrt, 1),
+    'sin': (np.sin, 1),
+    'cos': (np.cos, 1),
+    'tan': (np.tan, 1),
+    'asin': (np.arcsin, 1),
+    'acos': (np.arccos, 1),
+    'atan': (np.arctan, 1),
+    'atan2': (np.arctan2, 2),
+    'fabs': (np.fabs, 1),
+    'abs': (np.abs, 1),
+    'exp': (np.exp, 1),
+    'log': (np.log, 1),
+    'log10': (np.log10, 1),
+    'floor': (np.floor, 1),
+    'ceil': (np.ceil, 1),
+    'pow': (np.power, 2),
+    'min': (np.minimum, 2),
+    'max': (np.maximum, 2),
+    'kmh': (kmh, 1),
+    'wrap_180': (wrap_180, 1),
+    'wrap_360': (wrap_360, 1),
+}
+
+CONSTANTS = {
+    'pi': np.pi,
+    'e': np.e,
+}
+
+BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+    ast.Pow: np.power,
+}
+
+COMPARE_OPERATORS = {
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+}
+
+
+def constant_value(node):
+    '''the value of a constant node, or None'''
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        return node.value
+    if hasattr(ast, 'Num') and isinstance(node, ast.Num):
+        return node.n
+    if hasattr(ast, 'Str') and isinstance(node, ast.Str):
+        return node.s
+    return None
+
+
+class Evaluation(object):
+    '''state of one evaluation of an expression'''
+    def __init__(self, columns, sequence):
+        self.columns = columns
+        # log positions of the samples
+        self.sequence = sequence
+        self.valid = np.ones(len(sequence), dtype=bool)
+
+    def field(self, mtype, instance, field):
+        '''value of a field in the latest message read at each sample'''
+        cols = self.columns.get(mtype)
+        if cols is None:
+            # the type never arrives, like a NameError on every sample
+            self.valid[:] = False
+            return np.zeros(len(self.sequence))
+        values = cols.column(field)
+        if values is None:
+            raise Unsupported('%s.%s is not in the log columns' % (mtype, field))
+        sequence = cols.sequence()
+        if instance is not None:
+            if cols.instance_field is None:
+                # indexing a type without instances raises IndexError
+                self.valid[:] = False
+                return np.zeros(len(self.sequence))
+            instances = cols.column(cols.instance_field)
+            if instances is None:
+                raise Unsupported('%s instance field is not in the log columns' % mtype)
+            mask = instances == instance
+            sequence = sequence[mask]
+            values = values[mask]
+        idx = np.searchsorted(sequence, self.sequence, side='right') - 1
+        self.valid &= idx >= 0
+        if len(values) == 0:
+            return np.zeros(len(self.sequence))
+        return values[np.maximum(idx, 0)]
+
+    def lowpass(self, var, factor):
+        '''vectorised mavextra.lowpass. The filter only runs over the
+        samples still valid when it is called, as per-message evaluation
+        never calls it for the others. NaN samples are dropped'''
+        try:
+            from scipy.signal import lfilter
+        except ImportError:
+            raise Unsupported('lowpass needs scipy')
+        self.valid &= ~np.isnan(var)
+        ret = np.zeros(len(var))
+        x = var[self.valid]
+        if len(x) > 0:
+            ret[self.valid] = lfilter([1.0 - factor], [1.0, -factor], x, zi=[factor * x[0]])[0]
+        return ret
+
+    def diff(self, var):
+        '''vectorised mavextra.diff, over the samples still valid when it
+        is called'''
+        ret = np.zeros(len(var))
+        x = var[self.valid]
+        if len(x) > 0:
+            ret[self.valid] = np.concatenate(([0.0], np.diff(x)))
+        return ret
+
+    def evaluate(self, node):
+        n = len(self.sequence)
+        value = constant_value(node)
+        if value is not None:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return np.full(n, float(value))
+            raise Unsupported('constant %r' % (value,))
+        if isinstance(node, ast.Expression):
+            return self.evaluate(node.body)
+        if isinstance(node, ast.Attribute):
+            return self.attribute(node)
+        if isinstance(node, ast.Name):
+            if node.id in CONSTANTS:
+                return np.full(n, CONSTANTS[node.id])
+            raise Unsupported('name %s' % node.id)
+        if isinstance(node, ast.BinOp):
+            op = BINARY_OPERATORS.get(type(node.op))
+            if op is None:
+                raise Unsupported('operator %s' % type(node.op).__name__)
+            left = self.evaluate(node.left)
+            right = self.evaluate(node.right)
+            if isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod)):
+                # ZeroDivisionError drops the sample
+                self.valid &= right != 0
+                right = np.where(right == 0, 1.0, right)
+            with np.errstate(all='ignore'):
+                return op(left, right)
+        if isinstance(node, ast.UnaryOp):
+            operand = self.evaluate(node.operand)
+            if isinstance(node.op, ast.USub):
+                return -operand
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.Not):
+                return np.logical_not(operand).astype(float)
+            raise Unsupported('operator %s' % type(node.op).__name__)
+        if isinstance(node, ast.Compare):
+            left = self.evaluate(node.left)
+            result = np.ones(n, dtype=bool)
+            for (op, comparator) in zip(node.ops, node.comparators):
+                func = COMPARE_OPERATORS.get(type(op))
+                if func is None:
+                    raise Unsupported('operator %s' % type(op).__name__)
+                right = self.evaluate(comparator)
+                result &= func(left, right)
+                left = right
+            return result.astype(float)
+        if isinstance(node, ast.Call):
+            return self.call(node)
+        raise Unsupported(type(node).__name__)
+
+    def attribute(self, node):
+        '''TYPE.field or TYPE[instance].field'''
+        target = node.value
+        instance = None
+        if isinstance(target, ast.Subscript):
+            index = target.slice
+            if hasattr(ast, 'Index') and isinstance(index, ast.Index):
+                index = index.value
+            instance = constant_value(index)
+            if not isinstance(instance, int):
+                raise Unsupported('instance index')
+            target = target.value
+        if not isinstance(target, ast.Name):
+            raise Unsupported('attribute of %s' % type(target).__name__)
+        return self.field(target.id, instance, node.attr)
+
+    def call(self, node):
+        if not isinstance(node.func, ast.Name) or getattr(node, 'keywords', None) or \
+           getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+            raise Unsupported('call')
+        name = node.func.id
+        args = node.args
+        if name == 'lowpass' and len(args) == 3:
+            factor = constant_value(args[2])
+            if not isinstance(factor, (int, float)):
+                raise Unsupported('lowpass factor')
+            return self.lowpass(self.evaluate(args[0]), float(factor))
+        if name == 'diff' and len(args) == 2:
+            return self.diff(self.evaluate(args[0]))
+        if name not in FUNCTIONS:
+            raise Unsupported('function %s' % name)
+        (func, nargs) = FUNCTIONS[name]
+        if len(args) != nargs:
+            raise Unsupported('%s with %u arguments' % (name, len(args)))
+        with np.errstate(all='ignore'):
+            return func(*[self.evaluate(a) for a in args])
+
+
+class ColumnExpression(object):
+    '''a graph expression compiled for evaluation over columns'''
+    def __init__(self, expression):
+        self.expression = expression
+        self.condition = None
+        if expression.endswith('}'):
+            start = expression.rfind('{')
+            if start == -1:
+                raise Unsupported('unbalanced condition')
+            self.condition = self.parse(expression[start+1:-1])
+            expression = expression[:start]
+        self.tree = self.parse(expression)
+
+    @staticmethod
+    def parse(expression):
+        try:
+            return ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            raise Unsupported('syntax')
+
+    def evaluate(self, columns, sample_types):
+        '''return (timestamps, values), with a sample for each message of
+        a type in sample_types'''
+        cols = [columns.get(t) for t in sample_types if t in columns]
+        if len(cols) == 0:
+            return (np.zeros(0), np.zeros(0))
+        sequence = np.concatenate([c.sequence() for c in cols])
+        times = np.concatenate([c.timestamps() for c in cols])
+        order = np.argsort(sequence, kind='stable')
+        (sequence, times) = (sequence[order], times[order])
+        ev = Evaluation(columns, sequence)
+        if self.condition is not None:
+            ev.valid &= ev.evaluate(self.condition) != 0
+        values = ev.evaluate(self.tree)
+        return (times[ev.valid], values[ev.valid])
+
+
+# expression -> ColumnExpression, or the Unsupported it raised
+compiled = {}
+
+
+def compile_expression(expression):
+    '''compile an expression, caching the result. Raises Unsupported'''
+    c = compiled.get(expression)
+    if c is None:
+        try:
+            c = ColumnExpression(expression)
+        except Unsupported as e:
+            c = e
+        compiled[expression] = c
+    if isinstance(c, Unsupported):
+        raise c
+    return c
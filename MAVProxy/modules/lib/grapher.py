@@ -17,6 +17,7 @@ import pylab
 from pymavlink import mavutil
 import threading
 import numpy as np
+from MAVProxy.modules.lib import column_expression
 
 colors = [ 'red', 'green', 'blue', 'orange', 'olive', 'black', 'grey', 'yellow', 'brown', 'darkcyan',
            'cornflowerblue', 'darkmagenta', 'deeppink', 'darkred']
@@ -62,11 +63,22 @@ def timestamp_to_days(timestamp, timeshift=0):
     sec_to_days = 1.0 / (60*60*24)
     return tday_base + (timestamp - tday_basetime) * sec_to_days
 
+def timestamps_to_days(timestamps, timeshift=0):
+    '''convert an array of log timestamps to days'''
+    if len(timestamps) == 0 or timestamp_to_days(timestamps[0], timeshift) == 0:
+        return np.zeros(len(timestamps))
+    sec_to_days = 1.0 / (60*60*24)
+    return tday_base + (timestamps - tday_basetime) * sec_to_days
+
 class MavGraph(object):
     def __init__(self, flightmode_colourmap=None):
         self.lowest_x = None
         self.highest_x = None
         self.mav_list = []
+        # LogColumns for each entry in mav_list, or None
+        self.columns_list = []
+        # indexes of the fields evaluated over columns
+        self.column_fields = set()
         self.fields = []
         self.condition = None
         self.xaxis = None
@@ -108,9 +120,11 @@ class MavGraph(object):
         '''add another field to plot'''
         self.fields.append(field)
 
-    def add_mav(self, mav):
-        '''add another data source to plot'''
+    def add_mav(self, mav, columns=None):
+        '''add another data source to plot, with its LogColumns if it
+        has been read into columns'''
         self.mav_list.append(mav)
+        self.columns_list.append(columns)
 
     def set_condition(self, condition):
         '''set graph condition'''
@@ -415,7 +429,7 @@ class MavGraph(object):
         '''add some data'''
         mtype = msg.get_type()
         for i in range(0, len(self.fields)):
-            if mtype not in self.field_types[i]:
+            if mtype not in self.field_types[i] or i in self.column_fields:
                 continue
             f = self.fields[i]
             simple = self.simple_field[i]
@@ -434,7 +448,39 @@ class MavGraph(object):
             self.y[i].append(v)
             self.x[i].append(xv)
 
-    def process_mav(self, mlog, flightmode_selections):
+    def process_columns(self, columns, flightmode_selections):
+        '''add data for the fields that can be evaluated over the column
+        arrays of a log, rather than by reading it. Fields that can't are
+        left out of self.column_fields'''
+        if self.condition or self.xaxis is not None:
+            return
+
+        selections = None
+        if any(flightmode_selections) and len(self.flightmode_list) > 0:
+            # a sample belongs to the first flight mode ending after it
+            ends = np.array([t1 for (mode, t0, t1) in self.flightmode_list])
+            selections = np.zeros(len(ends)+1, dtype=bool)
+            n = min(len(ends), len(flightmode_selections))
+            selections[:n] = flightmode_selections[:n]
+
+        for i in range(self.num_fields):
+            try:
+                expression = column_expression.compile_expression(self.fields[i])
+                (t, v) = expression.evaluate(columns, self.field_types[i])
+            except column_expression.Unsupported:
+                continue
+            if selections is not None:
+                keep = selections[np.searchsorted(ends, t, side='right')]
+                (t, v) = (t[keep], v[keep])
+            x = timestamps_to_days(t, self.timeshift)
+            if len(self.x[i]) > 0:
+                x = np.concatenate((self.x[i], x))
+                v = np.concatenate((self.y[i], v))
+            self.x[i] = x
+            self.y[i] = v
+            self.column_fields.add(i)
+
+    def process_mav(self, mlog, flightmode_selections, columns=None):
         '''process one file'''
         self.vars = {}
         idx = 0
@@ -478,6 +524,17 @@ class MavGraph(object):
             # prime the timestamp conversion
             timestamp_to_days(self.flightmode_list[0][1], self.timeshift)
 
+        self.column_fields = set()
+        if columns is not None:
+            self.process_columns(columns, flightmode_selections)
+            if len(self.column_fields) == self.num_fields:
+                return
+        # only read the messages needed by the remaining fields
+        msg_types = set()
+        for i in range(self.num_fields):
+            if i not in self.column_fields:
+                msg_types = msg_types.union(self.field_types[i])
+
         try:
             reset_state_data()
         except Exception:
@@ -486,12 +543,12 @@ class MavGraph(object):
         all_messages = {}
 
         while True:
-            msg = mlog.recv_match(type=self.msg_types)
+            msg = mlog.recv_match(type=msg_types)
             if msg is None:
                 break
             mtype = msg.get_type()
             all_messages[mtype] = msg
-            if mtype not in self.msg_types:
+            if mtype not in msg_types:
                 continue
             if self.condition:
                 if not mavutil.evaluate_condition(self.condition, all_messages):
@@ -501,9 +558,11 @@ class MavGraph(object):
             if all_false or len(flightmode_selections) == 0:
                 self.add_data(tdays, msg, all_messages)
             else:
-                if idx < len(self.flightmode_list) and msg._timestamp >= self.flightmode_list[idx][2]:
+                # a message belongs to the first flight mode ending after it,
+                # as in process_columns
+                while idx < len(self.flightmode_list) and msg._timestamp >= self.flightmode_list[idx][2]:
                     idx += 1
-                elif (idx < len(flightmode_selections) and flightmode_selections[idx]):
+                if idx < len(flightmode_selections) and flightmode_selections[idx]:
                     self.add_data(tdays, msg, all_messages)
 
     def xlim_change_check(self, idx):
@@ -559,7 +618,7 @@ class MavGraph(object):
 
         for fi in range(0, len(self.mav_list)):
             mlog = self.mav_list[fi]
-            self.process_mav(mlog, flightmode_selections)
+            self.process_mav(mlog, flightmode_selections, self.columns_list[fi])
 
 
     def show(self, lenmavlist, block=True, xlim_pipe=None, output=None):
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+Decides which module idle tasks are due on each pass of the main loop.
+
+Modules with idle_rate set to None have their idle_task called on every
+pass, as before. Modules with an idle_rate in Hz are kept in a heap of
+deadlines and are only called when their deadline has passed, which also
+tells the main loop how long it can sleep in select().
+'''
+
+import heapq
+
+
+class IdleScheduler(object):
+    def __init__(self):
+        self.dirty = True
+        self.every_pass = []
+        self.heap = []
+        # module -> its current deadline. Heap entries that don't match are stale
+        self.deadlines = {}
+        self.seq = 0
+
+    def clear(self):
+        '''must be called whenever the module list changes'''
+        self.dirty = True
+
+    def rebuild(self, modules, now):
+        old_deadlines = self.deadlines
+        self.every_pass = []
+        self.heap = []
+        self.deadlines = {}
+        for (m,pm) in modules:
+            if not m.has_idle_task():
+                continue
+            if m.idle_rate is None:
+                self.every_pass.append(m)
+            else:
+                self.schedule(m, old_deadlines.get(m, now))
+        self.dirty = False
+
+    def schedule(self, m, deadline):
+        self.deadlines[m] = deadline
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, m))
+
+    def wake(self, m, deadline):
+        '''bring the next idle_task call of m forward to deadline'''
+        if m in self.deadlines and deadline < self.deadlines[m]:
+            self.schedule(m, deadline)
+
+    def due(self, modules, now):
+        '''list of modules whose idle_task should be called now'''
+        if self.dirty:
+            self.rebuild(modules, now)
+        ret = list(self.every_pass)
+        while self.heap and self.heap[0][0] <= now:
+            (deadline, seq, m) = heapq.heappop(self.heap)
+            if self.deadlines.get(m) != deadline:
+                continue
+            period = 1.0 / m.idle_rate
+            next_deadline = deadline + period
+            if next_deadline <= now:
+                # we fell behind, don't try to catch up with a burst of calls
+                next_deadline = now + period
+            self.schedule(m, next_deadline)
+            ret.append(m)
+        return ret
+
+    def timeout(self, now, max_timeout):
+        '''how long the main loop can wait before the next idle_task is due'''
+        if self.dirty or self.every_pass or not self.heap:
+            return max_timeout
+        return min(max(self.heap[0][0] - now, 0), max_timeout)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+Persistent fd registrations for the main loop.
+
+Each readable fd maps to a (kind, object, callback) handler, so a ready fd
+is dispatched with a dict lookup instead of a scan over every link. Uses
+the selectors module (epoll on Linux) where available, and plain select()
+on the registered fds otherwise. epoll refuses regular files (a log
+being replayed, for example), so while any are registered the whole set is
+polled with select().
+'''
+
+import os
+import select
+
+try:
+    import selectors
+except ImportError:
+    # python2 without the selectors34 backport
+    selectors = None
+
+
+def fd_identity(fd):
+    '''the file behind fd, as (device, inode). A closed fd drops out of
+    epoll, and a reconnecting link usually gets the same fd number back for
+    its new socket, so the fd alone does not say whether a registration is
+    still live'''
+    try:
+        st = os.fstat(fd)
+    except (OSError, ValueError):
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+class LinkSelector(object):
+    def __init__(self):
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+        else:
+            self.selector = None
+        # fd -> (kind, object, callback)
+        self.handlers = {}
+        # fds the selector refused, that need select()
+        self.select_fds = set()
+        self.dirty = True
+        # whatever the owner last synced against, see needs_update()
+        self.state = None
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def changed(self):
+        '''mark the registrations out of date, e.g. after adding a link'''
+        self.dirty = True
+
+    def needs_update(self, state):
+        '''true if the registrations are out of date. state is a cheap summary
+        of anything that can change without changed() being called'''
+        return self.dirty or state != self.state
+
+    def update(self, handlers, state=None):
+        '''make the registrations match handlers, a dict of fd -> (kind, object, callback).
+        Everything is registered afresh, as an unchanged handler may sit on
+        an fd that was closed and reopened'''
+        for fd in list(self.handlers.keys()):
+            self.unregister(fd)
+        for fd in handlers:
+            if fd not in self.handlers:
+                self.register(fd, handlers[fd])
+        self.dirty = False
+        self.state = state
+
+    def register(self, fd, handler):
+        if self.selector is not None:
+            try:
+                self.selector.register(fd, selectors.EVENT_READ, handler)
+            except (ValueError, KeyError):
+                # closed or otherwise unusable fd, try again on the next update
+                self.dirty = True
+                return
+            except (IOError, OSError):
+                # e.g. EPERM from epoll for a regular file
+                self.select_fds.add(fd)
+        self.handlers[fd] = handler
+
+    def unregister(self, fd):
+        self.handlers.pop(fd)
+        if fd in self.select_fds:
+            self.select_fds.discard(fd)
+        elif self.selector is not None:
+            try:
+                self.selector.unregister(fd)
+            except (ValueError, KeyError, OSError):
+                pass
+
+    def select(self, timeout):
+        '''wait up to timeout seconds, returning the handlers of ready fds'''
+        if self.selector is not None and not self.select_fds:
+            return [key.data for (key, events) in self.selector.select(timeout)]
+        (rin, win, xin) = select.select(list(self.handlers.keys()), [], [], timeout)
+        return [self.handlers[fd] for fd in rin]
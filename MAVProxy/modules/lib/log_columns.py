@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+'''
+columnar message store for MAVExplorer
+
+A log is read once into a float64 array per message type, holding the
+timestamps and every numeric field. Commands can then slice those arrays
+instead of parsing the log again. The arrays are saved to a <log>.columns
+sidecar file and memory-mapped when the log is opened again. The sidecar
+is keyed by a hash of the log, so it is rebuilt if the log changes.
+
+Each message also gets a sequence number, its position in the log among
+all the stored messages. Many messages share a timestamp (every IMU
+instance is written with the same TimeUS, and untimed messages take the
+time of the message before them), so the sequence numbers are what put
+messages of different types back into the order they were read in.
+
+Binary DataFlash logs are decoded with numpy rather than message by
+message. DFReader has already indexed where every message starts, using
+the lengths in the FMT messages, so the file is cut into chunks at message
+boundaries and the chunks are decoded by a pool of processes.
+
+Text and array fields are not stored. A message type that has any is
+marked incomplete: its numeric fields can still be graphed, but it can't
+be printed back out.
+'''
+
+import array
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from MAVProxy.modules.lib import multiproc
+
+MAGIC = b'MXCOLS3\n'
+HEADER_LENGTH = struct.Struct('<Q')
+# bytes hashed at each end of the log to make the cache key
+KEY_SAMPLE_SIZE = 1024 * 1024
+# logs smaller than this are decoded without starting worker processes
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+# messages of one type decoded at a time, bounding the memory used
+DECODE_BATCH = 65536
+
+# DataFlash format characters as numpy types, see DFReader.FORMAT_TO_STRUCT
+DF_TYPES = {
+    'a': ('<i2', (32,)),
+    'b': 'i1',
+    'B': 'u1',
+    'h': '<i2',
+    'H': '<u2',
+    'i': '<i4',
+    'I': '<u4',
+    'f': '<f4',
+    'g': '<f2',
+    'n': 'S4',
+    'N': 'S16',
+    'Z': 'S64',
+    'c': '<i2',
+    'C': '<u2',
+    'e': '<i4',
+    'E': '<u4',
+    'L': '<i4',
+    'd': '<f8',
+    'M': 'i1',
+    'q': '<i8',
+    'Q': '<u8',
+}
+# format characters that aren't stored in columns
+DF_TEXT = 'nNZa'
+
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
+
+
+def log_key(filename):
+    '''hash identifying a log file. Only the size and both ends are
+    hashed, so large logs don't have to be read in full'''
+    h = hashlib.sha1()
+    size = os.path.getsize(filename)
+    h.update(str(size).encode('ascii'))
+    with open(filename, 'rb') as f:
+        h.update(f.read(KEY_SAMPLE_SIZE))
+        if size > KEY_SAMPLE_SIZE:
+            f.seek(max(size - KEY_SAMPLE_SIZE, KEY_SAMPLE_SIZE))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def is_number(v):
+    return isinstance(v, integer_types + (float,)) and not isinstance(v, bool)
+
+
+class MessageColumns(object):
+    '''the numeric fields of every message of one type'''
+    def __init__(self, name, fields, ints, complete, data, instance_field=None, fieldnames=None):
+        self.name = name
+        # stored field names, in message order
+        self.fields = fields
+        # all field names, including those that aren't stored
+        self.fieldnames = fieldnames if fieldnames is not None else fields
+        # True for each field holding integers
+        self.ints = ints
+        # False if the type has fields that aren't stored
+        self.complete = complete
+        # row 0 is the timestamps, row 1 the sequence numbers, then a row per field
+        self.data = data
+        # the field telling apart instances of multi-instance sensors
+        self.instance_field = instance_field
+        self.field_index = dict([(f, i+2) for (i, f) in enumerate(fields)])
+        self.instance_set = None
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def timestamps(self):
+        return self.data[0]
+
+    def sequence(self):
+        '''position of each message in the log'''
+        return self.data[1]
+
+    def column(self, field):
+        '''values of a field, or None if it isn't stored'''
+        i = self.field_index.get(field)
+        if i is None:
+            return None
+        return self.data[i]
+
+    def instances(self):
+        '''the set of instance numbers in the log, or None if the instances
+        aren't known'''
+        if self.instance_set is None:
+            values = self.column(self.instance_field) if self.instance_field is not None else None
+            if values is None:
+                return None
+            self.instance_set = set([int(v) for v in np.unique(values) if not math.isnan(v)])
+        return self.instance_set
+
+    def format(self, i):
+        '''message i as text, in the same form as str() on a message'''
+        values = []
+        for (j, f) in enumerate(self.fields):
+            v = self.data[j+2, i]
+            if self.ints[j] and not math.isnan(v):
+                v = int(v)
+            else:
+                v = float(v)
+            values.append("%s : %s" % (f, v))
+        return "%s {%s}" % (self.name, ', '.join(values))
+
+
+class LogColumns(object):
+    '''the column arrays of a log, by message type'''
+    def __init__(self, key, types, flightmodes=None):
+        self.key = key
+        # message type -> MessageColumns
+        self.types = types
+        # cached result of mlog.flightmode_list()
+        self.flightmodes = flightmodes
+
+    def __contains__(self, mtype):
+        return mtype in self.types
+
+    def get(self, mtype):
+        return self.types.get(mtype)
+
+    def save(self, path):
+        '''write to a sidecar file, atomically'''
+        header = {'key': self.key, 'flightmodes': self.flightmodes, 'types': {}}
+        offset = 0
+        for (name, cols) in self.types.items():
+            header['types'][name] = {'fields': cols.fields,
+                                     'ints': cols.ints,
+                                     'complete': cols.complete,
+                                     'instance_field': cols.instance_field,
+                                     'fieldnames': cols.fieldnames,
+                                     'count': len(cols),
+                                     'offset': offset}
+            offset += cols.data.size * 8
+        header = json.dumps(header).encode('utf-8')
+        # keep the arrays 8 byte aligned
+        header += b' ' * (-(len(MAGIC) + HEADER_LENGTH.size + len(header)) % 8)
+        tmpname = path + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(MAGIC)
+            f.write(HEADER_LENGTH.pack(len(header)))
+            f.write(header)
+            for cols in self.types.values():
+                f.write(np.ascontiguousarray(cols.data, dtype='<f8').tobytes())
+        if os.name == 'nt' and os.path.exists(path):
+            os.unlink(path)
+        os.rename(tmpname, path)
+
+    @staticmethod
+    def load(path, key):
+        '''memory-map a sidecar file, or return None if it is missing or
+        for a different log'''
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    return None
+                (length,) = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))
+                header = json.loads(f.read(length).decode('utf-8'))
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+        if header.get('key') != key:
+            return None
+        base = len(MAGIC) + HEADER_LENGTH.size + length
+        types = {}
+        for (name, t) in header['types'].items():
+            shape = (len(t['fields']) + 2, t['count'])
+            if t['count'] == 0:
+                data = np.zeros(shape)
+            else:
+                data = np.memmap(path, dtype='<f8', mode='r', offset=base + t['offset'], shape=shape)
+            instance_field = t.get('instance_field')
+            if instance_field is not None:
+                instance_field = str(instance_field)
+            fieldnames = [str(f) for f in t['fieldnames']]
+            types[str(name)] = MessageColumns(str(name), [str(f) for f in t['fields']], t['ints'],
+                                              t['complete'], data, instance_field, fieldnames)
+        flightmodes = header.get('flightmodes')
+        if flightmodes is not None:
+            flightmodes = [tuple(m) for m in flightmodes]
+        return LogColumns(key, types, flightmodes)
+
+    @staticmethod
+    def extract(mlog, key, processes=None):
+        '''read every message of a log into columns. DataFlash logs are
+        decoded by a pool of processes, other logs message by message.
+        Leaves the log rewound'''
+        columns = read_dataflash(mlog, key, processes)
+        if columns is None:
+            columns = read_messages(mlog, key)
+        return columns
+
+
+def read_messages(mlog, key):
+    '''read a log into columns one message at a time'''
+    # type -> [fields, ints, complete, timestamps, columns, instance_field, fieldnames, sequence]
+    building = {}
+    count = 0
+    mlog.rewind()
+    while True:
+        m = mlog.recv_match()
+        if m is None:
+            break
+        mtype = m.get_type()
+        if mtype == 'BAD_DATA':
+            continue
+        b = building.get(mtype)
+        if b is None:
+            fields = []
+            ints = []
+            complete = True
+            for f in m.get_fieldnames():
+                v = getattr(m, f, None)
+                if is_number(v):
+                    fields.append(f)
+                    ints.append(isinstance(v, integer_types))
+                else:
+                    complete = False
+            if hasattr(m, 'fmt'):
+                instance_field = m.fmt.instance_field
+            else:
+                instance_field = getattr(m, '_instance_field', None)
+            b = building[mtype] = [fields, ints, complete, array.array('d'),
+                                   [array.array('d') for f in fields], instance_field,
+                                   list(m.get_fieldnames()), array.array('d')]
+        b[3].append(m._timestamp)
+        b[7].append(count)
+        count += 1
+        for (f, col) in zip(b[0], b[4]):
+            v = getattr(m, f, None)
+            try:
+                col.append(v)
+            except TypeError:
+                col.append(float('nan'))
+    mlog.rewind()
+
+    types = {}
+    for (mtype, (fields, ints, complete, timestamps, columns, instance_field, fieldnames, sequence)) in building.items():
+        data = np.empty((len(fields) + 2, len(timestamps)))
+        data[0] = np.frombuffer(timestamps, dtype=np.float64)
+        data[1] = np.frombuffer(sequence, dtype=np.float64)
+        for (i, col) in enumerate(columns):
+            data[i+2] = np.frombuffer(col, dtype=np.float64)
+        types[mtype] = MessageColumns(mtype, fields, ints, complete, data, instance_field, fieldnames)
+    return LogColumns(key, types)
+
+
+def dataflash_dtype(format):
+    '''numpy record type for the body of a DataFlash message, or None if
+    the format has characters we don't know'''
+    formats = []
+    offsets = []
+    offset = 0
+    for c in format:
+        t = DF_TYPES.get(c)
+        if t is None:
+            return None
+        formats.append(t)
+        offsets.append(offset)
+        offset += np.dtype(t).itemsize
+    return np.dtype({'names': ['f%u' % i for i in range(len(formats))],
+                     'formats': formats,
+                     'offsets': offsets,
+                     'itemsize': offset})
+
+
+def decode_chunk(job):
+    '''decode the numeric fields of DataFlash messages at known offsets.
+    Run in the worker processes of read_dataflash()'''
+    (filename, types) = job
+    ret = []
+    with open(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = np.frombuffer(m, dtype=np.uint8)
+        try:
+            for (type_id, dtype, fields, offsets) in types:
+                columns = np.empty((len(fields), len(offsets)))
+                body = np.arange(3, dtype.itemsize + 3)
+                for start in range(0, len(offsets), DECODE_BATCH):
+                    batch = offsets[start:start+DECODE_BATCH]
+                    records = buf[batch[:, None] + body].view(dtype).reshape(-1)
+                    for (i, (name, mult)) in enumerate(fields):
+                        v = records[name].astype(np.float64)
+                        if mult is not None:
+                            # divide like DFReader does, for identical results
+                            if 0.0 < mult < 1.0:
+                                v /= 1 / mult
+                            else:
+                                v *= mult
+                        columns[i, start:start+len(batch)] = v
+                ret.append((type_id, columns))
+        finally:
+            buf = None
+            m.close()
+    return ret
+
+
+def read_dataflash(mlog, key, processes=None):
+    '''read a binary DataFlash log into columns. The reader has already
+    found the offset of every message while opening the log, so the
+    messages are split into chunks of the file at message boundaries and
+    each chunk is decoded with numpy in a pool of processes. Returns None
+    for logs that have to be read message by message'''
+    try:
+        from pymavlink import DFReader
+    except ImportError:
+        return None
+    if not isinstance(mlog, DFReader.DFReader_binary) or not isinstance(mlog.clock, DFReader.DFReaderClock_usec):
+        return None
+
+    jobs = []
+    names = set()
+    for (type_id, fmt) in mlog.formats.items():
+        if mlog.counts[type_id] <= 0:
+            continue
+        if fmt.name in names or (len(fmt.columns) > 0 and fmt.columns[0] == 'TimeMS'):
+            # messages timed by the log clock's state
+            return None
+        names.add(fmt.name)
+        dtype = dataflash_dtype(fmt.format)
+        if dtype is None or dtype.itemsize + 3 != fmt.len or len(fmt.columns) != len(fmt.format):
+            return None
+        fields = []
+        for (i, c) in enumerate(fmt.format):
+            if c not in DF_TEXT:
+                fields.append(('f%u' % i, DFReader.FORMAT_TO_STRUCT[c][1]))
+        offsets = np.asarray(mlog.offsets[type_id][:mlog.counts[type_id]], dtype=np.int64)
+        jobs.append((type_id, fmt, dtype, fields, offsets))
+
+    if processes is None:
+        processes = multiproc.cpu_count()
+    if mlog.data_len < PARALLEL_MIN_SIZE:
+        processes = 1
+    # a few chunks per process to even out the load
+    nchunks = processes * 4 if processes > 1 else 1
+    bounds = np.linspace(0, mlog.data_len, nchunks + 1)
+    chunks = []
+    for c in range(nchunks):
+        types = []
+        for (type_id, fmt, dtype, fields, offsets) in jobs:
+            (i0, i1) = np.searchsorted(offsets, bounds[c:c+2])
+            if i1 > i0:
+                types.append((type_id, dtype, fields, offsets[i0:i1]))
+        if types:
+            chunks.append((mlog.filehandle.name, types))
+    if processes > 1:
+        pool = multiproc.Pool(processes)
+        try:
+            results = pool.map(decode_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [decode_chunk(chunk) for chunk in chunks]
+
+    decoded = {}
+    for result in results:
+        for (type_id, columns) in result:
+            decoded.setdefault(type_id, []).append(columns)
+
+    # messages timed by TimeUS, then the rest take the time of the
+    # message before them, as DFReaderClock_usec does
+    clock = mlog.clock
+    stamps = {}
+    for (type_id, fmt, dtype, fields, offsets) in jobs:
+        decoded[type_id] = np.concatenate(decoded[type_id], axis=1)
+        if len(fmt.columns) > 0 and fmt.columns[0] == 'TimeUS':
+            stamps[type_id] = clock.timebase + decoded[type_id][0] * 0.000001
+    timed = [(jobs_offsets, stamps[type_id]) for (type_id, fmt, dtype, fields, jobs_offsets) in jobs if type_id in stamps]
+    if timed:
+        timed_offsets = np.concatenate([o for (o, t) in timed])
+        order = np.argsort(timed_offsets, kind='stable')
+        timed_offsets = timed_offsets[order]
+        timed_stamps = np.concatenate([t for (o, t) in timed])[order]
+    else:
+        timed_offsets = timed_stamps = np.zeros(0)
+    first_stamp = clock.timebase
+    if clock.first_us_stamp is not None:
+        first_stamp += clock.first_us_stamp * 0.000001
+
+    # number the messages in file order, as read_messages() does
+    all_offsets = np.concatenate([offsets for (type_id, fmt, dtype, fields, offsets) in jobs]) if jobs else np.zeros(0)
+    sequence = np.empty(len(all_offsets))
+    sequence[np.argsort(all_offsets, kind='stable')] = np.arange(len(all_offsets))
+    sequence_start = 0
+
+    types = {}
+    for (type_id, fmt, dtype, fields, offsets) in jobs:
+        if type_id not in stamps:
+            idx = np.searchsorted(timed_offsets, offsets) - 1
+            stamps[type_id] = np.where(idx >= 0, timed_stamps[np.maximum(idx, 0)] if len(timed_stamps) else 0, first_stamp)
+        data = np.empty((len(fields) + 2, len(offsets)))
+        data[0] = stamps[type_id]
+        data[1] = sequence[sequence_start:sequence_start+len(offsets)]
+        sequence_start += len(offsets)
+        data[2:] = decoded[type_id]
+        stored = [fmt.columns[i] for (i, c) in enumerate(fmt.format) if c not in DF_TEXT]
+        ints = [DFReader.FORMAT_TO_STRUCT[c][1] is None and DFReader.FORMAT_TO_STRUCT[c][2] is not float
+                for c in fmt.format if c not in DF_TEXT]
+        types[fmt.name] = MessageColumns(fmt.name, stored, ints, len(stored) == len(fmt.columns),
+                                         data, fmt.instance_field, list(fmt.columns))
+    return LogColumns(key, types)
+
+
+def open_columns(filename, mlog, flightmodes=True, processes=None):
+    '''columns for a log, from its sidecar file if it has an up to date
+    one, otherwise by reading the log. The sidecar is written if the
+    log's directory is writable'''
+    key = log_key(filename)
+    path = filename + '.columns'
+    columns = LogColumns.load(path, key)
+    if columns is not None:
+        return columns
+    columns = LogColumns.extract(mlog, key, processes)
+    if flightmodes:
+        columns.flightmodes = mlog.flightmode_list()
+    try:
+        columns.save(path)
+    except (IOError, OSError):
+        pass
+    return columns
@@ -107,38 +107,111 @@ def expected_field(ATT, yaw):
     return field
 
 data = None
+samples = None
 old_corrections = Correction()
 
-def wmm_error(p):
-    '''world magnetic model error with correction fit'''
-    p = list(p)
-    c = copy.copy(old_corrections)
-
-    c.offsets = Vector3(p.pop(0), p.pop(0), p.pop(0))
-    c.scaling = p.pop(0)
+# largest number of (parameter set, sample) pairs evaluated at once,
+# bounding the memory used by the intermediate arrays
+BATCH_SIZE = 200000
+
+class MagSamples:
+    '''the fit data packed into arrays, so corrections can be applied to
+    every sample at once'''
+    def __init__(self, data):
+        n = len(data)
+        self.mag = numpy.array([(MAG.MagX, MAG.MagY, MAG.MagZ) for (MAG,ATT,BAT) in data], dtype=float).reshape(n, 3)
+        # battery current for compassmot, zero when there is none
+        self.curr = numpy.zeros(n)
+        for (i, (MAG,ATT,BAT)) in enumerate(data):
+            if BAT is not None and hasattr(BAT, 'Curr') and not math.isnan(BAT.Curr):
+                self.curr[i] = BAT.Curr
+        roll = numpy.radians([ATT.Roll for (MAG,ATT,BAT) in data])
+        pitch = numpy.radians([ATT.Pitch for (MAG,ATT,BAT) in data])
+        (cp, sp, sr, cr) = (numpy.cos(pitch), numpy.sin(pitch), numpy.sin(roll), numpy.cos(roll))
+        # Matrix3.from_euler(roll, pitch, 0) for each sample. Rotating this
+        # by the yaw gives the full rotation, and its bottom row is the one
+        # get_yaw() uses from mavextra.rotation_df(ATT)
+        zero = numpy.zeros(n)
+        self.tilt = numpy.stack([numpy.stack([cp, sr * sp, cr * sp], axis=-1),
+                                 numpy.stack([zero, cr, -sr], axis=-1),
+                                 numpy.stack([-sp, sr * cp, cr * cp], axis=-1)], axis=1)
+        self.dcm_c = self.tilt[:,2,:]
+
+    def __len__(self):
+        return self.mag.shape[0]
+
+def unpack_parameters(P):
+    '''split K parameter vectors from fit_WWW() into offsets (K,3),
+    scaling (K), correction matrices (K,3,3) and cmot (K,3)'''
+    P = numpy.atleast_2d(numpy.asarray(P, dtype=float))
+    k = P.shape[0]
+    offsets = P[:,0:3]
+    scaling = P[:,3]
+    i = 4
     if margs['Elliptical']:
-        c.diag = Vector3(p.pop(0), p.pop(0), p.pop(0))
-        c.offdiag = Vector3(p.pop(0), p.pop(0), p.pop(0))
+        (d, o) = (P[:,i:i+3], P[:,i+3:i+6])
+        i += 6
+        mat = numpy.stack([numpy.stack([d[:,0], o[:,0], o[:,1]], axis=-1),
+                           numpy.stack([o[:,0], d[:,1], o[:,2]], axis=-1),
+                           numpy.stack([o[:,1], o[:,2], d[:,2]], axis=-1)], axis=1)
     else:
-        c.diag = Vector3(1.0, 1.0, 1.0)
-        c.offdiag = Vector3(0.0, 0.0, 0.0)
-
+        mat = numpy.tile(numpy.eye(3), (k, 1, 1))
     if margs['CMOT']:
-        c.cmot = Vector3(p.pop(0), p.pop(0), p.pop(0))
-
-    ret = 0
-
-    for (MAG,ATT,BAT) in data:
-        yaw = get_yaw(ATT,MAG,BAT,c)
-        expected = expected_field(ATT, yaw)
-        observed = correct(MAG,BAT,c)
-
-        error = (expected - observed).length()
-        ret += error
+        cmot = P[:,i:i+3]
+    else:
+        c = old_corrections.cmot
+        cmot = numpy.tile([c.x, c.y, c.z], (k, 1))
+    return (offsets, scaling, mat, cmot)
+
+def correct_array(s, offsets, scaling, mat, cmot):
+    '''correct() applied to all samples for K corrections, giving (K,N,3)'''
+    mag = (s.mag[None,:,:] + offsets[:,None,:]) * scaling[:,None,None]
+    mag = numpy.einsum('kij,knj->kni', mat, mag, optimize=True)
+    return mag + cmot[:,None,:] * s.curr[None,:,None]
+
+def get_yaw_array(s, mag):
+    '''get_yaw() for corrected fields of shape (K,N,3), giving (K,N)'''
+    (cx, cy, cz) = (s.dcm_c[:,0], s.dcm_c[:,1], s.dcm_c[:,2])
+    cos_pitch_sq = 1.0-(cx*cx)
+    headY = mag[...,1] * cz - mag[...,2] * cy
+    headX = mag[...,0] * cos_pitch_sq - cx * (mag[...,1] * cy + mag[...,2] * cz)
+    yaw = numpy.degrees(numpy.arctan2(-headY,headX)) + declination
+    return numpy.where(yaw < 0, yaw + 360, yaw)
+
+def expected_field_array(s, yaw):
+    '''expected_field() for yaws of shape (K,N), giving (K,N,3)'''
+    yaw = numpy.radians(yaw)
+    sy = numpy.sin(yaw)
+    cy = numpy.cos(yaw)
+    # rot.transposed() * earth_field, with rot split into the yaw rotation
+    # and the per-sample tilt
+    ef = earth_field
+    field = numpy.stack([cy * ef.x + sy * ef.y, cy * ef.y - sy * ef.x, numpy.full(yaw.shape, ef.z)], axis=-1)
+    return numpy.einsum('nji,knj->kni', s.tilt, field, optimize=True)
+
+def wmm_error_array(P):
+    '''wmm_error() for each of K parameter vectors'''
+    (offsets, scaling, mat, cmot) = unpack_parameters(P)
+    ret = numpy.empty(len(scaling))
+    step = max(1, BATCH_SIZE // len(samples))
+    for i in range(0, len(ret), step):
+        observed = correct_array(samples, offsets[i:i+step], scaling[i:i+step], mat[i:i+step], cmot[i:i+step])
+        expected = expected_field_array(samples, get_yaw_array(samples, observed))
+        error = numpy.sqrt(numpy.sum((expected - observed)**2, axis=-1))
+        ret[i:i+step] = numpy.sum(error, axis=-1) / len(samples)
+    return ret
 
-    ret /= len(data)
+def wmm_error(p):
+    '''world magnetic model error with correction fit'''
+    return float(wmm_error_array(p)[0])
 
-    return ret
+def wmm_error_gradient(p, epsilon=math.sqrt(numpy.finfo(float).eps)):
+    '''forward difference gradient of wmm_error(), with all the steps
+    evaluated together'''
+    p = numpy.asarray(p, dtype=float)
+    P = numpy.vstack([p, p + numpy.eye(len(p)) * epsilon])
+    err = wmm_error_array(P)
+    return (err[1:] - err[0]) / epsilon
 
 def fit_WWW():
     from scipy import optimize
@@ -180,7 +253,7 @@ def fit_WWW():
             for i in range(3):
                 bounds.append((-max_cmot,max_cmot))
 
-    (p,err,iterations,imode,smode) = optimize.fmin_slsqp(wmm_error, p, bounds=bounds, full_output=True)
+    (p,err,iterations,imode,smode) = optimize.fmin_slsqp(wmm_error, p, bounds=bounds, fprime=wmm_error_gradient, full_output=True)
     if imode != 0:
         print("Fit failed: %s" % smode)
         sys.exit(1)
@@ -230,7 +303,7 @@ def magfit(mlog, timestamp_in_range):
     '''find best magnetometer offset fit to a log file'''
 
     global earth_field, declination
-    global data
+    global data, samples
     data = []
 
     ATT = None
@@ -334,6 +407,7 @@ def magfit(mlog, timestamp_in_range):
         if remove_offsets(MAG, BAT, old_corrections):
             data2.append((MAG,ATT,BAT))
     data = data2
+    samples = MagSamples(data)
 
     print("Extracted %u points" % len(data))
     print("Current: %s diag: %s offdiag: %s cmot: %s scale: %.2f" % (
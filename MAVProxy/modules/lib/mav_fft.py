@@ -2,6 +2,16 @@
 
 '''
 extract ISBH and ISBD messages from AP_Logging files and produce FFT plots
+
+The samples of each batch are written into a buffer sized from its ISBH
+header, and the batch is transformed as soon as it is complete. Only the
+running sum of each sensor's spectra is kept, so memory doesn't grow with
+the length of the log. The spectra of each sensor instance are summed in
+a child process of their own.
+
+By default the complex spectra of the batches are averaged. With welch set
+each batch is Hann windowed and their power spectra are averaged instead,
+as in Welch's method with the batches as segments.
 '''
 
 import numpy
@@ -11,6 +21,7 @@ import sys
 import time
 
 from pymavlink import mavutil
+from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.lib.multiproc_util import MPDataLogChildTask
 
 class MavFFT(MPDataLogChildTask):
@@ -24,24 +35,107 @@ class MavFFT(MPDataLogChildTask):
             A dataflash or telemetry log
         xlimits: MAVExplorer.XLimits
             An object capturing timestamp limits
+        welch : bool
+            Average power spectra of windowed batches (optional)
         '''
 
         super(MavFFT, self).__init__(*args, **kwargs)
 
         # all attributes are implicitly passed to the child process 
         self.xlimits = kwargs['xlimits']
+        self.welch = kwargs.get('welch', False)
 
     # @override
     def child_task(self):
         '''Launch `mavfft_display`'''
 
         # run the fft tool
-        mavfft_display(self.mlog, self.xlimits.timestamp_in_range)
+        mavfft_display(self.mlog, self.xlimits.timestamp_in_range, welch=self.welch)
+
+class BatchSpectra(object):
+    '''running sum of the spectra of one sensor's batches'''
+    def __init__(self, welch=False):
+        self.welch = welch
+        self.count = 0
+        self.nsamples = None
+        self.sample_rate_hz = None
+        self.window = None
+        # X, Y and Z rows
+        self.sum = None
+
+    def add(self, samples, multiplier, sample_rate_hz):
+        '''add a batch of samples, shaped (3, N)'''
+        if self.nsamples is None:
+            self.nsamples = samples.shape[1]
+            self.sample_rate_hz = sample_rate_hz
+            if self.welch:
+                self.window = numpy.hanning(self.nsamples)
+        elif samples.shape[1] != self.nsamples:
+            print("Skipping batch of %u samples (expected %u)" % (samples.shape[1], self.nsamples))
+            return
+        d = samples / float(multiplier)
+        d -= numpy.sum(d, axis=1, keepdims=True) / self.nsamples
+        if self.welch:
+            d_fft = numpy.fft.rfft(d * self.window, axis=1)
+            d_fft = numpy.real(d_fft * numpy.conj(d_fft))
+        else:
+            d_fft = numpy.fft.rfft(d, axis=1)
+        if self.sum is None:
+            self.sum = d_fft
+        else:
+            self.sum += d_fft
+        self.count += 1
+
+    def freq(self):
+        return numpy.fft.rfftfreq(self.nsamples, 1.0/self.sample_rate_hz)
+
+def average_spectra(conn, welch):
+    '''child process summing the spectra of batches received on conn,
+    until None is received. Sends back the BatchSpectra'''
+    spectra = BatchSpectra(welch)
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+        spectra.add(*batch)
+    conn.send(spectra)
+    conn.close()
+
+class SpectraWorker(object):
+    '''sums the spectra of one sensor's batches, in a child process if
+    multiprocess is set'''
+    def __init__(self, welch, multiprocess):
+        self.spectra = None
+        self.conn = None
+        self.process = None
+        if multiprocess:
+            (self.conn, child_conn) = multiproc.Pipe()
+            self.process = multiproc.Process(target=average_spectra, args=(child_conn, welch))
+            self.process.start()
+        else:
+            self.spectra = BatchSpectra(welch)
+
+    def add(self, samples, multiplier, sample_rate_hz):
+        if self.conn is not None:
+            # blocks while the child is busy, so batches don't pile up
+            self.conn.send((samples, multiplier, sample_rate_hz))
+        else:
+            self.spectra.add(samples, multiplier, sample_rate_hz)
 
-def mavfft_display(mlog, timestamp_in_range):
+    def result(self):
+        '''the BatchSpectra, once all batches are added'''
+        if self.conn is not None:
+            self.conn.send(None)
+            self.spectra = self.conn.recv()
+            self.conn.close()
+            self.conn = None
+            self.process.join()
+        return self.spectra
+
+def mavfft_display(mlog, timestamp_in_range, welch=False, multiprocess=True):
     '''display fft for raw ACC data in logfile'''
 
-    '''object to store data about a single FFT plot'''
+    '''object to collect the samples of one batch'''
     class PlotData(object):
         def __init__(self, ffth):
             self.seqno = -1
@@ -50,16 +144,14 @@ def mavfft_display(mlog, timestamp_in_range):
             self.instance = ffth.instance
             self.sample_rate_hz = ffth.smp_rate
             self.multiplier = ffth.mul
-            self.data = {}
-            self.data["X"] = []
-            self.data["Y"] = []
-            self.data["Z"] = []
+            # X, Y and Z rows, filled in by the ISBD messages
+            self.samples = numpy.empty((3, ffth.smp_cnt))
+            self.count = 0
             self.holes = False
-            self.freq = None
 
         def add_fftd(self, fftd):
             if fftd.N != self.fftnum:
-                print("Skipping ISBD with wrong fftnum (%u vs %u)\n" % (fftd.fftnum, self.fftnum))
+                print("Skipping ISBD with wrong fftnum (%u vs %u)\n" % (fftd.N, self.fftnum))
                 return
             if self.holes:
                 print("Skipping ISBD(%u) for ISBH(%u) with holes in it" % (fftd.seqno, self.fftnum))
@@ -68,10 +160,19 @@ def mavfft_display(mlog, timestamp_in_range):
                 print("ISBH(%u) has holes in it" % fftd.N)
                 self.holes = True
                 return
+            n = len(fftd.x)
+            if self.count + n > self.samples.shape[1]:
+                print("ISBH(%u) has too many samples" % fftd.N)
+                self.holes = True
+                return
             self.seqno += 1
-            self.data["X"].extend(fftd.x)
-            self.data["Y"].extend(fftd.y)
-            self.data["Z"].extend(fftd.z)
+            self.samples[0,self.count:self.count+n] = fftd.x
+            self.samples[1,self.count:self.count+n] = fftd.y
+            self.samples[2,self.count:self.count+n] = fftd.z
+            self.count += n
+
+        def complete(self):
+            return not self.holes and self.count == self.samples.shape[1]
 
         def prefix(self):
             if self.sensor_type == 0:
@@ -89,11 +190,22 @@ def mavfft_display(mlog, timestamp_in_range):
 
     print("Processing log for ISBH and ISBD messages")
 
-    things_to_plot = []
+    workers = {}
     plotdata = None
     start_time = time.time()
     mlog.rewind()
 
+    def close_batch(plotdata):
+        if plotdata is None or plotdata.count == 0:
+            return
+        if not plotdata.complete():
+            print("Skipping incomplete ISBH(%u)" % plotdata.fftnum)
+            return
+        tag = plotdata.tag()
+        if tag not in workers:
+            workers[tag] = SpectraWorker(welch, multiprocess)
+        workers[tag].add(plotdata.samples, plotdata.multiplier, plotdata.sample_rate_hz)
+
     while True:
         m = mlog.recv_match(type=['ISBH','ISBD'])
         if m is None:
@@ -105,9 +217,8 @@ def mavfft_display(mlog, timestamp_in_range):
             break
         msg_type = m.get_type()
         if msg_type == "ISBH":
-            if plotdata is not None:
-                # close off previous data collection
-                things_to_plot.append(plotdata)
+            # close off previous data collection
+            close_batch(plotdata)
             # initialise plot-data collection object
             plotdata = PlotData(m)
             continue
@@ -116,43 +227,37 @@ def mavfft_display(mlog, timestamp_in_range):
             if plotdata is None:
                 continue
             plotdata.add_fftd(m)
+            if plotdata.complete():
+                # transform the batch as soon as it is complete
+                close_batch(plotdata)
+                plotdata = None
+    close_batch(plotdata)
 
-    if len(things_to_plot) == 0:
+    sum_fft = {}
+    for tag in workers:
+        spectra = workers[tag].result()
+        if spectra.count > 0:
+            sum_fft[tag] = spectra
+
+    if len(sum_fft) == 0:
         print("No FFT data. Did you set INS_LOG_BAT_MASK?")
         return
     time_delta = time.time() - start_time
-    print("Extracted %u fft data sets" % len(things_to_plot))
+    print("Extracted %u fft data sets" % sum([s.count for s in sum_fft.values()]))
 
-    sum_fft = {}
-    freqmap = {}
-    count = 0
-
-    first_freq = None
-    for thing_to_plot in things_to_plot:
-        for axis in [ "X","Y","Z" ]:
-            d = numpy.array(thing_to_plot.data[axis])/float(thing_to_plot.multiplier)
-            if len(d) == 0:
-                print("No data?!?!?!")
-                continue
-            
-            avg = numpy.sum(d) / len(d)
-            d -= avg
-            d_fft = numpy.fft.rfft(d)
-            if thing_to_plot.tag() not in sum_fft:
-                sum_fft[thing_to_plot.tag()] = {
-                    "X": 0,
-                    "Y": 0,
-                    "Z": 0
-                }
-            sum_fft[thing_to_plot.tag()][axis] = numpy.add(sum_fft[thing_to_plot.tag()][axis], d_fft)
-            count += 1
-            freq = numpy.fft.rfftfreq(len(d), 1.0/thing_to_plot.sample_rate_hz)
-            freqmap[thing_to_plot.tag()] = freq
+    # the complex spectra are averaged over the batches and axes of all sensors
+    count = 3 * sum([s.count for s in sum_fft.values()])
 
     for sensor in sum_fft:
+        spectra = sum_fft[sensor]
         pylab.figure(str(sensor))
-        for axis in [ "X","Y","Z" ]:
-            pylab.plot(freqmap[sensor], numpy.abs(sum_fft[sensor][axis]/count), label=axis)
+        for (i, axis) in enumerate([ "X","Y","Z" ]):
+            if welch:
+                # amplitude from the average power, corrected for the window gain
+                amplitude = numpy.sqrt(spectra.sum[i] / spectra.count) * spectra.nsamples / numpy.sum(spectra.window)
+            else:
+                amplitude = numpy.abs(spectra.sum[i]/count)
+            pylab.plot(spectra.freq(), amplitude, label=axis)
         pylab.legend(loc='upper right')
         pylab.xlabel('Hz')
 
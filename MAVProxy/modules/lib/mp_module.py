@@ -5,6 +5,14 @@ class MPModule(object):
     The base class for all modules
     '''
 
+    # message types passed to mavlink_packet, e.g. ['HEARTBEAT', 'ATTITUDE'].
+    # None means every message
+    mavlink_types = None
+
+    # how often idle_task is called, in Hz. None means on every pass of the
+    # main loop. See also wake_idle()
+    idle_rate = None
+
     def __init__(self, mpstate, name, description=None, public=False, multi_instance=False, multi_vehicle=False):
         '''
         Constructor
@@ -52,6 +60,29 @@ class MPModule(object):
     def mavlink_packet(self, packet):
         pass
 
+    def _overrides(self, name):
+        '''true if this module's class overrides the MPModule method name'''
+        method = getattr(type(self), name, None)
+        base = getattr(MPModule, name)
+        return getattr(method, '__func__', method) is not getattr(base, '__func__', base)
+
+    def wants_mavlink(self, mtype):
+        '''true if mavlink_packet should be called for messages of type mtype'''
+        if not self._overrides('mavlink_packet'):
+            # nothing to do with any message
+            return False
+        return self.mavlink_types is None or mtype in self.mavlink_types
+
+    def has_idle_task(self):
+        return self._overrides('idle_task')
+
+    def wake_idle(self, delay=0):
+        '''call idle_task within delay seconds, even if that is sooner than
+        idle_rate allows. Use when there is new work for idle_task'''
+        scheduler = getattr(self.mpstate, 'idle_scheduler', None)
+        if scheduler is not None:
+            scheduler.wake(self, time.time() + delay)
+
     #
     # Methods for subclass use
     #
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Fixed size, time indexed store of recent telemetry.
+
+Each TelemetryRing holds the last `capacity` samples of one message type as
+NumPy columns (one time column plus one column per field), so historical
+lookups are a searchsorted over memory instead of a database query.
+'''
+
+import threading
+import numpy as np
+
+
+def interpolate_columns(times, values, req_times, max_gap):
+    '''interpolate every column of values (one row per entry of the sorted
+    times array) to each of req_times at once.
+    Returns (interpolated, valid) where valid is false for requested times
+    with no sample within max_gap seconds'''
+    req_times = np.asarray(req_times, dtype=float)
+    n = len(times)
+    if n == 0:
+        return (np.zeros((len(req_times), values.shape[1])),
+                np.zeros(len(req_times), dtype=bool))
+    hi = np.searchsorted(times, req_times)
+    lo = np.clip(hi - 1, 0, n - 1)
+    hi = np.clip(hi, 0, n - 1)
+    gap = np.minimum(np.abs(req_times - times[lo]), np.abs(times[hi] - req_times))
+    interpolated = np.empty((len(req_times), values.shape[1]))
+    for col in range(values.shape[1]):
+        interpolated[:, col] = np.interp(req_times, times, values[:, col])
+    return interpolated, gap <= max_gap
+
+
+class TelemetryRing(object):
+    '''ring buffer of (time, fields...) samples with nearest and interpolated lookup
+
+    Samples are stored twice, at i and i+capacity, so the live window is always
+    one contiguous, time ordered slice of the backing arrays and can be
+    searched without copying or unrolling the ring.
+    '''
+    def __init__(self, fields, capacity):
+        self.fields = tuple(fields)
+        self.capacity = int(capacity)
+        self.times = np.zeros(2 * self.capacity)
+        self.values = np.zeros((2 * self.capacity, len(self.fields)))
+        self.start = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        with self.lock:
+            self.start = 0
+            self.count = 0
+
+    def append(self, t, values):
+        '''add a sample. t is unix time in seconds and must not go backwards'''
+        with self.lock:
+            if self.count > 0 and t < self.times[self.start + self.count - 1]:
+                # the system clock stepped backwards, old samples can't be ordered
+                self.start = 0
+                self.count = 0
+            if self.count < self.capacity:
+                idx = (self.start + self.count) % self.capacity
+                self.count += 1
+            else:
+                idx = self.start
+                self.start = (self.start + 1) % self.capacity
+            self.times[idx] = t
+            self.times[idx + self.capacity] = t
+            self.values[idx] = values
+            self.values[idx + self.capacity] = values
+
+    def _window(self):
+        # must be called with self.lock held
+        end = self.start + self.count
+        return self.times[self.start:end], self.values[self.start:end]
+
+    def oldest(self):
+        '''time of the oldest sample held, or None if empty'''
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.times[self.start]
+
+    def covers(self, t):
+        '''true if t is not older than the oldest sample held'''
+        oldest = self.oldest()
+        return oldest is not None and t >= oldest
+
+    def nearest(self, t, max_gap):
+        '''return (time, values) of the sample closest to t, or None if
+        there is no sample within max_gap seconds'''
+        with self.lock:
+            if self.count == 0:
+                return None
+            times, values = self._window()
+            i = np.searchsorted(times, t)
+            if i == self.count or (i > 0 and t - times[i-1] < times[i] - t):
+                i -= 1
+            if abs(times[i] - t) > max_gap:
+                return None
+            return float(times[i]), values[i].tolist()
+
+    def interpolate(self, t, max_gap):
+        '''return the fields linearly interpolated to time t, or None if
+        there is no sample within max_gap seconds of t'''
+        with self.lock:
+            if self.count == 0:
+                return None
+            times, values = self._window()
+            hi = np.searchsorted(times, t)
+            lo = max(hi - 1, 0)
+            hi = min(hi, self.count - 1)
+            if min(abs(t - times[lo]), abs(times[hi] - t)) > max_gap:
+                return None
+            if hi == lo or times[hi] == times[lo] or t >= times[hi]:
+                return values[hi].tolist()
+            if t <= times[lo]:
+                return values[lo].tolist()
+            w = (t - times[lo]) / (times[hi] - times[lo])
+            return (values[lo] + w * (values[hi] - values[lo])).tolist()
+
+    def interpolate_many(self, req_times, max_gap):
+        '''vectorised interpolate() for an array of times.
+        Returns (interpolated, valid), see interpolate_columns'''
+        with self.lock:
+            times, values = self._window()
+            return interpolate_columns(times, values, req_times, max_gap)
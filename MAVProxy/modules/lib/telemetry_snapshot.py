@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+Latest value of each live telemetry field, shared between the mavlink
+handlers that write it and the web server threads that read it.
+
+Every field carries a version that only moves when its value changes, so
+serialised responses built from a set of fields can be cached and reused
+until one of those fields changes. The 'time' field of a namedtuple is
+the time of the packet, so it doesn't count as a change: at telemetry
+rates every packet would otherwise move the version. Instead responses
+are cached with a marker in place of each time, and the latest times are
+written over the markers every time a response is served.
+'''
+
+import json
+import threading
+
+# stands in for the time of a field in cached responses
+TIME_MARKER = '\x00time:%s\x00'
+
+
+def has_time(value):
+    fields = getattr(value, '_fields', None)
+    return bool(fields) and fields[0] == 'time'
+
+
+def payload(value):
+    '''the part of a value that moves its version, all but the time of a
+    namedtuple'''
+    if has_time(value):
+        return tuple(value[1:])
+    return value
+
+
+class TelemetrySnapshot(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.versions = {}
+        self.version = 0
+        # render key -> (field versions it was built from, rendered text)
+        self.renders = {}
+        # set while a thread is building a response for render()
+        self.local = threading.local()
+
+    def set(self, name, value):
+        '''store the latest value of a field. Values must not be modified
+        after they are stored, namedtuples and plain values work well'''
+        with self.lock:
+            changed = name not in self.values or payload(self.values[name]) != payload(value)
+            self.values[name] = value
+            if not changed:
+                return
+            self.version += 1
+            self.versions[name] = self.version
+
+    def get(self, name, default=None):
+        '''the latest value of a field. While render() is building a
+        response the time is replaced by a marker'''
+        with self.lock:
+            value = self.values.get(name, default)
+        if getattr(self.local, 'building', False) and has_time(value):
+            value = value._replace(time=TIME_MARKER % name)
+        return value
+
+    def stamp(self, names):
+        '''versions of the fields in names, equal stamps mean nothing changed'''
+        with self.lock:
+            return tuple(self.versions.get(name, 0) for name in names)
+
+    def render(self, key, names, build, default=None):
+        '''return build(), JSON text for the response called key, which
+        depends on the fields in names. build is only called again once one
+        of those fields has changed since the last render of key. The
+        current time of each field is serialised with default, as in
+        json.dumps'''
+        with self.lock:
+            stamp = tuple(self.versions.get(name, 0) for name in names)
+            cached = self.renders.get(key)
+        if cached is not None and cached[0] == stamp:
+            text = cached[1]
+        else:
+            self.local.building = True
+            try:
+                text = build()
+            finally:
+                self.local.building = False
+            with self.lock:
+                self.renders[key] = (stamp, text)
+        return self.fill_times(text, names, default)
+
+    def fill_times(self, text, names, default=None):
+        '''write the latest time of each field in names over its marker'''
+        if text is None:
+            return None
+        for name in names:
+            marker = json.dumps(TIME_MARKER % name)
+            if marker not in text:
+                continue
+            with self.lock:
+                value = self.values.get(name)
+            text = text.replace(marker, json.dumps(value.time, default=default))
+        return text
@@ -12,8 +12,9 @@ import sys
 import os
 import json
 import time
+import threading
 import numpy as np
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
 from datetime import datetime
 import traceback
 
@@ -23,6 +24,8 @@ import mysql.connector
 from mysql.connector.pooling import MySQLConnectionPool
 
 from modules.lib import mp_module
+from modules.lib.telemetry_ring import TelemetryRing, interpolate_columns
+from modules.lib.telemetry_snapshot import TelemetrySnapshot
 from modules.server.helperFunctions import heading_to_vector, degrees_to_rads
 
 logger = mavproxy_logging.create_logger("database")
@@ -36,6 +39,204 @@ HEARTBEAT_TIMEOUT = 3
 TIME_INCONSISTENCY_MAX = 20
 TIME_EPSILON_SECONDS = 1
 
+# Write-behind queue tuning. Rows are flushed when either WRITE_FLUSH_ROWS rows
+# are pending or WRITE_FLUSH_INTERVAL seconds have passed since the last flush.
+WRITE_QUEUE_MAX_ROWS = 20000
+WRITE_FLUSH_ROWS = 250
+WRITE_FLUSH_INTERVAL = 0.25
+# How much recent telemetry is kept in memory for historical (?tm=) lookups.
+# Older requests fall back to MySQL.
+RING_STORE_SECONDS = 600
+RING_STORE_MAX_RATE_HZ = 50
+
+# What to do when the queue is full: 'drop_oldest', 'drop_newest' or 'block'
+WRITE_QUEUE_POLICY = 'drop_oldest'
+# Maximum time the main loop may block on a full queue under the 'block' policy
+WRITE_BLOCK_TIMEOUT = 0.05
+
+
+def datetime_to_unix(t):
+    '''unix time in seconds of a naive local datetime, as stored by MySQL'''
+    return time.mktime(t.timetuple()) + t.microsecond / 1e6
+
+
+class WriteBehindQueue(object):
+    '''
+    Buffers INSERT rows in memory and writes them from a dedicated thread, so
+    mavlink_packet never waits on MySQL. Rows are grouped per statement and
+    written with executemany, which mysql.connector turns into a single
+    multi-row INSERT.
+    '''
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, pool, max_rows=WRITE_QUEUE_MAX_ROWS, flush_rows=WRITE_FLUSH_ROWS,
+                 flush_interval=WRITE_FLUSH_INTERVAL, policy=WRITE_QUEUE_POLICY):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown write queue policy: " + str(policy))
+        self.pool = pool
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.policy = policy
+
+        self.cond = threading.Condition()
+        # query -> deque of row tuples, in insertion order so older tables flush first
+        self.pending = OrderedDict()
+        self.pending_rows = 0
+        # queries whose rows are never dropped, e.g. waypoints and mode changes
+        self.keep = set()
+        self.running = True
+
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.high_water = 0
+        self.last_flush_ms = 0.0
+
+        self.thread = threading.Thread(target=self.writer_loop, name='database_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, query, row, keep=False):
+        '''queue a row to be inserted with query. Never touches the database.
+        Rows queued with keep=True are rare and can't be rebuilt, so they are
+        queued even when the queue is full and are never dropped'''
+        with self.cond:
+            if keep:
+                self.keep.add(query)
+            if self.pending_rows >= self.max_rows:
+                if self.policy == 'block':
+                    self.cond.notify_all()
+                    self.cond.wait(WRITE_BLOCK_TIMEOUT)
+                if self.pending_rows >= self.max_rows and not keep:
+                    if self.policy != 'drop_oldest' or not self._drop_oldest():
+                        self.dropped += 1
+                        return False
+            rows = self.pending.get(query)
+            if rows is None:
+                rows = self.pending[query] = deque()
+            rows.append(tuple(row))
+            self.pending_rows += 1
+            self.queued += 1
+            self.high_water = max(self.high_water, self.pending_rows)
+            if self.pending_rows >= self.flush_rows:
+                self.cond.notify()
+        return True
+
+    def _drop_oldest(self):
+        '''drop the oldest row of the query with the most rows pending, which
+        is the highest rate telemetry. Must be called with self.cond held'''
+        rows = None
+        for query, r in self.pending.items():
+            if query not in self.keep and (rows is None or len(r) > len(rows)):
+                rows = r
+        if not rows:
+            return False
+        rows.popleft()
+        self.pending_rows -= 1
+        self.dropped += 1
+        return True
+
+    def _requeue(self, batch):
+        '''put a batch that couldn't be written back in front of the queue'''
+        with self.cond:
+            pending = OrderedDict()
+            for query, rows in batch.items():
+                pending[query] = rows
+            for query, rows in self.pending.items():
+                if query in pending:
+                    pending[query].extend(rows)
+                else:
+                    pending[query] = rows
+            self.pending = pending
+            self.pending_rows = sum(len(rows) for rows in pending.values())
+            while self.pending_rows > self.max_rows and self._drop_oldest():
+                pass
+            self.high_water = max(self.high_water, self.pending_rows)
+
+    def flush(self):
+        '''ask the writer thread to write everything now'''
+        with self.cond:
+            self.cond.notify()
+
+    def stop(self, timeout=5):
+        '''stop the writer thread after writing out what is queued'''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(timeout)
+
+    def writer_loop(self):
+        last_flush = time.time()
+        while True:
+            with self.cond:
+                while (self.running and self.pending_rows < self.flush_rows and
+                       time.time() - last_flush < self.flush_interval):
+                    self.cond.wait(max(0, self.flush_interval - (time.time() - last_flush)))
+                batch = self.pending
+                self.pending = OrderedDict()
+                self.pending_rows = 0
+                running = self.running
+                # wake anyone blocked on a full queue
+                self.cond.notify_all()
+            last_flush = time.time()
+            if batch:
+                self.write_batch(batch)
+            if not running:
+                return
+
+    def write_batch(self, batch):
+        start = time.time()
+        try:
+            conn = self.pool.get_connection()
+        except Exception as e:
+            # usually the pool is exhausted for a moment; try again on the next flush
+            logger.error("database writer could not get a connection: " + str(e))
+            self._requeue(batch)
+            time.sleep(self.flush_interval)
+            return
+        try:
+            cursor = conn.cursor()
+            for query, rows in batch.items():
+                if not rows:
+                    continue
+                rows = list(rows)
+                try:
+                    cursor.executemany(query, rows)
+                    self.written += len(rows)
+                except mysql.connector.IntegrityError:
+                    # one duplicate row shouldn't lose the whole batch
+                    self.write_rows(cursor, query, rows)
+                except mysql.connector.Error as e:
+                    self.failed += len(rows)
+                    logger.error("MYSQl error in database writer: " + str(e))
+                self.batches += 1
+            conn.commit()
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            conn.close()
+        self.last_flush_ms = (time.time() - start) * 1000
+
+    def write_rows(self, cursor, query, rows):
+        for row in rows:
+            try:
+                cursor.execute(query, row)
+                self.written += 1
+            except mysql.connector.IntegrityError:
+                self.failed += 1
+            except mysql.connector.Error as e:
+                self.failed += 1
+                logger.error("MYSQl error in database writer: " + str(e))
+
+    def __str__(self):
+        return "{queued=%u written=%u pending=%u dropped=%u failed=%u batches=%u max_pending=%u last_flush=%.1fms}" % (
+            self.queued, self.written, self.pending_rows, self.dropped, self.failed,
+            self.batches, self.high_water, self.last_flush_ms)
+
+
 class DatabaseModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(DatabaseModule, self).__init__(mpstate, "database", "database module", public=True)
@@ -50,6 +251,10 @@ class DatabaseModule(mp_module.MPModule):
             
             time.sleep(10)
 
+        # telemetry inserts are written from a background thread, see WriteBehindQueue
+        self.writer = WriteBehindQueue(self.pool)
+        self.mpstate.status.counters['DBWrite'] = self.writer
+
         self.autopilot_boot_time = None
         self.time_inconsistent = False
 
@@ -107,6 +312,39 @@ class DatabaseModule(mp_module.MPModule):
 
         self.current_waypoint_index = 0
 
+        # recent numeric telemetry, keyed by table name. The time column is
+        # implicit so fields skip the namedtuple's leading 'time'.
+        capacity = RING_STORE_SECONDS * RING_STORE_MAX_RATE_HZ
+        self.rings = {
+            'attitude': TelemetryRing(self.ATTITUDE._fields[1:], capacity),
+            'global_position_int': TelemetryRing(self.GPS_INT._fields[1:], capacity),
+            'vfr_hud': TelemetryRing(self.VFR_HUD._fields[1:], capacity),
+            'battery': TelemetryRing(self.BATTERY._fields[1:], capacity),
+            'wind': TelemetryRing(self.WIND._fields[1:], capacity),
+            'gps_status': TelemetryRing(self.GPS_STATUS._fields[1:], capacity),
+            'signal_status': TelemetryRing(self.SIGNAL._fields[1:], capacity),
+        }
+
+        # waypoint and mode rows are only written when they change; these count the
+        # checks that found nothing new and are shown under DBSkipped in status
+        self.wp_version = None
+        self.skipped_writes = {'waypoints': 0, 'mode': 0}
+        self.mpstate.status.counters['DBSkipped'] = self.skipped_writes
+
+        # latest values for the live (no tm) status API, which never needs the database
+        self.snapshot = TelemetrySnapshot()
+        self.snapshot.set('attitude', self.attitude)
+        self.snapshot.set('gps', self.global_position_int)
+        self.snapshot.set('gps_status', self.GPSStatus)
+        self.snapshot.set('vfr_hud', self.vfr_hud)
+        self.snapshot.set('flight_time', self.flight_time)
+        self.snapshot.set('wind', self.wind)
+        self.snapshot.set('battery', self.battery)
+        self.snapshot.set('signal', self.signal)
+        self.snapshot.set('current_wp', self.current_waypoint_index)
+        self.snapshot.set('mode', self.mode)
+        self._snapshot_status_text()
+
     def _get_packet_time(self, msg):
 
         # # If the packet includes a time since boot, use autopilot boot time
@@ -163,9 +401,9 @@ class DatabaseModule(mp_module.MPModule):
         if len(data) < 1 or len(data[0]) < 1:
             logger.debug("Empty data, cannot interpolate")
             return data
-        data = data[:10]  # don't use tons of old data
+        data = sorted(data[:10], key=lambda d: d[0])  # don't use tons of old data; np.interp needs increasing times
         interpolated = [req_time]
-        times = [d[0].strftime("%s") for d in data]  # get the unix time version of each datetime
+        times = [datetime_to_unix(d[0]) for d in data]
         for i in range(1, len(data[0])):
             values = [d[i] for d in data]
             interpolated.append(np.interp(req_time, times, values))
@@ -191,6 +429,71 @@ class DatabaseModule(mp_module.MPModule):
         closest = self.get_nearby_data(cursor, req_time, query)
         return self.interpolate(closest, req_time)
 
+    # Stores a row (whose first element is its datetime) in the in-memory ring for table
+    def _ring_append(self, table, row):
+        self.rings[table].append(datetime_to_unix(row[0]), row[1:])
+
+    # Looks up req_time in the in-memory ring for table.
+    # @returns (found, data): found is False if req_time is older than the ring and the
+    #          database must be asked. data is [req_time, field1, field2, ...] or None if
+    #          there was no sample close enough to req_time.
+    def _ring_interpolate(self, table, req_time):
+        ring = self.rings[table]
+        if not ring.covers(req_time):
+            return False, None
+        values = ring.interpolate(req_time, TIME_VARIANCE_MAX)
+        if values is None:
+            return True, None
+        return True, [req_time] + values
+
+    # Interpolates table to every time in req_times at once. Times inside the in-memory
+    # ring are served from it; the rest are answered from a single range query.
+    # @param columns: database columns, in the same order as the ring's fields
+    # @returns list holding [req_time, field1, field2, ...] or None for each of req_times
+    def _interpolate_many(self, table, columns, req_times):
+        req_times = np.asarray(req_times, dtype=float)
+        result = [None] * len(req_times)
+        if len(req_times) == 0:
+            return result
+
+        def fill(indexes, values, valid):
+            for i, row, ok in zip(indexes, values.tolist(), valid):
+                if ok:
+                    result[i] = [float(req_times[i])] + row
+
+        oldest = self.rings[table].oldest()
+        if oldest is None:
+            in_ring = np.zeros(len(req_times), dtype=bool)
+        else:
+            in_ring = req_times >= oldest
+        if in_ring.any():
+            values, valid = self.rings[table].interpolate_many(req_times[in_ring], TIME_VARIANCE_MAX)
+            fill(np.nonzero(in_ring)[0], values, valid)
+        if not in_ring.all():
+            indexes = np.nonzero(~in_ring)[0]
+            wanted = req_times[indexes]
+            rows = self._query_range((table, columns,
+                                      wanted.min() - TIME_VARIANCE_MAX,
+                                      wanted.max() + TIME_VARIANCE_MAX))
+            if rows:
+                times = np.array([datetime_to_unix(r[0]) for r in rows])
+                values = np.array([r[1:] for r in rows], dtype=float)
+                values, valid = interpolate_columns(times, values, wanted, TIME_VARIANCE_MAX)
+                fill(indexes, values, valid)
+        return result
+
+    # Same as _ring_interpolate but returns the closest sample, with its own datetime.
+    # Only used for tables of integer columns, so the ring's floats are cast back to
+    # int to match what the database returns.
+    def _ring_nearest(self, table, req_time):
+        ring = self.rings[table]
+        if not ring.covers(req_time):
+            return False, None
+        closest = ring.nearest(req_time, TIME_VARIANCE)
+        if closest is None:
+            return True, None
+        return True, [datetime.fromtimestamp(closest[0])] + [int(v) for v in closest[1]]
+
 
     # returns a list of waypoints as a dict
     def mavwp_to_wps(self, wplist):
@@ -210,10 +513,20 @@ class DatabaseModule(mp_module.MPModule):
     #
     # ###################
 
-    @_db_connector
-    def handle_waypoints(self, cursor, arg):
+    # Cheap fingerprint of the wp module's loader. MAVWPLoader bumps last_change
+    # on every add/set/remove/clear, so an unchanged key means unchanged waypoints.
+    def _wp_version(self, wploader):
+        return (id(wploader), wploader.last_change, len(wploader.wpoints), wploader.expected_count)
+
+    def handle_waypoints(self, arg=None):
         wploader = self.mpstate.public_modules['wp'].wploader
 
+        version = self._wp_version(wploader)
+        if version == self.wp_version:
+            self.skipped_writes['waypoints'] += 1
+            return
+        self.wp_version = version
+
         # Update if our waypoints are out of date, and the loader is at the expected count.
         if wploader.wpoints != self.wps and len(wploader.wpoints) == wploader.expected_count:
             # If the waypoints change, then the minimum distance to each waypoint calculated before
@@ -232,10 +545,11 @@ class DatabaseModule(mp_module.MPModule):
 
             if not self.mpstate.airapi:
                 self.mpstate.public_modules['mission'].reset_min_dists()
-            cursor.execute(query, data)
+            self.writer.put(query, data, keep=True)
+        else:
+            self.skipped_writes['waypoints'] += 1
 
-    @_db_connector
-    def handle_mode(self, cursor, arg):
+    def handle_mode(self, arg=None):
         if self.mode != self.master.flightmode:
             # mode has changed
             
@@ -244,6 +558,7 @@ class DatabaseModule(mp_module.MPModule):
             if self.master.flightmode.startswith("Mode"):
                 self.master.flightmode = self.num2mode[int(self.master.flightmode[5:-1])]
             self.mode = self.master.flightmode
+            self.snapshot.set('mode', self.mode)
             data = (datetime.now(), self.mode2num[self.mode])
             query = """
                     INSERT INTO
@@ -252,10 +567,11 @@ class DatabaseModule(mp_module.MPModule):
                       (%s, %s);
                     """
             if not self.mpstate.airapi:
-                cursor.execute(query, data)
+                self.writer.put(query, data, keep=True)
+        else:
+            self.skipped_writes['mode'] += 1
 
-    @_db_connector
-    def handle_heartbeat(self, cursor, msg):
+    def handle_heartbeat(self, msg):
         # Note: We're only callling this function after we've received a heartbeat from the plane
         # so there will never be a linkerror when this function is called. The boolean stored is
         # never referenced but is left in to avoid needing to update the database schema
@@ -269,10 +585,9 @@ class DatabaseModule(mp_module.MPModule):
                   (%s, %s);
                 """
         if not self.mpstate.airapi:
-            cursor.execute(query, self.heartbeat)
+            self.writer.put(query, self.heartbeat)
 
-    @_db_connector
-    def handle_global_position_int(self, cursor, msg):
+    def handle_global_position_int(self, msg):
         self.global_position_int = self.GPS_INT(self._get_packet_time(msg),                  # seconds
                                                 float(msg.relative_alt) / 1000,    # meters
                                                 float(msg.alt) / 1000,             # meters
@@ -288,11 +603,12 @@ class DatabaseModule(mp_module.MPModule):
                 VALUES
                   (%s,%s,%s,%s,%s,%s,%s,%s,%s);
                 """
+        self._ring_append('global_position_int', self.global_position_int)
+        self.snapshot.set('gps', self.global_position_int)
         if not self.mpstate.airapi:
-            cursor.execute(query, self.global_position_int)
+            self.writer.put(query, self.global_position_int)
 
-    @_db_connector
-    def handle_vfr_hud(self, cursor, msg):
+    def handle_vfr_hud(self, msg):
         airx, airy = heading_to_vector(msg.heading, msg.airspeed)
         airz = self.global_position_int.groundvz
         self.vfr_hud = self.VFR_HUD(self._get_packet_time(msg),        # seconds
@@ -308,11 +624,12 @@ class DatabaseModule(mp_module.MPModule):
                 VALUES
                   (%s,%s,%s,%s,%s,%s,%s);
                 """
+        self._ring_append('vfr_hud', self.vfr_hud)
+        self.snapshot.set('vfr_hud', self.vfr_hud)
         if not self.mpstate.airapi:
-            cursor.execute(query, self.vfr_hud)
+            self.writer.put(query, self.vfr_hud)
 
-    @_db_connector
-    def handle_flight_time(self, cursor, msg):
+    def handle_flight_time(self, msg):
         # if the throttle is on and it is climbing and this is the first time this has been seen then 
         # this is the start of the flight time
         if(msg.throttle > 2 and msg.climb > 2 and not self.flight_time.is_flying):
@@ -322,6 +639,7 @@ class DatabaseModule(mp_module.MPModule):
             self.flight_time = self.FLIGHT_TIME(self._get_packet_time(msg), self.flight_time.time_start, True)
         else:
             self.flight_time = self.FLIGHT_TIME(self._get_packet_time(msg), self.flight_time.time_start, False)
+        self.snapshot.set('flight_time', self.flight_time)
 
         query = """
                 INSERT INTO
@@ -330,10 +648,9 @@ class DatabaseModule(mp_module.MPModule):
                   (%s, %s, %s);
                 """
         if not self.mpstate.airapi:
-            cursor.execute(query, self.flight_time)
+            self.writer.put(query, self.flight_time)
 
-    @_db_connector
-    def handle_signal(self, cursor, msg):
+    def handle_signal(self, msg):
         self.signal = self.SIGNAL(self._get_packet_time(msg), msg.rssi)
         query = """
                 INSERT INTO signal_status
@@ -342,11 +659,12 @@ class DatabaseModule(mp_module.MPModule):
                   (%s, %s);
                 """
 
+        self._ring_append('signal_status', self.signal)
+        self.snapshot.set('signal', self.signal)
         if not self.mpstate.airapi:
-            cursor.execute(query, self.signal)
+            self.writer.put(query, self.signal)
 
-    @_db_connector
-    def handle_attitude(self, cursor, msg):
+    def handle_attitude(self, msg):
         self.attitude = self.ATTITUDE(self._get_packet_time(msg),         # seconds
                                       msg.roll,                 # rad -pi...+pi
                                       msg.pitch,                # rad -pi...+pi
@@ -361,11 +679,12 @@ class DatabaseModule(mp_module.MPModule):
                 VALUES
                   (%s,%s,%s,%s,%s,%s,%s);
                 """
+        self._ring_append('attitude', self.attitude)
+        self.snapshot.set('attitude', self.attitude)
         if not self.mpstate.airapi:
-            cursor.execute(query, self.attitude)
+            self.writer.put(query, self.attitude)
 
-    @_db_connector
-    def handle_status_text(self, cursor, msg):
+    def handle_status_text(self, msg):
         if '#EP' in msg.text and len(self.wps) > 0:
             lat, lon = msg.text.split('#EP:')[1].split(',')
             self.wps[0].x = float(lat)
@@ -381,6 +700,7 @@ class DatabaseModule(mp_module.MPModule):
             self.mav_warning = self.MAV_WARNING(*data)
         elif msg.severity < 4:
             self.mav_error = self.MAV_ERROR(*data)
+        self._snapshot_status_text()
 
         query = """
                 INSERT INTO mav_message
@@ -389,10 +709,14 @@ class DatabaseModule(mp_module.MPModule):
                   (%s, %s, %s)
                 """
         if not self.mpstate.airapi:
-            cursor.execute(query, data)
+            self.writer.put(query, data)
 
-    @_db_connector
-    def handle_sys_status(self, cursor, msg):
+    def _snapshot_status_text(self):
+        self.snapshot.set('status_text', {'info_text': self.mav_info.text,
+                                          'warning_text': self.mav_warning.text,
+                                          'error_text': self.mav_error.text})
+
+    def handle_sys_status(self, msg):
         self.battery = self.BATTERY(self._get_packet_time(msg),                      # seconds
                                     float(msg.battery_remaining),          # percent
                                     float(msg.voltage_battery) / 1000.0, # Volts
@@ -404,11 +728,12 @@ class DatabaseModule(mp_module.MPModule):
                 VALUES
                   (%s, %s, %s, %s)
                 """
+        self._ring_append('battery', self.battery)
+        self.snapshot.set('battery', self.battery)
         if not self.mpstate.airapi:
-            cursor.execute(query, self.battery)
+            self.writer.put(query, self.battery)
 
-    @_db_connector
-    def handle_wind(self, cursor, msg):
+    def handle_wind(self, msg):
         windx, windy = heading_to_vector(msg.direction, msg.speed)
         self.wind = self.WIND(self._get_packet_time(msg),        # seconds
                               windx,                  # m/s
@@ -422,12 +747,14 @@ class DatabaseModule(mp_module.MPModule):
                   (%s, %s, %s, %s);
                 """
 
+        self._ring_append('wind', self.wind)
+        self.snapshot.set('wind', self.wind)
         if not self.mpstate.airapi:
-            cursor.execute(query, self.wind)
+            self.writer.put(query, self.wind)
 
-    @_db_connector
-    def handle_current_wp(self, cursor, msg):
+    def handle_current_wp(self, msg):
         self.current_waypoint_index = msg.seq
+        self.snapshot.set('current_wp', msg.seq)
 
         data = (self._get_packet_time(msg),  # datetime
                 msg.seq)           # int
@@ -440,10 +767,9 @@ class DatabaseModule(mp_module.MPModule):
                 """
 
         if not self.mpstate.airapi:
-            cursor.execute(query, data)
+            self.writer.put(query, data)
 
-    @_db_connector
-    def handle_gps_status(self, cursor, msg):
+    def handle_gps_status(self, msg):
         self.GPSStatus = self.GPS_STATUS(self._get_packet_time(msg),
                                          msg.satellites_visible)
         query = """
@@ -453,8 +779,10 @@ class DatabaseModule(mp_module.MPModule):
                   (%s, %s);
                 """
 
+        self._ring_append('gps_status', self.GPSStatus)
+        self.snapshot.set('gps_status', self.GPSStatus)
         if not self.mpstate.airapi:
-            cursor.execute(query, self.GPSStatus)
+            self.writer.put(query, self.GPSStatus)
 
 
     def handle_ekf(self, msg):
@@ -477,8 +805,7 @@ class DatabaseModule(mp_module.MPModule):
 
     # @param obstacles: {'stationary_obstaces': {"lat": lat, "lon": lon, "cylinder_radius": cylinder_radius, "cylinder_height": cylinder_height} }
     # @param t: option time in seconds
-    @_db_connector
-    def handle_interop_obstacles(self, cursor, obstacles):
+    def handle_interop_obstacles(self, obstacles):
         if 'stationary_obstacles' not in obstacles:
             logger.error("handle_interop_obstacles: incorrect obstacle format: {}".format(obstacles.keys()))
             return
@@ -493,10 +820,9 @@ class DatabaseModule(mp_module.MPModule):
                 """
 
         if not self.mpstate.airapi:
-            cursor.execute(query, data)
+            self.writer.put(query, data)
 
-    @_db_connector
-    def handle_camera_feedback(self, cursor, msg):
+    def handle_camera_feedback(self, msg):
         data = (msg.time_usec, float(msg.lat) / pow(10, 7), 
                 float(msg.lng) / pow(10, 7), msg.alt_rel,
                 degrees_to_rads(msg.roll),     # Comes from roll_sensor in degrees 0-360, converting to -pi...+pi
@@ -511,7 +837,7 @@ class DatabaseModule(mp_module.MPModule):
                 VALUES
                   (%s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """
-        cursor.execute(query, data)
+        self.writer.put(query, data)
 
     # #############
     #
@@ -520,6 +846,53 @@ class DatabaseModule(mp_module.MPModule):
     #
     #
     # #############
+
+    # Database fallbacks for lookups older than the in-memory rings. In AirAPI mode
+    # there is no database, so these raise ValueError for the views to turn into a 400.
+    # The check is made here, as _db_connector would swallow it.
+    # @param args: (req_time, query) where query takes (time_start, time_end, req_time)
+    def _query_interpolated(self, args):
+        self._check_database()
+        return self._db_query_interpolated(args)
+
+    def _query_nearest(self, args):
+        self._check_database()
+        return self._db_query_nearest(args)
+
+    # @param args: (table, columns, time_start, time_end)
+    # @returns every row in the range, oldest first
+    def _query_range(self, args):
+        self._check_database()
+        return self._db_query_range(args)
+
+    def _check_database(self):
+        if self.mpstate.airapi:
+            raise ValueError("Database query not supported in AirAPI mode")
+
+    @_db_connector
+    def _db_query_interpolated(self, cursor, args):
+        req_time, query = args
+        return self.make_interpolated_query(cursor, req_time, query)
+
+    @_db_connector
+    def _db_query_nearest(self, cursor, args):
+        req_time, query = args
+        cursor.execute(query, (req_time - TIME_VARIANCE, req_time + TIME_VARIANCE, req_time))
+        return cursor.fetchone()
+
+    @_db_connector
+    def _db_query_range(self, cursor, args):
+        table, columns, time_start, time_end = args
+        query = """
+                SELECT
+                  time, {}
+                FROM {}
+                WHERE time > FROM_UNIXTIME(%s) AND time < FROM_UNIXTIME(%s)
+                ORDER BY time
+                """.format(", ".join(columns), table)
+        cursor.execute(query, (time_start, time_end))
+        return cursor.fetchall()
+
     @_db_connector
     def get_camera_feedback(self, cursor, req_time=None):
         if req_time is None:
@@ -550,11 +923,11 @@ class DatabaseModule(mp_module.MPModule):
         return None       
 
 
-    @_db_connector
-    def get_attitude(self, cursor, req_time=None):
+    def get_attitude(self, req_time=None):
         if req_time is None:
             return self.attitude._asdict()
-        elif not self.mpstate.airapi:
+        found, data = self._ring_interpolate('attitude', req_time)
+        if not found:
             query = """
                     SELECT
                       time
@@ -566,19 +939,24 @@ class DatabaseModule(mp_module.MPModule):
                       , yawspeed
                     FROM attitude
                     WHERE time > FROM_UNIXTIME(%s) AND time < FROM_UNIXTIME(%s)
-                    ORDER BY ABS(DATEDIFF(time, FROM_UNIXTIME(%s)))
+                    ORDER BY ABS(TIMESTAMPDIFF(MICROSECOND, time, FROM_UNIXTIME(%s)))
                     """
-            data = self.make_interpolated_query(cursor, req_time, query)
-            if len(data) == 0:
-                logger.debug("get_attitude: no data at time {}".format(req_time))
-                return None
-            try:
-                return self.ATTITUDE(*data)._asdict()
-            except TypeError as e:
-                logger.error("get_attitude:" + str(e) + str(data))
-                return None
-        else:
-            raise ValueError("Database query not supported in AirAPI mode")
+            data = self._query_interpolated((req_time, query))
+        if not data:
+            logger.debug("get_attitude: no data at time {}".format(req_time))
+            return None
+        try:
+            return self.ATTITUDE(*data)._asdict()
+        except TypeError as e:
+            logger.error("get_attitude:" + str(e))
+            return None
+
+    # @param req_times: list of times in seconds
+    # @returns list of dicts of format ATTITUDE (or None where unavailable), one per time
+    def get_attitude_many(self, req_times):
+        columns = ('roll', 'pitch', 'yaw', 'rollspeed', 'pitchspeed', 'yawspeed')
+        return [self.ATTITUDE(*data)._asdict() if data is not None else None
+                for data in self._interpolate_many('attitude', columns, req_times)]
 
     @_db_connector
     def get_param(self, cursor, req_time=None):
@@ -611,31 +989,24 @@ class DatabaseModule(mp_module.MPModule):
 
         return data
 
-    @_db_connector
-    def get_gps_status(self, cursor, req_time=None):
+    def get_gps_status(self, req_time=None):
         if req_time is None:
             return self.GPSStatus._asdict()
-        elif not self.mpstate.airapi:
+        found, closest = self._ring_nearest('gps_status', req_time)
+        if not found:
             query = """
                     SELECT
                         time
                       , satellite_number
                     FROM gps_status
                     WHERE time > FROM_UNIXTIME(%s) and time < FROM_UNIXTIME(%s)
-                    ORDER BY ABS(DATEDIFF(time, FROM_UNIXTIME(%s)))
+                    ORDER BY ABS(TIMESTAMPDIFF(MICROSECOND, time, FROM_UNIXTIME(%s)))
                     """
-            time_start = req_time - TIME_VARIANCE
-            time_end = req_time + TIME_VARIANCE
-            cursor.execute(query, (time_start, time_end, req_time))
-
-            closest = cursor.fetchone()
-            if closest is None:
-                logger.debug("get_gps_status: no data at time {}".format(req_time))
-                return 0
-            else:
-                return self.GPS_STATUS(*closest)._asdict()
-        else:
-            raise ValueError("Database query not supported in AirAPI mode")
+            closest = self._query_nearest((req_time, query))
+        if closest is None:
+            logger.debug("get_gps_status: no data at time {}".format(req_time))
+            return 0
+        return self.GPS_STATUS(*closest)._asdict()
 
     @_db_connector
     def get_flight_time(self, cursor, req_time=None):
@@ -670,11 +1041,11 @@ class DatabaseModule(mp_module.MPModule):
         else:
             raise ValueError("Database query not supported in AirAPI mode")
 
-    @_db_connector
-    def get_gps(self, cursor, req_time=None):
+    def get_gps(self, req_time=None):
         if req_time is None:
             return self.global_position_int._asdict()
-        elif not self.mpstate.airapi:
+        found, data = self._ring_interpolate('global_position_int', req_time)
+        if not found:
             query = """
                     SELECT
                         time
@@ -688,27 +1059,32 @@ class DatabaseModule(mp_module.MPModule):
                       , groundvz
                     FROM global_position_int
                     WHERE time > FROM_UNIXTIME(%s) AND time < FROM_UNIXTIME(%s)
-                    ORDER BY ABS(DATEDIFF(time, FROM_UNIXTIME(%s)))
+                    ORDER BY ABS(TIMESTAMPDIFF(MICROSECOND, time, FROM_UNIXTIME(%s)))
                     """
-            data = self.make_interpolated_query(cursor, req_time, query)
-            if len(data) == 0:
-                logger.debug("get_gps: no data at time {}".format(req_time))
-                return None
-            try:
-                return self.GPS_INT(*data)._asdict()
-            except TypeError as e:
-                logger.error("get_gps: " + str(e))
-                return None
-        else:
-            raise ValueError("Database query not supported in AirAPI mode")
+            data = self._query_interpolated((req_time, query))
+        if not data:
+            logger.debug("get_gps: no data at time {}".format(req_time))
+            return None
+        try:
+            return self.GPS_INT(*data)._asdict()
+        except TypeError as e:
+            logger.error("get_gps: " + str(e))
+            return None
+
+    # @param req_times: list of times in seconds
+    # @returns list of dicts of format GPS_INT (or None where unavailable), one per time
+    def get_gps_many(self, req_times):
+        columns = ('rel_alt', 'asl_alt', 'lat', 'lon', 'heading', 'groundvx', 'groundvy', 'groundvz')
+        return [self.GPS_INT(*data)._asdict() if data is not None else None
+                for data in self._interpolate_many('global_position_int', columns, req_times)]
 
     # @param time: time in seconds
     # @returns dict of format VFR_HUD or None if unavailable
-    @_db_connector
-    def get_vfr_hud(self, cursor, req_time=None):
+    def get_vfr_hud(self, req_time=None):
         if req_time is None:
             return self.vfr_hud._asdict()
-        elif not self.mpstate.airapi:
+        found, data = self._ring_interpolate('vfr_hud', req_time)
+        if not found:
             query = """
                     SELECT
                         time
@@ -720,45 +1096,36 @@ class DatabaseModule(mp_module.MPModule):
                       , throttle
                     FROM vfr_hud
                     WHERE time > FROM_UNIXTIME(%s) AND time < FROM_UNIXTIME(%s)
-                    ORDER BY ABS(DATEDIFF(time, FROM_UNIXTIME(%s)))
+                    ORDER BY ABS(TIMESTAMPDIFF(MICROSECOND, time, FROM_UNIXTIME(%s)))
                     """
-            data = self.make_interpolated_query(cursor, req_time, query)
-
-            if len(data) == 0:
-                logger.debug("get_vfr_hud: no data at time {}".format(req_time))
-                return None
-
-            try:
-                return self.VFR_HUD(*data)._asdict()
-            except TypeError as e:
-                logger.error("get_vfr_hud" + str(e))
-                return None
-        else:
-            raise ValueError("Database query not supported in AirAPI mode")
+            data = self._query_interpolated((req_time, query))
+        if not data:
+            logger.debug("get_vfr_hud: no data at time {}".format(req_time))
+            return None
+        try:
+            return self.VFR_HUD(*data)._asdict()
+        except TypeError as e:
+            logger.error("get_vfr_hud" + str(e))
+            return None
 
-    @_db_connector
-    def get_signal(self, cursor, req_time=None):
+    def get_signal(self, req_time=None):
         if req_time is None:
             return self.signal._asdict()
-        elif not self.mpstate.airapi:
+        found, closest = self._ring_nearest('signal_status', req_time)
+        if not found:
             query = """
                     SELECT
                         time
                       , signal_strength
                     FROM signal_status
                     WHERE time > FROM_UNIXTIME(%s) and time < FROM_UNIXTIME(%s)
-                    ORDER BY ABS(DATEDIFF(time, FROM_UNIXTIME(%s)))
+                    ORDER BY ABS(TIMESTAMPDIFF(MICROSECOND, time, FROM_UNIXTIME(%s)))
                     """
-            cursor.execute(query, (req_time - TIME_VARIANCE, req_time + TIME_VARIANCE, req_time))
-
-            closest = cursor.fetchone()
-            if closest is None:
-                logger.debug("get_signal : no data at time {}".format(req_time))
-                return None
-            else:
-                return self.SIGNAL(*closest)._asdict()
-        else:
-            raise ValueError("Database query not supported in AirAPI mode")
+            closest = self._query_nearest((req_time, query))
+        if closest is None:
+            logger.debug("get_signal: no data at time {}".format(req_time))
+            return None
+        return self.SIGNAL(*closest)._asdict()
 
     @_db_connector
     def get_status_text(self, cursor, req_time=None):
@@ -787,11 +1154,11 @@ class DatabaseModule(mp_module.MPModule):
         else:
             raise ValueError("Database query not supported in AirAPI mode")
 
-    @_db_connector
-    def get_sys_status(self, cursor, req_time=None):
+    def get_sys_status(self, req_time=None):
         if req_time is None:
             return self.battery._asdict()
-        elif not self.mpstate.airapi:
+        found, data = self._ring_interpolate('battery', req_time)
+        if not found:
             query = """
                     SELECT
                         time
@@ -800,27 +1167,23 @@ class DatabaseModule(mp_module.MPModule):
                       , batterycurrent  # current
                     FROM battery
                     WHERE time > FROM_UNIXTIME(%s) AND time < FROM_UNIXTIME(%s)
-                    ORDER BY ABS(DATEDIFF(time, FROM_UNIXTIME(%s)))
+                    ORDER BY ABS(TIMESTAMPDIFF(MICROSECOND, time, FROM_UNIXTIME(%s)))
                     """
-            data = self.make_interpolated_query(cursor, req_time, query)
-
-            if len(data) == 0:
-                logger.debug("get_sys_status: no data at time {}".format(req_time))
-                return None
-
-            try:
-                return self.BATTERY(*data)._asdict()
-            except TypeError as e:
-                logger.error("get_sys_status" + str(e))
-                return None
-        else:
-            raise ValueError("Database query not supported in AirAPI mode")
+            data = self._query_interpolated((req_time, query))
+        if not data:
+            logger.debug("get_sys_status: no data at time {}".format(req_time))
+            return None
+        try:
+            return self.BATTERY(*data)._asdict()
+        except TypeError as e:
+            logger.error("get_sys_status" + str(e))
+            return None
 
-    @_db_connector
-    def get_wind(self, cursor, req_time=None):
+    def get_wind(self, req_time=None):
         if req_time is None:
             return self.wind._asdict()
-        elif not self.mpstate.airapi:
+        found, data = self._ring_interpolate('wind', req_time)
+        if not found:
             query = """
                     SELECT
                         time
@@ -829,16 +1192,12 @@ class DatabaseModule(mp_module.MPModule):
                       , windz
                     FROM wind
                     WHERE time > FROM_UNIXTIME(%s) AND time < FROM_UNIXTIME(%s)
-                    ORDER BY ABS(DATEDIFF(time, FROM_UNIXTIME(%s)))
+                    ORDER BY ABS(TIMESTAMPDIFF(MICROSECOND, time, FROM_UNIXTIME(%s)))
                     """
-            data = self.make_interpolated_query(cursor, req_time, query)
-
-            if len(data) == 0:
-                logger.debug("get_wind: no data at time {}".format(req_time))
-                return None
-        else:
-            raise ValueError("Database query not supported in AirAPI mode")
-
+            data = self._query_interpolated((req_time, query))
+        if not data:
+            logger.debug("get_wind: no data at time {}".format(req_time))
+            return None
         try:
             return self.WIND(*data)._asdict()
         except TypeError as e:
@@ -980,6 +1339,8 @@ class DatabaseModule(mp_module.MPModule):
                 self.handle_param(msg)
             elif msgt == 'HEARTBEAT':
                 self.handle_heartbeat(msg)
+                # master.flightmode is only ever updated from a HEARTBEAT
+                self.handle_mode(None)
             elif msgt == 'GLOBAL_POSITION_INT':
                 self.handle_global_position_int(msg)
             elif msgt == 'ATTITUDE':
@@ -1013,13 +1374,17 @@ class DatabaseModule(mp_module.MPModule):
                 self.handle_camera_feedback(msg)
                 
             self.handle_waypoints(None)
-            self.handle_mode(None)
 
         except Exception as e:
             exc_type, _, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
             logger.error("mavlink_packet: " + str(e) + str(exc_type) + str(fname) + str(exc_tb.tb_lineno))
 
+    def unload(self):
+        self.mpstate.status.counters.pop('DBWrite', None)
+        self.mpstate.status.counters.pop('DBSkipped', None)
+        self.writer.stop()
+
 
 instance = None
 def get_db_mod():
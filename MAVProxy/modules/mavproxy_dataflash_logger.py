@@ -35,6 +35,7 @@ class dataflash_logger(mp_module.MPModule):
             "dataflash_logger",
             "logging of mavlink dataflash messages"
         )
+        self.idle_rate = 10
         self.sender = None
         self.stopped = False
         self.time_last_start_packet_sent = 0
@@ -381,6 +382,8 @@ class dataflash_logger(mp_module.MPModule):
                     if self.last_seqno < m.seqno:
                         self.last_seqno = m.seqno
                 self.download += size
+                # send the acks and nacks promptly
+                self.wake_idle()
 
 
 def init(mpstate):
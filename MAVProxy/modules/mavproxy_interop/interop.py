@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 import requests
-# import thread
+from requests.adapters import HTTPAdapter
 import threading
 import time
 import os
 import json
+import hashlib
 from modules.mavproxy_interop import interop_api_pb2
 from google.protobuf import json_format
 
@@ -22,6 +23,17 @@ MOVING_AVERAGE_SIZE = 30
 POST_ATTEMPT_MAX = 1
 POST_TIMEOUT_SECONDS = 2
 GET_UPDATE_RATE = .1
+# While the mission is unchanged the time between GETs grows by this factor,
+# up to GET_MAX_INTERVAL seconds. Any change goes back to GET_UPDATE_RATE
+GET_BACKOFF_FACTOR = 1.5
+GET_MAX_INTERVAL = 2.0
+# Default rate to POST telemetry at. Newer positions replace unsent ones, so a
+# slow server gets fewer, fresher posts rather than a growing backlog.
+TELEMETRY_POST_HZ = 10
+# Number of telemetry POSTs allowed to be waiting on the server at once
+MAX_IN_FLIGHT = 1
+# Upper edges of the POST latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [25, 50, 100, 250, 500, 1000, 2000]
 
 # CUAir is using custom logging rather than printing this year
 # If it doesn't find the CUAir logger it'll just use a generic one
@@ -38,15 +50,132 @@ except:
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
+class TelemetrySender(object):
+    '''
+    Posts telemetry from a fixed set of worker threads at a target rate.
+    submit() only stores the newest telemetry in a single slot, so the
+    mavlink thread never waits and stale positions are never sent.
+    '''
+    def __init__(self, post_function, rate_hz=TELEMETRY_POST_HZ, max_in_flight=MAX_IN_FLIGHT):
+        # post_function(telemetry_data) -> True on success
+        self.post_function = post_function
+        self.rate_hz = rate_hz
+        self.cond = threading.Condition()
+        self.latest = None
+        self.running = True
+        self.next_send = 0
+        self.in_flight = 0
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latencies = deque(maxlen=MOVING_AVERAGE_SIZE)
+        self.success_times = deque(maxlen=MOVING_AVERAGE_SIZE + 1)
+
+        self.workers = []
+        for i in range(max_in_flight):
+            t = threading.Thread(target=self.worker_loop, name="interop_telemetry%u" % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, telemetry_data):
+        with self.cond:
+            if self.latest is not None:
+                self.coalesced += 1
+            self.latest = telemetry_data
+            self.submitted += 1
+            self.cond.notify()
+
+    def set_rate(self, rate_hz):
+        with self.cond:
+            self.rate_hz = rate_hz
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def _next(self):
+        # Wait until there is telemetry and the rate allows a send, then claim it
+        with self.cond:
+            while self.running:
+                now = time.time()
+                if self.latest is not None and now >= self.next_send:
+                    telemetry_data = self.latest
+                    self.latest = None
+                    if self.rate_hz > 0:
+                        self.next_send = max(self.next_send + 1.0 / self.rate_hz, now)
+                    self.in_flight += 1
+                    return telemetry_data
+                if self.latest is None:
+                    self.cond.wait()
+                else:
+                    self.cond.wait(self.next_send - now)
+        return None
+
+    def worker_loop(self):
+        while True:
+            telemetry_data = self._next()
+            if telemetry_data is None:
+                return
+            start = time.time()
+            ok = self.post_function(telemetry_data)
+            end = time.time()
+            with self.cond:
+                self.in_flight -= 1
+                if ok:
+                    self.record_success(start, end)
+                else:
+                    self.failed += 1
+
+    def record_success(self, start, end):
+        # must be called with self.cond held
+        latency_ms = (end - start) * 1000
+        self.sent += 1
+        self.latencies.append(latency_ms)
+        self.success_times.append(end)
+        for i, edge in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= edge:
+                self.latency_counts[i] += 1
+                break
+        else:
+            self.latency_counts[-1] += 1
+
+    def rolling_frequency(self):
+        with self.cond:
+            if len(self.success_times) < 2:
+                return -1
+            return (len(self.success_times) - 1) / (self.success_times[-1] - self.success_times[0])
+
+    def histogram(self):
+        '''list of (label, count) for each latency bucket'''
+        labels = ["<=%ums" % edge for edge in LATENCY_BUCKETS_MS] + [">%ums" % LATENCY_BUCKETS_MS[-1]]
+        with self.cond:
+            return list(zip(labels, self.latency_counts))
+
+    def percentile(self, pct):
+        with self.cond:
+            if not self.latencies:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
 print("interop1")
 class Interop(mp_module.MPModule):
     def __init__(self, mpstate):
         super(Interop, self).__init__(mpstate, "interop", "AUVSI interoperability module")
+        self.mavlink_types = ['GLOBAL_POSITION_INT']
         self.add_command('interop_obst', self._print_obstacles, "show interop obstacle data")
         self.add_command('interop_start', self.start, "start sending and receiving interop data")
         self.add_command('interop_stop', self.stop, "stop sending and receiving interop data")
-        self.add_command('interop_hz', self._print_post_hz, "show interop post frequency moving average")
+        self.add_command('interop_hz', self._print_post_hz, "show interop post frequency and latency, or set the target rate")
         self.add_command('interop_wp', self._print_waypoint_min_dists, "show minimum distance from each waypoint")
+        self.add_command('interop_poll', self._print_poll_stats, "show mission polling statistics")
         self.add_command('interop', self._print_help, "shows a help message for using the interop command line")
 
         self.is_active = False
@@ -58,9 +187,9 @@ class Interop(mp_module.MPModule):
         self.login_response = None
         self.interop_url = None
 
-        self.last_post_time = 0
-        # Queue to be used for a rolling average of frequency
-        self.post_hz_list = []
+        # Sends telemetry while interop is active, see TelemetrySender
+        self.sender = None
+        self.post_rate_hz = TELEMETRY_POST_HZ
 
         self.mission_waypoints = []
 
@@ -69,30 +198,58 @@ class Interop(mp_module.MPModule):
 
         self.mission = None
         self.mission_id = 1
+        # Validators from the last full mission response, used to skip
+        # re-parsing a mission that hasn't changed
+        self.mission_etag = None
+        self.mission_last_modified = None
+        self.mission_digest = None
+        self.mission_size = 0
+        self.poll_interval = GET_UPDATE_RATE
+        self.poll_start = None
+        self.poll_stats = {'requests': 0, 'not_modified': 0, 'unchanged': 0, 'changed': 0,
+                           'bytes': 0, 'bytes_saved': 0,
+                           'obstacle_updates': 0, 'obstacle_updates_skipped': 0}
         # List of closest points of approach to each waypoint, in feet
         self.min_wp_dists = []
 
         # list of functions to run on new obstacles
         self.binders = []
 
+    # Returns True if the mission changed since the last GET
     def get_active_mission_from_server(self):
-        mission = self.session.get(self.interop_url + "/api/missions/" + str(self.mission_id), cookies=self.login_response.cookies)
-        mission = json.loads(mission.text)
-
-        # Check for active mission - if found, update the instance variable
-        # If not, set the instance variable to None
-        # Done this way to ensure there is no moment at which the self.active_missions variable
-        # is in an incorrect state when it doesn't have to be
-        self.mission = mission
-            # Ensure that the mission waypoints always match the ones given by the server
-            # If we lose the active mission, we keep the old mission waypoints
+        headers = {}
+        if self.mission_etag:
+            headers['If-None-Match'] = self.mission_etag
+        if self.mission_last_modified:
+            headers['If-Modified-Since'] = self.mission_last_modified
+        response = self.session.get(self.interop_url + "/api/missions/" + str(self.mission_id),
+                                    cookies=self.login_response.cookies, headers=headers)
+        self.poll_stats['requests'] += 1
+        if response.status_code == 304:
+            self.poll_stats['not_modified'] += 1
+            self.poll_stats['bytes_saved'] += self.mission_size
+            return False
+        response.raise_for_status()
+
+        body = response.content
+        self.poll_stats['bytes'] += len(body)
+        self.mission_etag = response.headers.get('ETag')
+        self.mission_last_modified = response.headers.get('Last-Modified')
+        # Servers that don't send validators still send the same bytes for
+        # the same mission
+        digest = hashlib.sha1(body).hexdigest()
+        if digest == self.mission_digest:
+            self.poll_stats['unchanged'] += 1
+            return False
+
+        # Ensure that the mission waypoints always match the ones given by the server
+        self.mission = json.loads(response.text)
         self.setup_waypoints()
         self.setup_obstacles()
-        # break
-        # else: # Only runs if the loop exited normally, not through 'break'
-        #     if self.active_mission:
-        #         logger.error("No active mission exists")
-        #     self.active_mission = None
+        self.mission_digest = digest
+        self.mission_size = len(body)
+        self.poll_stats['changed'] += 1
+        return True
 
     def setup_obstacles(self):
         metric_obstacles = {"stationary_obstacles" : []}
@@ -102,7 +259,12 @@ class Interop(mp_module.MPModule):
                                 "longitude": obst["longitude"],
                                 "height": feet_to_meters(obst["height"]),
                                 "radius": feet_to_meters(obst["radius"])})
+        if metric_obstacles == self.obstacles:
+            # Something else in the mission changed, binders have these already
+            self.poll_stats['obstacle_updates_skipped'] += 1
+            return
         self.obstacles = metric_obstacles
+        self.poll_stats['obstacle_updates'] += 1
         for f in self.binders:
             try:
                 f(self.obstacles)
@@ -110,14 +272,16 @@ class Interop(mp_module.MPModule):
                 logger.error("get_interop_data Error from: " + str(f) + " Message: " + str(e))
 
     def get_main_loop(self):
-        start = time.time()
+        self.poll_interval = GET_UPDATE_RATE
+        next_get = time.time()
         while(self.is_active):
             # Sleep until it's time to get data again, or just continue if it's
             # already time
-            time.sleep(max(GET_UPDATE_RATE - (time.time() - start),0))
+            time.sleep(max(next_get - time.time(), 0))
 
+            changed = False
             try:
-                self.get_active_mission_from_server()
+                changed = self.get_active_mission_from_server()
                 if not self.get_working:
                     logger.info("GET working again")
                     self.get_working = True
@@ -126,9 +290,16 @@ class Interop(mp_module.MPModule):
                     self.get_working = False
                     logger.error("EXCEPTION while 'GETing': " + str(ex))
 
-            start += GET_UPDATE_RATE
+            # Poll less often while the mission stays the same
+            if changed:
+                self.poll_interval = GET_UPDATE_RATE
+            else:
+                self.poll_interval = min(self.poll_interval * GET_BACKOFF_FACTOR, GET_MAX_INTERVAL)
+            next_get = max(next_get + self.poll_interval, time.time())
 
+    # Called from the TelemetrySender worker threads
     def send_telemetry_post_request(self, telemetry_data):
+        e = None
         for _ in range(POST_ATTEMPT_MAX):
             try:
                 
@@ -139,23 +310,15 @@ class Interop(mp_module.MPModule):
                                                     timeout=POST_TIMEOUT_SECONDS)
                 telem_response.raise_for_status()
                 self.update_wp_dists(telemetry_data)
-                if self.last_post_time:
-                    self.post_hz_list.append(time.time() - self.last_post_time)
-
-                # List must be at max the proper size, so we take an item
-                # off the beginning of a queue to maintain the rolling average
-                if len(self.post_hz_list) > MOVING_AVERAGE_SIZE:
-                    self.post_hz_list = self.post_hz_list[1:]
 
                 if self.consecutive_post_failures > 0:
                     self.consecutive_post_failures = 0
                     logger.info("POST working again")
-                self.last_post_time = time.time()
 
                 return True
-            except Exception as e:
+            except Exception as ex:
                 # Move on, try again if the loop hasn't finished yet
-                pass
+                e = ex
 
         if self.consecutive_post_failures == 0:
             logger.error("BAD RESPONSE TO SENT TELEMETRY DATA: " + str(e))
@@ -165,10 +328,12 @@ class Interop(mp_module.MPModule):
             logger.error("-------------------------------------------------------")
             logger.error("ERROR INTEROP MODULE IS FAILING TO POST TELEMETRY DATA")
             logger.error("-------------------------------------------------------")
+        return False
 
     # Sets up the waypoint objects to be used for alert when each waypoint has been reached
     def setup_waypoints(self):
         if self.using_file:
+            self.mission_waypoints = []
             filepath = os.path.split(os.path.realpath(__file__))[0]
             with open(filepath + "/waypoints.json", "r") as waypoint_file:
                 json_string = waypoint_file.read()
@@ -225,7 +390,7 @@ class Interop(mp_module.MPModule):
                                 'altitude': meters_to_feet(millimeters_to_meters(m.alt)),
                                 'heading': centidegrees_to_degrees(m.hdg),
                               }
-            thread.start_new_thread(self.send_telemetry_post_request,(telemetry_data,))
+            self.sender.submit(telemetry_data)
 
 
     ##################
@@ -244,7 +409,7 @@ class Interop(mp_module.MPModule):
         return self.min_wp_dists
 
     def get_rolling_frequency(self):
-        return len(self.post_hz_list) / sum(self.post_hz_list) if self.post_hz_list else -1
+        return self.sender.rolling_frequency() if self.sender else -1
 
     def is_working(self):
         return self.get_working or self.consecutive_post_failures > 0
@@ -295,16 +460,25 @@ class Interop(mp_module.MPModule):
             payload = json_format.MessageToJson(creds)
             self.login_response = requests.post(self.interop_url + "/api/login", data=payload, timeout=5)
             self.session = requests.Session()
+            # keep connections to the server alive between posts
+            self.session.mount(self.interop_url, HTTPAdapter(pool_connections=1, pool_maxsize=MAX_IN_FLIGHT + 1))
             # Get the missions
+            self.poll_start = time.time()
+            self.mission_etag = None
+            self.mission_last_modified = None
+            self.mission_digest = None
             self.get_active_mission_from_server()
         except Exception as e:
             logger.error(e)
             return False
 
+        self.sender = TelemetrySender(self.send_telemetry_post_request, self.post_rate_hz)
         logger.info("Interop server started")
         self.is_active = True
 
-        thread.start_new_thread(self.get_main_loop,())
+        get_thread = threading.Thread(target=self.get_main_loop, name="interop_get")
+        get_thread.daemon = True
+        get_thread.start()
 
         return True
 
@@ -314,7 +488,7 @@ class Interop(mp_module.MPModule):
             self.is_active = False
             self.consecutive_post_failures = 0
             self.get_working = True
-            self.post_hz_list = []
+            self.sender.stop()
         else:
             logger.error("Interop not active")
 
@@ -331,10 +505,24 @@ class Interop(mp_module.MPModule):
             logger.info("No obstacle data")
 
     def _print_post_hz(self, args):
-        if self.post_hz_list:
-            logger.info("Rolling POST frequency: " + str((len(self.post_hz_list) / sum(self.post_hz_list))) + " hz")
-        else:
+        if args:
+            try:
+                self.post_rate_hz = float(args[0])
+            except ValueError:
+                logger.error("usage: interop_hz [target_rate_hz]")
+                return
+            if self.sender:
+                self.sender.set_rate(self.post_rate_hz)
+            logger.info("Target POST rate set to " + str(self.post_rate_hz) + " hz")
+            return
+        if not self.sender or self.sender.rolling_frequency() < 0:
             logger.info("No data")
+            return
+        sender = self.sender
+        logger.info("Rolling POST frequency: " + str(sender.rolling_frequency()) + " hz (target " + str(sender.rate_hz) + " hz)")
+        logger.info("Sent: %u  Failed: %u  Coalesced: %u  In flight: %u" % (sender.sent, sender.failed, sender.coalesced, sender.in_flight))
+        logger.info("Latency p50: %.0fms  p95: %.0fms" % (sender.percentile(50), sender.percentile(95)))
+        logger.info("Latency histogram: " + "  ".join("%s: %u" % bucket for bucket in sender.histogram()))
 
     def _print_waypoint_min_dists(self, args):
         if self.min_wp_dists:
@@ -346,8 +534,24 @@ class Interop(mp_module.MPModule):
         else:
             logger.info("No waypoints")
 
+    def _print_poll_stats(self, args):
+        stats = self.poll_stats
+        if not self.poll_start:
+            logger.info("No data")
+            return
+        # GETs that would have been made polling at GET_UPDATE_RATE the whole time
+        requests_saved = max(int((time.time() - self.poll_start) / GET_UPDATE_RATE) - stats['requests'], 0)
+        logger.info("Mission GETs: %u  Changed: %u  Unchanged: %u  Not modified: %u" % (
+            stats['requests'], stats['changed'], stats['unchanged'], stats['not_modified']))
+        logger.info("Poll interval: %.2fs  Requests saved by backoff: %u" % (self.poll_interval, requests_saved))
+        logger.info("Bytes received: %u  Bytes saved by 304s: %u" % (stats['bytes'], stats['bytes_saved']))
+        logger.info("Obstacle updates: %u  Skipped: %u" % (stats['obstacle_updates'], stats['obstacle_updates_skipped']))
+
+    def get_poll_stats(self):
+        return dict(self.poll_stats, poll_interval=self.poll_interval)
+
     def _print_help(self, args):
-        logger.info('usage: ["interop_start | interop_stop | interop_hz | interop_wp | interop"]')
+        logger.info('usage: ["interop_start | interop_stop | interop_hz [target_rate_hz] | interop_wp | interop_poll | interop"]')
 
     def unload(self):
         if self.is_active:
@@ -37,6 +37,7 @@ class LinkModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(LinkModule, self).__init__(mpstate, "link", "link control", public=True, multi_vehicle=True)
+        self.mavlink_types = ['HEARTBEAT']
         self.add_command('link', self.cmd_link, "link control",
                          ["<list|ports>",
                           'add (SERIALPORT)',
@@ -239,6 +240,7 @@ class LinkModule(mp_module.MPModule):
         conn.target_system = self.settings.target_system
         self.apply_link_attributes(conn, optional_attributes)
         self.mpstate.mav_master.append(conn)
+        self.mpstate.links_changed()
         self.status.counters['MasterIn'].append(0)
         self.status.bytecounters['MasterIn'].append(self.status.ByteCounter())
         try:
@@ -306,6 +308,7 @@ class LinkModule(mp_module.MPModule):
             print(msg)
             pass
         self.mpstate.mav_master.pop(i)
+        self.mpstate.links_changed()
         self.status.counters['MasterIn'].pop(i)
         self.status.bytecounters['MasterIn'].pop(i)
         # renumber the links
@@ -661,8 +664,9 @@ class LinkModule(mp_module.MPModule):
         # see if it is handled by a specialised sysid connection
         sysid = m.get_srcSystem()
         mtype = m.get_type()
+        msgbuf = m.get_msgbuf()
         if sysid in self.mpstate.sysid_outputs:
-            self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+            self.mpstate.sysid_outputs[sysid].write(msgbuf)
             if mtype == "GLOBAL_POSITION_INT":
                 for modname in 'map', 'asterix', 'NMEA', 'NMEA2':
                     mod = self.module(modname)
@@ -677,12 +681,12 @@ class LinkModule(mp_module.MPModule):
         if mtype == 'GLOBAL_POSITION_INT':
             # send GLOBAL_POSITION_INT to 2nd GCS for 2nd vehicle display
             for sysid in self.mpstate.sysid_outputs:
-                self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+                self.mpstate.sysid_outputs[sysid].write(msgbuf)
 
             if self.mpstate.settings.fwdpos:
                 for link in self.mpstate.mav_master:
                     if link != master:
-                        link.write(m.get_msgbuf())
+                        link.write(msgbuf)
 
         # and log them
         if mtype not in dataPackets and self.mpstate.logqueue:
@@ -690,7 +694,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + msgbuf))
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -737,22 +741,23 @@ class LinkModule(mp_module.MPModule):
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if mtype not in self.no_fwd_types:
-                    for r in self.mpstate.mav_outputs:
-                        r.write(m.get_msgbuf())
+                    self.mpstate.forward_to_outputs(msgbuf)
 
             sysid = m.get_srcSystem()
             target_sysid = self.target_system
 
-            # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            # pass to modules that want this message type
+            modtiming = self.mpstate.settings.modtiming
+            for mod in self.mpstate.mavlink_route(mtype):
                 if not mod.multi_vehicle and sysid != target_sysid:
                     # only pass packets not from our target to modules that
                     # have marked themselves as being multi-vehicle capable
                     continue
                 try:
-                    mod.mavlink_packet(m)
+                    if modtiming:
+                        self.timed_mavlink_packet(mod, m)
+                    else:
+                        mod.mavlink_packet(m)
                 except Exception as msg:
                     if self.mpstate.settings.moddebug == 1:
                         print(msg)
@@ -761,6 +766,16 @@ class LinkModule(mp_module.MPModule):
                         traceback.print_exception(exc_type, exc_value, exc_traceback,
                                                   limit=2, file=sys.stdout)
 
+    def timed_mavlink_packet(self, mod, m):
+        '''pass m to a module, adding the time taken to mpstate.module_timing'''
+        t0 = time.time()
+        try:
+            mod.mavlink_packet(m)
+        finally:
+            timing = self.mpstate.module_timing.setdefault(mod.name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += time.time() - t0
+
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
         if len(args) < 1:
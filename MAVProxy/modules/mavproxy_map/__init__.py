@@ -28,6 +28,9 @@ class MapModule(mp_module.MPModule):
         self.rally_change_time = 0
         self.have_simstate = False
         self.have_vehicle = {}
+        # downloads tiles for "map seed", created on first use
+        self.seeder = None
+        self.seeding = False
         self.move_wp = -1
         self.moving_wp = None
         self.moving_fencepoint = None
@@ -76,7 +79,8 @@ class MapModule(mp_module.MPModule):
                                                                 'zoom',
                                                                 'center',
                                                                 'follow',
-                                                                'clear'])
+                                                                'clear',
+                                                                'seed'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
         self.default_popup = MPMenuSubMenu('Popup', items=[])
@@ -208,6 +212,8 @@ class MapModule(mp_module.MPModule):
             self.cmd_follow(args)
         elif args[0] == "clear":
             self.cmd_clear(args)
+        elif args[0] == "seed":
+            self.cmd_seed(args)
         else:
             print("usage: map <icon|set>")
 
@@ -529,6 +535,9 @@ class MapModule(mp_module.MPModule):
             self.last_unload_check_time = now
             if not self.map.is_alive():
                 self.needs_unloading = True
+            if self.seeding and self.seeder.tiles_pending() == 0:
+                self.seeding = False
+                print("Map seed done, %u tiles in archive" % len(self.seeder.archive(writable=True)))
 
     def create_vehicle_icon(self, name, colour, follow=False, vehicle_type=None):
         '''add a vehicle to the map'''
@@ -655,6 +664,34 @@ class MapModule(mp_module.MPModule):
         self.map.add_object(mp_slipmap.SlipClearLayer(3))
         self.have_vehicle = {}
 
+    def cmd_seed(self, args):
+        '''download the map tiles of an area into the tile archive'''
+        if len(args) == 1:
+            if self.seeder is None:
+                print("No map seeding started")
+            else:
+                archive = self.seeder.archive(writable=True)
+                print("Map seed: %u tiles left, %u in archive" % (self.seeder.tiles_pending(), len(archive)))
+            return
+        if len(args) < 6:
+            print("usage: map seed <lat1> <lon1> <lat2> <lon2> <zoom_min> [zoom_max]")
+            return
+        from modules.mavproxy_map import mp_tile
+        (lat1, lon1, lat2, lon2) = [float(a) for a in args[1:5]]
+        zoom_min = int(args[5])
+        zoom_max = zoom_min
+        if len(args) > 6:
+            zoom_max = int(args[6])
+        if self.seeder is None:
+            self.seeder = mp_tile.MPTile(service=self.map.service)
+        try:
+            queued = self.seeder.seed(lat1, lon1, lat2, lon2, range(zoom_min, zoom_max+1))
+        except mp_tile.TileException as e:
+            print("Map seed failed: %s" % str(e))
+            return
+        print("Map seed: downloading %u tiles" % queued)
+        self.seeding = queued > 0
+
     def set_secondary_vehicle_position(self, m):
         '''show 2nd vehicle on map'''
         if m.get_type() != 'GLOBAL_POSITION_INT':
@@ -8,22 +8,45 @@ Created by Stephen Dade (stephen_dade@hotmail.com)
 import os
 import sys
 import time
+import math
+import threading
+from collections import OrderedDict
 
 import numpy
 
 from modules.mavproxy_map import srtm
 
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+# number of tiles kept open, least recently used tiles are closed first
+TILE_CACHE_SIZE = 16
+# how far ahead along the track Prefetch() looks, in seconds
+PREFETCH_LOOKAHEAD = 300
+# spacing in degrees of the points along the track that Prefetch() checks
+PREFETCH_STEP = 0.25
+
 class ElevationModel():
     '''Elevation Model. Only SRTM for now'''
 
-    def __init__(self, database='srtm', offline=0, debug=False):
+    def __init__(self, database='srtm', offline=0, debug=False, max_tiles=TILE_CACHE_SIZE):
         '''Use offline=1 to disable any downloading of tiles, regardless of whether the
         tile exists'''
         self.database = database
         if self.database == 'srtm':
             self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug)
             self.downloader.loadFileList()
-            self.tileDict = dict()
+            # TileID -> tile, in least to most recently used order
+            self.tileDict = OrderedDict()
+            self.max_tiles = max_tiles
+            self.tile_lock = threading.Lock()
+            # SRTMDownloader isn't thread safe, and the prefetch thread
+            # uses it too
+            self.download_lock = threading.Lock()
+            self.prefetch_queue = None
+            self.prefetch_pending = set()
 
         '''Use the Geoscience Australia database instead - watch for the correct database path'''
         if self.database == 'geoscience':
@@ -31,31 +54,126 @@ class ElevationModel():
             self.mappy = GAreader.ERMap()
             self.mappy.read_ermapper(os.path.join(os.environ['HOME'], './Documents/Elevation/Canberra/GSNSW_P756demg'))
 
+    def getCachedTile(self, TileID):
+        with self.tile_lock:
+            tile = self.tileDict.get(TileID)
+            if tile is not None and next(reversed(self.tileDict)) != TileID:
+                # mark as most recently used
+                del self.tileDict[TileID]
+                self.tileDict[TileID] = tile
+            return tile
+
+    def cacheTile(self, TileID, tile):
+        with self.tile_lock:
+            self.tileDict.pop(TileID, None)
+            self.tileDict[TileID] = tile
+            while len(self.tileDict) > self.max_tiles:
+                self.tileDict.popitem(last=False)
+
+    def downloadTile(self, TileID):
+        '''the tile from the downloader, 0 if it isn't available yet'''
+        with self.download_lock:
+            return self.downloader.getTile(TileID[0], TileID[1])
+
+    def loadTile(self, TileID, timeout=0):
+        '''the tile for TileID from the cache or the downloader, waiting up to
+        timeout seconds for a download. None if it isn't available'''
+        tile = self.getCachedTile(TileID)
+        if tile is not None:
+            return tile
+        tile = self.downloadTile(TileID)
+        if tile == 0:
+            if timeout > 0:
+                t0 = time.time()
+                while time.time() < t0+timeout and tile == 0:
+                    tile = self.downloadTile(TileID)
+                    if tile == 0:
+                        time.sleep(0.1)
+        if tile == 0:
+            return None
+        self.cacheTile(TileID, tile)
+        return tile
+
     def GetElevation(self, latitude, longitude, timeout=0):
         '''Returns the altitude (m ASL) of a given lat/long pair, or None if unknown'''
         if latitude is None or longitude is None:
             return None
         if self.database == 'srtm':
             TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            tile = self.loadTile(TileID, timeout)
+            if tile is None:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         if self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         return alt
 
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns an array of the altitudes (m ASL) of arrays of lat/long pairs,
+        with NaN where unknown. Points are grouped by tile and each tile
+        interpolates all of its points at once'''
+        lats = numpy.asarray(latitudes, dtype=float)
+        lons = numpy.asarray(longitudes, dtype=float)
+        alts = numpy.full(lats.shape, numpy.nan)
+        if self.database != 'srtm':
+            for i in range(lats.size):
+                alt = self.GetElevation(lats.flat[i], lons.flat[i], timeout)
+                if alt is not None:
+                    alts.flat[i] = alt
+            return alts
+        tile_lats = numpy.floor(lats)
+        tile_lons = numpy.floor(lons)
+        # one number per tile, to group the points with numpy.unique
+        tile_keys = (tile_lats + 90) * 360 + (tile_lons + 180)
+        for key in numpy.unique(tile_keys[~numpy.isnan(tile_keys)]):
+            points = tile_keys == key
+            i = numpy.flatnonzero(points)[0]
+            tile = self.loadTile((tile_lats.flat[i], tile_lons.flat[i]), timeout)
+            if tile is not None:
+                alts[points] = tile.getAltitudeArray(lats[points], lons[points])
+        return alts
+
+    def Prefetch(self, latitude, longitude, north=0, east=0, lookahead=PREFETCH_LOOKAHEAD):
+        '''Load the tiles under the track ahead of a vehicle at latitude, longitude
+        moving at north, east m/s in a background thread, so GetElevation
+        doesn't stall when the vehicle reaches them'''
+        if self.database != 'srtm' or latitude is None or longitude is None:
+            return
+        dlat = north * lookahead / 111319.5
+        dlon = east * lookahead / (111319.5 * max(math.cos(math.radians(latitude)), 0.01))
+        steps = int(max(abs(dlat), abs(dlon)) / PREFETCH_STEP) + 1
+        for i in range(steps + 1):
+            lat = latitude + dlat * i / steps
+            lon = longitude + dlon * i / steps
+            if lat < -90 or lat >= 90:
+                break
+            lon = (lon + 180) % 360 - 180
+            TileID = (numpy.floor(lat), numpy.floor(lon))
+            with self.tile_lock:
+                if TileID in self.tileDict or TileID in self.prefetch_pending:
+                    continue
+                self.prefetch_pending.add(TileID)
+            if self.prefetch_queue is None:
+                self.prefetch_queue = Queue.Queue()
+                t = threading.Thread(target=self.prefetch_thread, name='srtm_prefetch')
+                t.daemon = True
+                t.start()
+            self.prefetch_queue.put(TileID)
+
+    def prefetch_thread(self):
+        '''load queued tiles. Tiles still downloading are dropped from the
+        queue and picked up again by a later Prefetch()'''
+        while True:
+            TileID = self.prefetch_queue.get()
+            try:
+                tile = self.downloadTile(TileID)
+            except Exception:
+                tile = 0
+            if tile != 0:
+                self.cacheTile(TileID, tile)
+            with self.tile_lock:
+                self.prefetch_pending.discard(TileID)
+
 
 if __name__ == "__main__":
 
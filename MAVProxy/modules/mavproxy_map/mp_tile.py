@@ -12,6 +12,8 @@ released under GNU GPL v3 or later
 import collections
 import errno
 import hashlib
+import heapq
+import socket
 import sys
 import math
 import threading
@@ -22,15 +24,14 @@ import cv2
 import numpy as np
 
 if sys.version_info.major < 3:
-    from urllib2 import Request as url_request
-    from urllib2 import urlopen as url_open
-    from urllib2 import URLError as url_error
+    import httplib
+    from urlparse import urlparse, urljoin
 else:
-    from urllib.request import Request as url_request
-    from urllib.request import urlopen as url_open
-    from urllib.error import URLError as url_error
+    import http.client as httplib
+    from urllib.parse import urlparse, urljoin
 
 from modules.lib import mp_util
+from modules.mavproxy_map.tile_archive import TileArchive
 
 class TileException(Exception):
     '''tile error class'''
@@ -67,6 +68,15 @@ BLANK_TILES = set(["d16657bbee25d7f15c583f5c5bf23f50",
 TILES_WIDTH = 256
 TILES_HEIGHT = 256
 
+# tiles requested within this many seconds of each other are downloaded
+# nearest to the view centre first, newer requests always go first
+DOWNLOAD_PRIORITY_INTERVAL = 0.5
+DOWNLOAD_TIMEOUT = 20
+# seconds between looks for a tile archive that doesn't exist yet
+ARCHIVE_CHECK_INTERVAL = 5
+# refuse to seed more tiles than this in one go
+MAX_SEED_TILES = 200000
+
 class TileServiceInfo:
     '''a lookup object for the URL templates'''
     def __init__(self, x, y, zoom):
@@ -98,6 +108,8 @@ class TileInfo:
         self.zoom = zoom
         self.service = service
         (self.offsetx, self.offsety) = offset
+        # seeded tiles go in the tile archive, and aren't cancelled when out of view
+        self.seed = False
         self.refresh_time()
 
     def key(self):
@@ -166,7 +178,7 @@ class MPTile:
     '''map tile object'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
              service="MicrosoftSat", tile_delay=0.3, debug=False,
-             max_zoom=19, refresh_age=30*24*60*60):
+             max_zoom=19, refresh_age=30*24*60*60, download_threads=4):
 
         if cache_path is None:
             try:
@@ -194,9 +206,21 @@ class MPTile:
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
 
-        # _download_pending is a dictionary of TileInfo objects
+        # _download_pending is a dictionary of TileInfo objects, including
+        # those being downloaded. _download_heap holds (priority, seq, key)
+        # entries, an entry is stale unless seq matches _download_queued[key]
+        self.download_threads = download_threads
         self._download_pending = {}
-        self._download_thread = None
+        self._download_heap = []
+        self._download_queued = {}
+        self._download_inflight = set()
+        self._download_seq = 0
+        self._download_cond = threading.Condition()
+        self._download_workers = []
+        self._view_centre = None
+        # service -> TileArchive, or None if there is no archive yet
+        self._archives = {}
+        self._archive_checked = {}
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
         try:
@@ -246,22 +270,185 @@ class MPTile:
         tile = self.coord_to_tile(lat, lon, zoom)
         return self.tile_to_path(tile)
 
+    def archive(self, writable=False):
+        '''the tile archive for the current service, or None if there
+        isn't one. A writable archive is created if needed'''
+        service = self.service
+        archive = self._archives.get(service)
+        if archive is not None and (archive.writable or not writable):
+            return archive
+        path = os.path.join(self.cache_path, service)
+        if not writable:
+            now = time.time()
+            if now - self._archive_checked.get(service, 0) < ARCHIVE_CHECK_INTERVAL:
+                return None
+            self._archive_checked[service] = now
+            if not TileArchive.exists(path):
+                return None
+        if archive is not None:
+            archive.close()
+        archive = TileArchive(path, writable=writable)
+        self._archives[service] = archive
+        return archive
+
+    def read_tile(self, tile):
+        '''read a tile image from the tile archive or the tile cache
+        directory, returning (img, mtime). mtime is None for archived
+        tiles, which are never refreshed'''
+        archive = self.archive()
+        if archive is not None:
+            data = archive.get(tile.zoom, tile.x, tile.y)
+            if data is not None:
+                img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if img is not None:
+                    return (img, None)
+        path = self.tile_to_path(tile)
+        img = cv2.imread(path)
+        if img is None:
+            return (None, None)
+        return (img, os.path.getmtime(path))
+
+    def seed(self, lat1, lon1, lat2, lon2, zooms):
+        '''queue downloads of every tile in a lat/lon box at the given
+        zoom levels into the tile archive, for flying without a network
+        connection. Tiles already in the cache directory are copied into
+        the archive. Returns the number of tiles queued'''
+        tiles = []
+        for zoom in zooms:
+            t1 = self.coord_to_tile(max(lat1, lat2), min(lon1, lon2), zoom)
+            t2 = self.coord_to_tile(min(lat1, lat2), max(lon1, lon2), zoom)
+            tiles.append((zoom, t1, t2))
+        total = sum([(t2.x - t1.x + 1) * (t2.y - t1.y + 1) for (zoom, t1, t2) in tiles])
+        if total > MAX_SEED_TILES:
+            raise TileException('%u tiles is too many to seed, the limit is %u' % (total, MAX_SEED_TILES))
+
+        archive = self.archive(writable=True)
+        queued = 0
+        for (zoom, t1, t2) in tiles:
+            for y in range(t1.y, t2.y+1):
+                for x in range(t1.x, t2.x+1):
+                    if (zoom, x, y) in archive:
+                        continue
+                    tile = TileInfo((x, y), zoom, self.service)
+                    try:
+                        with open(self.tile_to_path(tile), 'rb') as f:
+                            archive.put(zoom, x, y, f.read())
+                        continue
+                    except (IOError, OSError):
+                        pass
+                    tile.seed = True
+                    # behind any tile wanted for display
+                    self.queue_download(tile, priority=(0, 0))
+                    queued += 1
+        return queued
+
     def tiles_pending(self):
         '''return number of tiles pending download'''
         return len(self._download_pending)
 
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
+    def queue_download(self, tile, priority=None):
+        '''ask for a tile to be downloaded, or bump its priority if it
+        is already queued'''
+        key = tile.key()
+        if priority is None:
+            if self._view_centre is not None:
+                distance = tile.distance(self._view_centre[0], self._view_centre[1])
+            else:
+                distance = 0
+            priority = (-int(time.time() / DOWNLOAD_PRIORITY_INTERVAL), distance)
+        with self._download_cond:
+            if key in self._download_pending:
+                self._download_pending[key].refresh_time()
+            else:
+                self._download_pending[key] = tile
+            if key not in self._download_inflight:
+                self._download_seq += 1
+                self._download_queued[key] = self._download_seq
+                heapq.heappush(self._download_heap, (priority, self._download_seq, key))
+                self._download_cond.notify()
+        self.start_download_thread()
 
-            keys = sorted(self._download_pending.keys())
+    def cancel_downloads(self, keep):
+        '''drop queued downloads of tiles whose keys are not in keep, for
+        tiles that have scrolled out of view. Downloads in progress and
+        seeded tiles finish'''
+        with self._download_cond:
+            for (key, tile) in list(self._download_pending.items()):
+                if key not in keep and key not in self._download_inflight and not tile.seed:
+                    self._download_pending.pop(key)
+                    self._download_queued.pop(key, None)
+            if not self._download_pending:
+                self._download_heap = []
+
+    def next_download(self):
+        '''wait for the highest priority queued tile and mark it in flight'''
+        with self._download_cond:
+            while True:
+                while self._download_heap:
+                    (priority, seq, key) = heapq.heappop(self._download_heap)
+                    if self._download_queued.get(key) != seq:
+                        continue
+                    self._download_queued.pop(key)
+                    self._download_inflight.add(key)
+                    return self._download_pending[key]
+                self._download_cond.wait()
+
+    def download_done(self, key, available=True):
+        with self._download_cond:
+            self._download_pending.pop(key, None)
+            self._download_inflight.discard(key)
+        if not available and not key in self._tile_cache:
+            self._tile_cache[key] = self._unavailable
+
+    def fetch(self, url, connections):
+        '''GET a url over a kept-alive connection to its host, following one
+        redirect. Returns (status, content-type, body)'''
+        headers = {'User-Agent': 'MAVProxy'}
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+        for attempt in range(3):
+            parts = urlparse(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn_key = (parts.scheme, parts.netloc)
+            conn = connections.get(conn_key)
+            reused = conn is not None
+            if conn is None:
+                if parts.scheme == 'https':
+                    conn = httplib.HTTPSConnection(parts.netloc, timeout=DOWNLOAD_TIMEOUT)
+                else:
+                    conn = httplib.HTTPConnection(parts.netloc, timeout=DOWNLOAD_TIMEOUT)
+                connections[conn_key] = conn
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                connections.pop(conn_key)
+                if reused:
+                    # the server closed the idle connection, try a new one
+                    continue
+                raise
+            if resp.getheader('connection', '').lower() == 'close':
+                conn.close()
+                connections.pop(conn_key)
+            location = resp.getheader('location')
+            if resp.status in [301, 302, 303, 307] and location:
+                url = urljoin(url, location)
+                continue
+            return (resp.status, resp.getheader('content-type', ''), body)
+        raise TileException('too many retries for %s' % url)
 
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
-            for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
+    def downloader(self):
+        '''a download worker thread'''
+        # (scheme, host) -> connection, kept open between tiles
+        connections = {}
+        while True:
+            tile_info = self.next_download()
+            if self.tile_delay > 0:
+                time.sleep(self.tile_delay)
 
             url = tile_info.url(self.service)
             path = self.tile_to_path(tile_info)
@@ -269,60 +456,60 @@ class MPTile:
 
             try:
                 if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
+                    print("Downloading %s [%u left]" % (url, self.tiles_pending()))
+                (status, content_type, img) = self.fetch(url, connections)
+            except Exception as e:
                 #print('Error loading %s' % url)
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
+                self.download_done(key, available=False)
                 if self.debug:
                     print("Failed %s: %s" % (url, str(e)))
                 continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
+            if status != 200:
+                self.download_done(key, available=False)
+                if self.debug:
+                    print("Failed %s: HTTP %u" % (url, status))
+                continue
+            if content_type.find('image') == -1:
+                self.download_done(key, available=False)
                 if self.debug:
                     print("non-image response %s" % url)
                 continue
-            else:
-                img = resp.read()
 
             # see if its a blank/unavailable tile
             md5 = hashlib.md5(img).hexdigest()
             if md5 in BLANK_TILES:
                 if self.debug:
                     print("blank tile %s" % url)
-                    if not key in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
+                self.download_done(key, available=False)
+                continue
+
+            if tile_info.seed:
+                self.archive(writable=True).put(tile_info.zoom, tile_info.x, tile_info.y, img)
+                self.download_done(key)
                 continue
 
             mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp','wb')
+            tmpname = '%s.%s.tmp' % (path, threading.current_thread().name)
+            h = open(tmpname,'wb')
             h.write(img)
             h.close()
             try:
                 os.unlink(path)
             except Exception:
                 pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
+            os.rename(tmpname, path)
+            self.download_done(key)
 
     def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
+        '''start the download workers'''
+        if len(self._download_workers) >= self.download_threads:
             return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+        while len(self._download_workers) < self.download_threads:
+            t = threading.Thread(target=self.downloader,
+                                 name='tile_download_%u' % len(self._download_workers))
+            t.daemon = True
+            self._download_workers.append(t)
+            t.start()
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -352,8 +539,7 @@ class MPTile:
                 if np.array_equal(img, np.array(self._unavailable)):
                     continue
             else:
-                path = self.tile_to_path(tile_info)
-                img = cv2.imread(path)
+                (img, mtime) = self.read_tile(tile_info)
                 if img is None:
                     continue
                 # add it to the tile cache
@@ -388,17 +574,12 @@ class MPTile:
             return img
 
 
-        path = self.tile_to_path(tile)
-        ret = cv2.imread(path)
+        (ret, mtime) = self.read_tile(tile)
         if ret is not None:
             # if it is an old tile, then try to refresh
-            if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                        self._download_pending[key].refresh_time()
-                except Exception:
-                        self._download_pending[key] = tile
-                self.start_download_thread()
-                    
+            if mtime is not None and mtime + self.refresh_age < time.time():
+                self.queue_download(tile)
+
             # add it to the tile cache
             self._tile_cache[key] = ret
             while len(self._tile_cache) > self.cache_size:
@@ -411,11 +592,7 @@ class MPTile:
                 img = self._unavailable
             return img
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.queue_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
@@ -530,11 +707,14 @@ class MPTile:
 
         tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-        # order the display by distance from the middle, so the download happens
+        # downloads are prioritised by distance from the middle, so they happen
         # close to the middle of the image first
+        (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+        self._view_centre = (midlat, midlon)
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
             tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
+        # tiles that have scrolled out of view don't need downloading any more
+        self.cancel_downloads(set([t.key() for t in tlist]))
 
         for t in tlist:
             scaled_tile = self.scaled_tile(t)
@@ -585,8 +765,14 @@ if __name__ == "__main__":
     parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
     parser.add_option("--boundary", default=None, help="region boundary")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
+    parser.add_option("--url", default=None, help="tile URL template, e.g. http://127.0.0.1:8000/${ZOOM}/${X}/${Y}.png for a local tile server")
+    parser.add_option("--threads", type='int', default=4, help="download threads")
     (opts, args) = parser.parse_args()
 
+    if opts.url is not None:
+        TILE_SERVICES['Custom'] = opts.url
+        opts.service = 'Custom'
+
     lat = opts.lat
     lon = opts.lon
     ground_width = opts.width
@@ -601,7 +787,8 @@ if __name__ == "__main__":
         print(lat, lon, ground_width)
 
     mt = MPTile(debug=opts.debug, service=opts.service,
-            tile_delay=opts.delay, max_zoom=opts.max_zoom)
+            tile_delay=opts.delay, max_zoom=opts.max_zoom,
+            download_threads=opts.threads)
     if opts.zoom is None:
         zooms = range(mt.min_zoom, mt.max_zoom+1)
     else:
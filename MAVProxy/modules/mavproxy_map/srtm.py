@@ -18,9 +18,10 @@ import re
 import pickle
 import os.path
 import os
+import tempfile
 import zipfile
-import array
 import math
+import numpy
 from modules.lib import mp_util
 from modules.lib import multiproc
 
@@ -280,8 +281,7 @@ class SRTMDownloader():
         elif mypid in childTileDownload and childTileDownload[mypid].is_alive():
             '''print("Still Getting Tile")'''
             return 0
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
+        # Tiles are cached by the caller, see mp_elevation.ElevationModel
         try:
             return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
         except InvalidTileError:
@@ -301,6 +301,11 @@ class SRTMDownloader():
                 self.ftpfile.write(data)
                 self.ftpfile.close()
                 self.ftpfile = None
+                # decompress here rather than on first use in the main process
+                try:
+                    decompressTile(os.path.join(self.cachedir, filename))
+                except (InvalidTileError, IOError, OSError):
+                    pass
         except Exception as e:
             if not self.first_failure:
                 print("SRTM Download failed %s on server %s" % (filepath, self.server))
@@ -308,6 +313,51 @@ class SRTMDownloader():
             pass
 
 
+def readZipTile(f, lat, lon):
+    """Return the raw big-endian samples of a .hgt.zip tile"""
+    try:
+        zipf = zipfile.ZipFile(f, 'r')
+    except Exception:
+        raise InvalidTileError(lat, lon)
+    names = zipf.namelist()
+    if len(names) != 1:
+        raise InvalidTileError(lat, lon)
+    data = zipf.read(names[0])
+    zipf.close()
+    # Currently only SRTM1/3 is supported, 2 bytes per sample
+    if len(data) not in (1201*1201*2, 3601*3601*2):
+        raise InvalidTileError(lat, lon)
+    return data
+
+def decompressTile(f, lat=0, lon=0):
+    """Decompress a .hgt.zip tile to a .hgt file next to it, unless that is
+        already up to date, and return the name of the .hgt file. Tiles are
+        then opened with mmap instead of being decompressed each time."""
+    hgt = f[:-len('.zip')] if f.endswith('.zip') else f + '.hgt'
+    if (os.path.exists(hgt) and
+        os.path.getsize(hgt) in (1201*1201*2, 3601*3601*2) and
+        os.path.getmtime(hgt) >= os.path.getmtime(f)):
+        return hgt
+    data = readZipTile(f, lat, lon)
+    # a name of its own, so threads or processes decompressing the same
+    # tile at once don't write over each other
+    (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(hgt) or '.', prefix=os.path.basename(hgt) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data)
+        if hasattr(os, 'replace'):
+            os.replace(tmpname, hgt)
+        else:
+            if os.path.exists(hgt):
+                # rename() won't replace a file on windows
+                os.unlink(hgt)
+            os.rename(tmpname, hgt)
+    except (IOError, OSError):
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+    return hgt
+
 class SRTMTile:
     """Base class for all SRTM tiles.
         Each SRTM tile is size x size pixels big and contains
@@ -315,23 +365,17 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+        The samples are a read-only memory map of the decompressed tile, so
+        only the pages that are used are read from disk.
         """
     def __init__(self, f, lat, lon):
         try:
-            zipf = zipfile.ZipFile(f, 'r')
-        except Exception:
-            raise InvalidTileError(lat, lon)
-        names = zipf.namelist()
-        if len(names) != 1:
-            raise InvalidTileError(lat, lon)
-        data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
+            self.data = numpy.memmap(decompressTile(f, lat, lon), dtype='>i2', mode='r')
+        except (IOError, OSError):
+            # can't write the decompressed tile, keep it in memory instead
+            self.data = numpy.frombuffer(readZipTile(f, lat, lon), dtype='>i2')
+        self.size = int(math.sqrt(len(self.data)))
+        if self.size not in (1201, 3601) or len(self.data) != self.size * self.size:
             raise InvalidTileError(lat, lon)
         self.lat = lat
         self.lon = lon
@@ -376,7 +420,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print(offset)
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -411,6 +455,33 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getAltitudeArray(self, lats, lons):
+        """Vectorised getAltitudeFromLatLon for arrays of lat lon pairs, all
+            of which must be within this tile. Gives the same results as
+            calling getAltitudeFromLatLon on each pair.
+        """
+        lat = numpy.asarray(lats, dtype=float) - self.lat
+        lon = numpy.asarray(lons, dtype=float) - self.lon
+        outside = (lat < 0.0) | (lat >= 1.0) | (lon < 0.0) | (lon >= 1.0)
+        if numpy.any(outside):
+            i = numpy.flatnonzero(outside)[0]
+            raise WrongTileError(self.lat, self.lon, self.lat+lat.flat[i], self.lon+lon.flat[i])
+        x = lon * (self.size - 1)
+        y = lat * (self.size - 1)
+        x_int = x.astype(int)
+        y_int = y.astype(int)
+        x_frac = x - x_int
+        y_frac = y - y_int
+        # offsets of (x_int, y_int), see calcOffset
+        offset = x_int + self.size * (self.size - y_int - 1)
+        values = self.data[numpy.stack((offset, offset+1, offset-self.size, offset-self.size+1))].astype(float)
+        # -32768 is a special value for areas with no data
+        values[values == -32768] = -1
+        (value00, value10, value01, value11) = values
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -420,6 +491,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(numpy.shape(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
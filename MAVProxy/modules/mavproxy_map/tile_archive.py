@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+'''
+packed map tile archive
+
+All the tiles of one service in two append-only files instead of one file
+per tile:
+
+  <service>.pack  the tile images, back to back
+  <service>.idx   one fixed size record per tile: zoom, x, y, offset, length
+
+The index is loaded into a dict when the archive is opened and the pack is
+read through mmap, so looking up a tile makes no filesystem calls. A later
+record for the same tile replaces the earlier one. Records are only
+written after their data, so a pack cut short by a crash just loses its
+last tiles.
+'''
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+# zoom, x, y, offset, length
+INDEX_RECORD = struct.Struct('<BIIQI')
+# how often a reader looks for tiles added by another process, in seconds
+REFRESH_INTERVAL = 1.0
+
+
+class TileArchive(object):
+    def __init__(self, path, writable=False):
+        '''open the archive at path (without extension), creating it if writable'''
+        self.pack_path = path + '.pack'
+        self.index_path = path + '.idx'
+        self.writable = writable
+        self.lock = threading.Lock()
+        # (zoom, x, y) -> (offset, length)
+        self.index = {}
+        self.index_size = 0
+        self.map = None
+        self.map_size = 0
+        self.last_refresh = 0
+        self.pack_file = None
+        self.index_file = None
+        if writable:
+            self.pack_file = open(self.pack_path, 'ab')
+            self.index_file = open(self.index_path, 'ab')
+        self.read_index()
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.idx') and os.path.exists(path + '.pack')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def read_index(self):
+        '''read index records added since the last call'''
+        try:
+            with open(self.index_path, 'rb') as f:
+                f.seek(self.index_size)
+                data = f.read()
+            # sized after reading the index: records are written after their
+            # data, so every record read is backed unless the pack was cut short
+            pack_size = os.path.getsize(self.pack_path)
+        except (IOError, OSError):
+            return
+        count = len(data) // INDEX_RECORD.size
+        for i in range(count):
+            (zoom, x, y, offset, length) = INDEX_RECORD.unpack_from(data, i * INDEX_RECORD.size)
+            if offset + length <= pack_size:
+                self.index[(zoom, x, y)] = (offset, length)
+        self.index_size += count * INDEX_RECORD.size
+
+    def refresh(self):
+        '''pick up tiles written by another process, at most every REFRESH_INTERVAL'''
+        now = time.time()
+        if now - self.last_refresh < REFRESH_INTERVAL:
+            return
+        self.last_refresh = now
+        with self.lock:
+            self.read_index()
+
+    def get(self, zoom, x, y):
+        '''the image data of a tile, or None if it isn't in the archive'''
+        entry = self.index.get((zoom, x, y))
+        if entry is None:
+            if not self.writable:
+                self.refresh()
+                entry = self.index.get((zoom, x, y))
+            if entry is None:
+                return None
+        (offset, length) = entry
+        with self.lock:
+            if offset + length > self.map_size:
+                self.remap()
+            return self.map[offset:offset+length]
+
+    def remap(self):
+        # must be called with self.lock held
+        if self.pack_file is not None:
+            self.pack_file.flush()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        with open(self.pack_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        self.map_size = size
+
+    def put(self, zoom, x, y, data):
+        '''add or replace a tile'''
+        with self.lock:
+            offset = self.pack_file.tell()
+            self.pack_file.write(data)
+            self.pack_file.flush()
+            self.index_file.write(INDEX_RECORD.pack(zoom, x, y, offset, len(data)))
+            self.index_file.flush()
+            self.index[(zoom, x, y)] = (offset, len(data))
+            self.index_size += INDEX_RECORD.size
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            for f in [self.pack_file, self.index_file]:
+                if f is not None:
+                    f.close()
+            self.pack_file = None
+            self.index_file = None
@@ -26,6 +26,9 @@ DEG_TO_RAD = math.pi / 180
 
 SPLINE_CONTROLLER = 2
 
+# min_wp_dists value for waypoints that haven't been approached yet
+NO_MIN_DIST = float(sys.maxsize)
+
 
 def constrain(val, min_val, max_val):
     return min(max_val, max(min_val, val))
@@ -52,16 +55,89 @@ def xy2mag(x, y):
     return math.sqrt(x ** 2 + y ** 2)
 
 
+class MissionGeometry(object):
+    '''
+    Everything about a waypoint list that doesn't depend on the plane's
+    position, computed once per mission rather than once per GPS packet.
+    Positions are projected to a local east/north plane in meters around
+    the first waypoint, which is plenty accurate over a mission area.
+    '''
+    def __init__(self, waypoints):
+        self.waypoints = waypoints
+        n = len(waypoints)
+        if n > 0:
+            self.lat0, self.lon0 = waypoints[0].x, waypoints[0].y
+        else:
+            self.lat0, self.lon0 = 0, 0
+        self.lon_scale = longitude_scale(self.lat0, self.lon0)
+
+        lats = numpy.array([wp.x for wp in waypoints], dtype=float)
+        lons = numpy.array([wp.y for wp in waypoints], dtype=float)
+        self.alts = numpy.array([wp.z for wp in waypoints], dtype=float)
+        self.en = self.project(lats, lons)
+        self.is_jump = numpy.array([wp.command == mavlink.MAV_CMD_DO_JUMP for wp in waypoints], dtype=bool)
+
+        # seg_lengths[k] is the distance from waypoint k to waypoint k+1
+        self.seg_lengths = numpy.array([dist_between_locations(((wp1.x, wp1.y), wp1.z), ((wp2.x, wp2.y), wp2.z))
+                                        for wp1, wp2 in zip(waypoints[:-1], waypoints[1:])])
+        # path_dist[j] is the distance along the flight plan from waypoint 1 (the
+        # first after home) to waypoint j
+        self.path_dist = numpy.zeros(n)
+        if n > 2:
+            self.path_dist[2:] = numpy.cumsum(self.seg_lengths[1:n - 1])
+            self.total_dist = self.path_dist[-1]
+        else:
+            self.total_dist = 0
+
+    def project(self, lat, lon):
+        '''(east, north) in meters from the first waypoint'''
+        east = (numpy.asarray(lon) - self.lon0) * self.lon_scale / LOCATION_SCALING_FACTOR_INV
+        north = (numpy.asarray(lat) - self.lat0) / LOCATION_SCALING_FACTOR_INV
+        return numpy.column_stack((east, north))
+
+    def segment_fraction(self, k, plane_loc):
+        '''how far (0 to 1) the plane has got along the segment from waypoint
+        k to waypoint k+1, given plane_loc as ((<lat>, <lon>), <alt>)'''
+        (lat, lon), alt = plane_loc
+        plane = numpy.append(self.project(lat, lon)[0], alt)
+        start = numpy.append(self.en[k], self.alts[k])
+        seg = numpy.append(self.en[k + 1], self.alts[k + 1]) - start
+        seg_sq = seg.dot(seg)
+        if seg_sq == 0:
+            return 0.0
+        return constrain((plane - start).dot(seg) / seg_sq, 0.0, 1.0)
+
+    def closest_approach(self, prev_coords, coords, alt):
+        '''distance in meters from every waypoint to the line flown between
+        prev_coords and coords (both (<lat>, <lon>)) at altitude alt.
+        DO_JUMP waypoints have no location and are always 0'''
+        prev_pos, pos = self.project([prev_coords[0], coords[0]], [prev_coords[1], coords[1]])
+        flown = pos - prev_pos
+        flown_sq = flown.dot(flown)
+        if flown_sq > 0:
+            t = numpy.clip((self.en - prev_pos).dot(flown) / flown_sq, 0.0, 1.0)
+        else:
+            t = numpy.zeros(len(self.en))
+        closest = prev_pos + t[:, None] * flown
+        xy_dist = numpy.hypot(*(self.en - closest).T)
+        dists = numpy.hypot(xy_dist, self.alts - alt)
+        dists[self.is_jump] = 0
+        return dists
+
+
 class MissionModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(MissionModule, self).__init__(mpstate, "mission", "mission info handling", public=True)
+        self.mavlink_types = ['WAYPOINT_CURRENT', 'MISSION_CURRENT', 'GLOBAL_POSITION_INT', 'SPLINE_CONTROL_POINTS']
         self.db = self.mpstate.public_modules['database']
         self.prev_gps_loc = None
         self.last_waypoint = 0
         self.avg_speed = 0
         self.flight_progress = {}
-        self.min_wp_dists = []
+        self.min_wp_dists = numpy.zeros(0)
         self.spline_path = []
+        # rebuilt whenever the database module replaces its waypoint list
+        self.geometry = MissionGeometry([])
 
         self.add_command('mission', self.cmd_mission, 'mission info',
                          ["<ttl|covered|percent>"])
@@ -128,74 +204,47 @@ class MissionModule(mp_module.MPModule):
         self.flight_progress = prog
 
         # calculate min distance to waypoints
-        waypoints = self.db.wps
-        if len(waypoints) != len(self.min_wp_dists):
+        geometry = self.get_geometry()
+        if len(geometry.waypoints) != len(self.min_wp_dists):
             self.reset_min_dists()
 
         if self.prev_gps_loc is not None:
-            for i, wp in enumerate(list(waypoints)):
-                # wp_gps_coords = sda_util.Point(wp.x, wp.y)
-                # plane_gps_arr = sda_util.Point(*plane_gps_coords)
-                # prev_plane_gps_arr = sda_util.Point(*self.prev_gps_loc)
-                # interp_segment = sda_util.Segment(plane_gps_arr, prev_plane_gps_arr)
-                closest_point = interp_segment.projection(wp_gps_coords)
-
-                if wp.command == mavlink.MAV_CMD_DO_JUMP:
-                    total_dist = 0
-                else:
-                    closest_point = (closest_point.x, closest_point.y)
-                    xy_dist = gps_distance(closest_point, (wp.x, wp.y)).meters
-                    z_dist = abs(relative_alt - wp.z)
-                    total_dist = (z_dist**2 + xy_dist**2)**.5
-
-                if self.min_wp_dists[i] and total_dist < self.min_wp_dists[i]:
-                    self.min_wp_dists[i] = total_dist
+            dists = geometry.closest_approach(self.prev_gps_loc, plane_gps_coords, relative_alt)
+            self.min_wp_dists = numpy.minimum(self.min_wp_dists, dists)
         self.prev_gps_loc = plane_gps_coords
 
+    def get_geometry(self):
+        '''MissionGeometry for the current waypoints'''
+        if self.geometry.waypoints is not self.db.wps:
+            self.geometry = MissionGeometry(self.db.wps)
+        return self.geometry
+
     def _get_wp_progress(self, plane_loc):
         '''given (<plane coordinates>, <plane altitude>), returns progress along
            waypoint path as an object'''
         progress = {}
         just_passed_wp = self.last_waypoint - 1
-        waypoints = self.db.wps
-        if(len(waypoints) <= 2):
+        geometry = self.get_geometry()
+        num_wps = len(geometry.waypoints)
+        if num_wps <= 2 or geometry.total_dist == 0:
             # no waypoints so return no progress
             progress["covered"] = 0
             progress["remaining"] = 0
             progress["percentage"] = 0
             return progress
-        total_dist = 0  # total length of the flight plan
-        covered_dist = 0  # length of the flight plan that has been flown so far
-        for i in range(len(waypoints) - 2):
-            wp_num = i + 1  # ignore the home waypoint
-            wp1 = waypoints[wp_num]  # earlier of the two waypoints being compared
-            wp2 = waypoints[wp_num + 1]  # latter of the two waypoints
-            wp1_gps_loc = ((wp1.x, wp1.y), wp1.z)
-            wp2_gps_loc = ((wp2.x, wp2.y), wp2.z)
-            res_dist = dist_between_locations(wp1_gps_loc, wp2_gps_loc)
-            total_dist += res_dist
-            # only add to covered dist if wp1 is before most recently passed wp
-            if wp_num + 1 <= just_passed_wp:
-                covered_dist += res_dist
+        # length of the flight plan that has been flown up to the most recently passed wp
+        covered_dist = geometry.path_dist[constrain(just_passed_wp, 0, num_wps - 1)]
 
         # add estimation of plane distance between prev and next waypoints
-        if just_passed_wp + 1 <= len(waypoints):  # only if not at last wp
-            passed_wp = waypoints[just_passed_wp]
-            next_wp = waypoints[just_passed_wp + 1]
-            passed_gps_loc = ((passed_wp.x, passed_wp.y), passed_wp.z)
-            next_gps_loc = ((next_wp.x, next_wp.y), next_wp.z)
-            # get dist between passed wp and plane, next wp and plane, and both wps
-            passed_dist = dist_between_locations(passed_gps_loc, plane_loc)
-            next_dist = dist_between_locations(next_gps_loc, plane_loc)
-            wp_diff = dist_between_locations(passed_gps_loc, next_gps_loc)
-            # map progress percent between wps on to dist between the two
-            covered_dist += wp_diff * (passed_dist / (passed_dist + next_dist))
+        if 0 <= just_passed_wp < num_wps - 1:  # only if not at last wp
+            covered_dist += geometry.seg_lengths[just_passed_wp] * geometry.segment_fraction(just_passed_wp, plane_loc)
 
+        total_dist = geometry.total_dist
         flight_percent = min(100.0 * (covered_dist / total_dist), 100.0)
         # update the progress object
         progress["covered"] = int(covered_dist)
         progress["remaining"] = int(total_dist - covered_dist)
-        progress["percentage"] = flight_percent
+        progress["percentage"] = float(flight_percent)
         return progress
 
     def add_next_spline_segment(self, m):
@@ -216,10 +265,10 @@ class MissionModule(mp_module.MPModule):
         return self.flight_progress
 
     def get_min_dists(self):
-        return self.min_wp_dists
+        return self.min_wp_dists.tolist()
 
     def reset_min_dists(self):
-        self.min_wp_dists = [sys.maxint] * len(self.db.wps)
+        self.min_wp_dists = numpy.full(len(self.db.wps), NO_MIN_DIST)
 
 
 instance = None
@@ -9,30 +9,60 @@ April 2018
 import time
 import json
 import socket
-from threading import Thread
+import hashlib
+from threading import Thread, Lock
 
-from flask import Flask
+from flask import Flask, Response, request as flask_request
 from werkzeug.serving import make_server
 from modules.lib import mp_module
 
-def mavlink_to_json(msg):
-    '''Translate mavlink python messages in json string'''
-    ret = '\"%s\": {' % msg._type
+def mavlink_to_dict(msg):
+    '''fields of a mavlink message with their native types. NaN isn't
+    valid JSON, so it becomes None'''
+    ret = {}
     for fieldname in msg._fieldnames:
         data = getattr(msg, fieldname)
-        ret += '\"%s\" : \"%s\", ' % (fieldname, data)
-    ret = ret[0:-2] + '}'
+        if isinstance(data, float) and data != data:
+            data = None
+        ret[fieldname] = data
     return ret
 
-def mpstatus_to_json(status):
-    '''Translate MPStatus in json string'''
-    msg_keys = list(status.msgs.keys())
-    data = '{'
-    for key in msg_keys[:-1]:
-        data += mavlink_to_json(status.msgs[key]) + ','
-    data += mavlink_to_json(status.msgs[msg_keys[-1]])
-    data += '}'
-    return data
+def json_default(obj):
+    '''json.dumps fallback for the odd bytes field'''
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode('utf-8', 'replace')
+    raise TypeError("%r is not JSON serializable" % obj)
+
+class MessageCache():
+    '''dict and JSON of each message type, rebuilt only when status.msgs
+    holds a new message of that type, so a request costs O(types requested)'''
+    def __init__(self):
+        # mtype -> (message, sequence, dict, json)
+        self.entries = {}
+        self.sequence = 0
+        # the server is threaded, and two rebuilds must never share a sequence
+        self.lock = Lock()
+        # keeps ETags from one run from matching those of another
+        self.epoch = str(time.time())
+
+    def entry(self, status, mtype):
+        msg = status.msgs.get(mtype)
+        if msg is None:
+            return None
+        with self.lock:
+            cached = self.entries.get(mtype)
+            if cached is not None and cached[0] is msg:
+                return cached
+            self.sequence += 1
+            data = mavlink_to_dict(msg)
+            cached = (msg, self.sequence, data, json.dumps(data, default=json_default))
+            self.entries[mtype] = cached
+            return cached
+
+    def etag(self, entries):
+        '''ETag for a response built from entries, a list of (mtype, entry)'''
+        tag = ','.join(['%s:%u' % (mtype, entry[1]) for (mtype, entry) in entries])
+        return hashlib.sha1((self.epoch + tag).encode('ascii')).hexdigest()
 
 class RestServer():
     '''Rest Server'''
@@ -51,6 +81,7 @@ class RestServer():
         # Save status
         self.status = None
         self.server = None
+        self.cache = MessageCache()
 
     def update_dict(self, mpstate):
         '''We don't have time to waste'''
@@ -91,30 +122,59 @@ class RestServer():
         self.server.serve_forever()
 
     def request(self, arg=None):
-        '''Deal with requests'''
+        '''Deal with requests. ?types=ATTITUDE,VFR_HUD limits the response to
+        those message types'''
         if not self.status:
             return '{"result": "No message"}'
 
-        try:
-            status_dict = json.loads(mpstatus_to_json(self.status))
-        except Exception as e:
-            print(e)
-            return
+        args = arg.split('/') if arg else []
+        types = flask_request.args.get('types')
+        if args:
+            types = [args[0]]
+        elif types:
+            types = types.split(',')
+        else:
+            types = list(self.status.msgs.keys())
+
+        entries = []
+        for mtype in types:
+            entry = self.cache.entry(self.status, mtype)
+            if entry is not None:
+                entries.append((mtype, entry))
 
-        # If no key, send the entire json
-        if not arg:
-            return json.dumps(status_dict)
+        if args and not entries:
+            return '{"key": "%s", "last_dict": %s}' % (args[0], self.all_json())
 
-        # Get item from path
-        new_dict = status_dict
-        args = arg.split('/')
-        for key in args:
-            if key in new_dict:
-                new_dict = new_dict[key]
-            else:
-                return '{"key": "%s", "last_dict": %s}' % (key, json.dumps(new_dict))
+        etag = self.cache.etag(entries)
+        if flask_request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
 
-        return json.dumps(new_dict)
+        if not args:
+            body = '{%s}' % ', '.join(['"%s": %s' % (mtype, entry[3]) for (mtype, entry) in entries])
+        else:
+            # Get item from path
+            new_dict = entries[0][1][2]
+            for key in args[1:]:
+                if isinstance(new_dict, dict) and key in new_dict:
+                    new_dict = new_dict[key]
+                else:
+                    return '{"key": "%s", "last_dict": %s}' % (key, json.dumps(new_dict, default=json_default))
+            body = json.dumps(new_dict, default=json_default)
+
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    def all_json(self):
+        '''every message type, for the error response to an unknown key'''
+        parts = []
+        for mtype in list(self.status.msgs.keys()):
+            entry = self.cache.entry(self.status, mtype)
+            if entry is not None:
+                parts.append('"%s": %s' % (mtype, entry[3]))
+        return '{%s}' % ', '.join(parts)
 
     def add_endpoint(self):
         '''Set endpoits'''
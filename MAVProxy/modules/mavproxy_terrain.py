@@ -3,24 +3,47 @@
 """
 
 import time
+import math
+
+import numpy
 
 from modules.mavproxy_map import mp_elevation
 from modules.lib import mp_util
 from modules.lib import mp_module
 from modules.lib import mp_settings
 
+# seconds between prefetches of the SRTM tiles ahead of the vehicle
+PREFETCH_INTERVAL = 5
+
+
+def gps_offset_array(lat, lon, east, north):
+    '''mp_util.gps_offset for arrays of east/north offsets from one point'''
+    bearing = numpy.arctan2(east, north)
+    dr = numpy.sqrt(east**2 + north**2) / mp_util.radius_of_earth
+    lat1 = math.radians(lat)
+    lon1 = math.radians(lon)
+    lat2 = numpy.arcsin(math.sin(lat1)*numpy.cos(dr) +
+                        math.cos(lat1)*numpy.sin(dr)*numpy.cos(bearing))
+    lon2 = lon1 + numpy.arctan2(numpy.sin(bearing)*numpy.sin(dr)*math.cos(lat1),
+                                numpy.cos(dr)-math.sin(lat1)*numpy.sin(lat2))
+    return (numpy.degrees(lat2), mp_util.wrap_valid_longitude(numpy.degrees(lon2)))
+
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=False)
+        self.idle_rate = 5
 
         self.ElevationModel = mp_elevation.ElevationModel()
         self.current_request = None
+        # altitudes of every point of current_request, see request_grid()
+        self.request_alts = None
         self.sent_mask = 0
         self.last_send_time = time.time()
         self.requests_received = 0
         self.blocks_sent = 0
         self.check_lat = 0
         self.check_lon = 0
+        self.last_prefetch = 0
         self.add_command('terrain', self.cmd_terrain, "terrain control",
                          ["<status|check>",
                           'set (TERRAINSETTING)'])
@@ -65,8 +88,10 @@ class TerrainModule(mp_module.MPModule):
         # add some status fields
         if mtype == 'TERRAIN_REQUEST' and self.terrain_settings.enable:
             self.current_request = msg
+            self.request_alts = None
             self.sent_mask = 0
             self.requests_received += 1
+            self.wake_idle()
         elif mtype == 'TERRAIN_REPORT':
             if (msg.lat == self.check_lat and
                 msg.lon == self.check_lon and
@@ -74,28 +99,43 @@ class TerrainModule(mp_module.MPModule):
                 print(msg)
                 self.check_lat = 0
                 self.check_lon = 0
+        elif mtype == 'GLOBAL_POSITION_INT' and self.terrain_settings.enable:
+            now = time.time()
+            if now - self.last_prefetch >= PREFETCH_INTERVAL:
+                self.last_prefetch = now
+                self.ElevationModel.Prefetch(msg.lat*1.0e-7, msg.lon*1.0e-7,
+                                             north=msg.vx*0.01, east=msg.vy*0.01)
 
-    def send_terrain_data_bit(self, bit):
-        '''send some terrain data'''
+    def request_grid(self):
+        '''altitudes of all 56 blocks of 4x4 points of the current request in
+        one GetElevationArray call, shape (56, 16) with NaN where unknown'''
         lat = self.current_request.lat * 1.0e-7
         lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
+        spacing = self.current_request.grid_spacing
+        bit_spacing = spacing * 4
+        i = numpy.arange(4*4)
+        east = spacing * (i % 4)
+        north = spacing * (i // 4)
+        lats = numpy.empty((56, 16))
+        lons = numpy.empty((56, 16))
+        for bit in range(56):
+            (lat1, lon1) = mp_util.gps_offset(lat, lon,
+                                              east=bit_spacing * (bit % 8),
+                                              north=bit_spacing * (bit // 8))
+            (lats[bit], lons[bit]) = gps_offset_array(lat1, lon1, east, north)
+        return self.ElevationModel.GetElevationArray(lats, lons)
+
+    def send_terrain_data_bit(self, bit):
+        '''send some terrain data'''
+        if self.request_alts is None or numpy.isnan(self.request_alts[bit]).any():
+            # first block, or a tile that was missing may have arrived
+            self.request_alts = self.request_grid()
+        alts = self.request_alts[bit]
+        if numpy.isnan(alts).any():
+            if self.terrain_settings.debug:
+                print("no alt for block %u" % bit)
+            return
+        data = [int(alt) for alt in alts]
         self.master.mav.terrain_data_send(self.current_request.lat,
                                           self.current_request.lon,
                                           self.current_request.grid_spacing,
@@ -130,9 +170,7 @@ class TerrainModule(mp_module.MPModule):
         '''called when idle'''
         if self.current_request is None:
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
-            return
+        # idle_rate limits this to 5 per second
         self.send_terrain_data()
 
 def init(mpstate):
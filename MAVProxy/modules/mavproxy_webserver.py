@@ -42,13 +42,17 @@ class WebServerModule(mp_module.MPModule):
             self.mpstate.public_modules['wp'].fetch()
 
         # put server in a dameon so it dies nicely
-        self.server = Urls()
+        self.server = Urls(backend=mpstate.web_backend, threads=mpstate.web_threads)
         serverThread = threading.Thread(target=self.server.start)
         serverThread.setDaemon(True)
         serverThread.start()
         self.in_air = False
         self.start_flying_time = 0
 
+    def unload(self):
+        '''stop the web server, letting requests in progress finish'''
+        self.server.stop()
+
     # cleans parameter and stores it in Data
     def handle_param(self, m):
         name = str(m.param_id).replace('\x00', '')
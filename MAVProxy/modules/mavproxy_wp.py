@@ -11,6 +11,7 @@ if mp_util.has_wxpython:
 class WPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(WPModule, self).__init__(mpstate, "wp", "waypoint handling", public = True)
+        self.idle_rate = 10
         self.wp_op = None
         self.wp_requested = {}
         self.wp_received = {}
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+Access logging and per-route metrics for the web API.
+
+Request lines are queued in memory and written by a background thread, so
+a response never waits on the log file. The log keeps the daily
+_requests.log name and is also rotated by size. Hot routes can be sampled,
+logging only one request in N. The per-route counters always see every
+request.
+'''
+
+import os
+import time
+import datetime
+import threading
+from collections import deque
+
+ACCESS_LOG_MAX_LINES = 10000
+ACCESS_LOG_FLUSH_INTERVAL = 1.0
+ACCESS_LOG_MAX_BYTES = 10 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 5
+
+
+class RouteMetrics(object):
+    '''request count, latency and status codes for each route'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.start_time = time.time()
+
+    def record(self, route, method, status_code, elapsed):
+        key = method + ' ' + route
+        with self.lock:
+            stats = self.routes.get(key)
+            if stats is None:
+                stats = self.routes[key] = {'count': 0, 'total_time': 0.0, 'max_time': 0.0, 'status': {}}
+            stats['count'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            code = str(status_code)
+            stats['status'][code] = stats['status'].get(code, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+            self.start_time = time.time()
+
+    def report(self):
+        '''routes sorted by the total time spent serving them, slowest first'''
+        with self.lock:
+            routes = []
+            for (key, stats) in self.routes.items():
+                entry = dict(stats)
+                entry['status'] = dict(stats['status'])
+                entry['route'] = key
+                entry['mean_time'] = stats['total_time'] / stats['count']
+                routes.append(entry)
+            period = time.time() - self.start_time
+        routes.sort(key=lambda r: r['total_time'], reverse=True)
+        return {'period': period, 'routes': routes}
+
+
+class AccessLog(object):
+    '''
+    Buffers access log lines and writes them from a dedicated thread. Lines
+    are dropped rather than queued without limit if the disk falls behind.
+    '''
+    def __init__(self, log_path, sample=None, max_lines=ACCESS_LOG_MAX_LINES,
+                 flush_interval=ACCESS_LOG_FLUSH_INTERVAL, max_bytes=ACCESS_LOG_MAX_BYTES,
+                 backups=ACCESS_LOG_BACKUPS):
+        self.log_path = log_path
+        # route -> N, log one request in N to that route
+        self.sample = dict(sample or {})
+        self.sample_counts = {}
+        self.max_lines = max_lines
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.running = True
+
+        self.queued = 0
+        self.sampled_out = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rotations = 0
+
+        self.thread = threading.Thread(target=self.writer_loop, name='access_log_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def should_log(self, route):
+        n = self.sample.get(route)
+        if n is None or n <= 1:
+            return True
+        with self.cond:
+            count = self.sample_counts.get(route, 0)
+            self.sample_counts[route] = count + 1
+            if count % n == 0:
+                return True
+            self.sampled_out += 1
+            return False
+
+    def log(self, route, line):
+        '''queue a line for the log. Never touches the disk'''
+        if not self.should_log(route):
+            return
+        with self.cond:
+            if len(self.pending) >= self.max_lines:
+                self.dropped += 1
+                return
+            self.pending.append(line)
+            self.queued += 1
+
+    def stop(self, timeout=5):
+        '''stop the writer thread after writing out what is queued'''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.cond:
+            return {'queued': self.queued,
+                    'pending': len(self.pending),
+                    'sampled_out': self.sampled_out,
+                    'written': self.written,
+                    'dropped': self.dropped,
+                    'failed': self.failed,
+                    'rotations': self.rotations}
+
+    def file_name(self):
+        log_name = datetime.date.today().strftime("%d-%m-%y") + "_requests.log"
+        return os.path.join(self.log_path, log_name)
+
+    def rotate(self, file_name):
+        '''shift file_name to file_name.1, .1 to .2 and so on'''
+        for i in range(self.backups - 1, 0, -1):
+            src = "%s.%u" % (file_name, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%u" % (file_name, i + 1))
+        os.rename(file_name, file_name + ".1")
+        self.rotations += 1
+
+    def writer_loop(self):
+        while True:
+            with self.cond:
+                if self.running:
+                    # let lines accumulate so each write covers many requests
+                    self.cond.wait(self.flush_interval)
+                batch = self.pending
+                self.pending = deque()
+                running = self.running
+            if batch:
+                self.write_batch(batch)
+            if not running:
+                return
+
+    def write_batch(self, batch):
+        file_name = self.file_name()
+        try:
+            if self.max_bytes and os.path.exists(file_name) and os.path.getsize(file_name) >= self.max_bytes:
+                self.rotate(file_name)
+            with open(file_name, 'a') as log_file:
+                log_file.write(''.join(batch))
+            self.written += len(batch)
+        except (IOError, OSError):
+            self.failed += len(batch)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+HTTP server backends for the web API.
+
+  waitress  waitress with a fixed pool of worker threads (pip install waitress)
+  pool      werkzeug's server with HTTP/1.1 keep-alive and a fixed pool of
+            worker threads, for when waitress isn't installed
+  dev       the Flask development server, a thread per connection
+  auto      waitress if it is installed, otherwise pool
+
+Every backend except dev stops gracefully: it stops accepting connections
+and gives requests in progress up to a timeout to finish.
+'''
+
+import logging
+import threading
+import time
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+try:
+    import waitress.server
+except ImportError:
+    waitress = None
+
+import mavproxy_logging
+
+logger = mavproxy_logging.create_logger("serving")
+
+BACKENDS = ['auto', 'waitress', 'pool', 'dev']
+DEFAULT_THREADS = 48
+# idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 5
+# connections waiting for a free worker, per worker, before new ones are refused
+QUEUED_PER_THREAD = 4
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    def log_request(self, *args, **kwargs):
+        # requests are already written to the access log by urls.py
+        pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    '''werkzeug server that hands connections to a fixed pool of threads'''
+    def __init__(self, host, port, app, threads=DEFAULT_THREADS):
+        BaseWSGIServer.__init__(self, host, port, app, handler=KeepAliveRequestHandler)
+        self.connections = Queue.Queue(maxsize=threads * QUEUED_PER_THREAD)
+        self.refused = 0
+        self.workers = []
+        for i in range(threads):
+            t = threading.Thread(target=self.worker_loop, name='web_worker_%u' % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except Queue.Full:
+            # overloaded, refuse the connection rather than queue it forever
+            self.refused += 1
+            self.shutdown_request(request)
+
+    def worker_loop(self):
+        while True:
+            item = self.connections.get()
+            if item is None:
+                return
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def stop(self, timeout):
+        self.shutdown()
+        self.server_close()
+        for t in self.workers:
+            self.connections.put(None)
+        deadline = time.time() + timeout
+        for t in self.workers:
+            t.join(max(deadline - time.time(), 0))
+
+
+class WebServer(object):
+    def __init__(self, app, host, port, backend='auto', threads=None):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown web server backend: " + str(backend))
+        if backend == 'auto':
+            backend = 'waitress' if waitress is not None else 'pool'
+        if backend == 'waitress' and waitress is None:
+            logger.warning("waitress is not installed, using the pool backend")
+            backend = 'pool'
+        self.app = app
+        self.host = host
+        self.port = port
+        self.backend = backend
+        self.threads = threads if threads is not None else DEFAULT_THREADS
+        self.server = None
+
+    def serve(self):
+        '''run the server, returns once stop() is called'''
+        logger.info("Serving on {}:{} with the {} backend".format(self.host, self.port, self.backend))
+        if self.backend == 'dev':
+            self.app.run(host=self.host, port=self.port, threaded=True)
+        elif self.backend == 'waitress':
+            # waitress warns about every request that has to wait for a worker
+            logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+            self.server = waitress.server.create_server(self.app, host=self.host, port=self.port,
+                                                        threads=self.threads,
+                                                        channel_timeout=KEEPALIVE_TIMEOUT)
+            self.server.run()
+        else:
+            self.server = PooledWSGIServer(self.host, self.port, self.app, threads=self.threads)
+            self.server.serve_forever()
+
+    def stop(self, timeout=5):
+        '''stop accepting connections and wait up to timeout seconds for
+        requests in progress to finish'''
+        server = self.server
+        self.server = None
+        if server is None:
+            if self.backend == 'dev':
+                logger.warning("The dev backend can't be stopped, it exits with MAVProxy")
+            return
+        if self.backend == 'waitress':
+            server.close()
+            server.task_dispatcher.shutdown(cancel_pending=False, timeout=timeout)
+        else:
+            server.stop(timeout)
@@ -2,11 +2,16 @@
 from flask import Flask
 from flask import redirect
 from flask import request
+from flask import g
+import atexit
 import datetime
-import os
+import json
+import time
 import mavproxy_logging
 import traceback
 from modules.mavproxy_database import get_db_mod
+from .access_log import AccessLog, RouteMetrics
+from .serving import WebServer
 import logging
 
 log = logging.getLogger('werkzeug')
@@ -16,10 +21,24 @@ logger = mavproxy_logging.create_logger("urls")
 
 mpstate = get_db_mod().mpstate
 
+if mpstate.airapi:
+    metrics_url = "/air/api/v3/metrics"
+else:
+    metrics_url = "/ground/api/v3/metrics"
+
+# route -> N to write only one in N requests to that route to the access log,
+# e.g. {'/ground/api/v3/status': 10}. Metrics always count every request
+ACCESS_LOG_SAMPLE = {}
+
+access_log = AccessLog(mavproxy_logging.get_log_path(), sample=ACCESS_LOG_SAMPLE)
+route_metrics = RouteMetrics()
+atexit.register(access_log.stop)
+
 # these statements must be done BEFORE url imports
 app = Flask(__name__)
 
 from .views import status
+from .views import stream
 from .views import gimbal
 if not mpstate.airapi:
     from .views import interop_api
@@ -55,23 +74,55 @@ class Urls(object):
     def send_file(filename):
         try:
             response = app.send_static_file(str(filename))
-            response.headers["Cache-Control"] = "no-cache, no-store"
+            # the frontend files aren't versioned, so browsers revalidate
+            # them with the ETag and Last-Modified on every load, and a
+            # rebuilt frontend is picked up straight away
+            response.headers["Cache-Control"] = "no-cache"
             return response
         except Exception as e:
             logger.error(str(e))
 
+    @staticmethod
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.time()
+
     @staticmethod
     @app.after_request
     def log_request(response):
-        log_path = mavproxy_logging.get_log_path()
-        log_name = datetime.date.today().strftime("%d-%m-%y") + "_requests.log"
-        with open(os.path.join(log_path, log_name), 'a') as log_file:
-            log_file.write("{time} | ({status_code}) {source} ==> {path}\n".format(
-                    time=datetime.datetime.now(),
-                    status_code=response.status_code,
-                    source=request.remote_addr,
-                    path=request.full_path))
+        if request.url_rule is not None:
+            route = request.url_rule.rule
+        else:
+            route = '<unmatched>'
+        start = getattr(g, 'request_start', None)
+        if start is not None:
+            route_metrics.record(route, request.method, response.status_code, time.time() - start)
+        access_log.log(route, "{time} | ({status_code}) {source} ==> {path}\n".format(
+                time=datetime.datetime.now(),
+                status_code=response.status_code,
+                source=request.remote_addr,
+                path=request.full_path))
         return response
 
+    # Per-route request counts, latency (seconds) and status codes since the
+    # last reset, slowest routes first. DELETE resets the counters
+    @staticmethod
+    @app.route(metrics_url, methods=['GET', 'DELETE'])
+    def metrics():
+        if request.method == 'DELETE':
+            route_metrics.reset()
+            return json.dumps(True)
+        report = route_metrics.report()
+        report['access_log'] = access_log.stats()
+        return json.dumps(report)
+
+    def __init__(self, backend='auto', threads=None):
+        self.server = WebServer(app, '0.0.0.0', 8001, backend=backend, threads=threads)
+
     def start(self):
-        app.run(host='0.0.0.0', port=8001, threaded=True)
+        self.server.serve()
+
+    def stop(self):
+        # access_log is shared by every Urls and outlives a module reload,
+        # so it is left running and flushed by its atexit hook
+        self.server.stop()
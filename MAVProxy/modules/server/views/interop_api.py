@@ -23,6 +23,7 @@ logger = mavproxy_logging.create_logger("interop_api")
 # "server_working" : Does the server believe it is functioning correctly (boolean)
 # "hz" : Rolling frequency of interop telemetry posts (integer)
 # "active" : Is the server active (boolean)
+# "poll" : Mission polling counters, see Interop.poll_stats
 @app.route('/ground/api/v3/interop')
 @decs.trace_errors(logger, 'Failed to send interop data')
 def get_info():
@@ -34,7 +35,8 @@ def get_info():
                            "active": interop_inst.server_active(),
                            "mission_waypoints": interop_inst.get_mission_waypoints(),
                            "mission_wp_dists": interop_inst.get_wp_min_dists(),
-                           "active_mission": interop_inst.get_active_mission()})
+                           "active_mission": interop_inst.get_active_mission(),
+                           "poll": interop_inst.get_poll_stats()})
     else:
         return 'Error: Server is not active', 200
 
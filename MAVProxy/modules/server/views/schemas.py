@@ -129,6 +129,19 @@ timestamp = {
     "timestamp": "number"
 }
 
+# Schema for batch geotag lookups.
+# [timestamps] are unix times in milliseconds, like the tm argument.
+geotag_batch = {
+    "type": "object",
+    "properties": {
+        "timestamps": {
+            "type": "array",
+            "items": {"type": "number"}
+        },
+    },
+    "required": ["timestamps"]
+}
+
 
 # Schema for changing a parameter.
 # Required downstream check: [parameter] is valid parameter name.
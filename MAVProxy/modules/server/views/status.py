@@ -8,6 +8,7 @@ import re
 from flask import request
 from .views_utils import json_serial
 import modules.server.views.decorators as decs
+import modules.server.views.schemas as schemas
 
 from modules.mavproxy_database import get_db_mod
 from modules.mavproxy_mission import get_mission_mod
@@ -34,72 +35,123 @@ else:
 #
 ####################
 
+# Live values (tm=None) come from the database module's snapshot, never from
+# MySQL. Historical values (a tm in seconds) go to the database module. The
+# snapshot is looked up on each request, as a database module reload replaces it.
+def get_snapshot():
+    return get_db_mod().snapshot
+
+
+def live(name):
+    value = get_snapshot().get(name)
+    return value._asdict() if value is not None else None
+
+
 def airspeed(tm=None):
+    if tm is None:
+        return live('vfr_hud')
     return get_db_mod().get_vfr_hud(tm)
 
 
 def attitude(tm=None):
+    if tm is None:
+        return live('attitude')
     return get_db_mod().get_attitude(tm)
 
 
 def battery(tm=None):
+    if tm is None:
+        return live('battery')
     return get_db_mod().get_sys_status(tm)
 
 
 def climb(tm=None):
     try:
-        return get_db_mod().get_vfr_hud(tm)['climb']
+        return airspeed(tm)['climb']
     except TypeError:  # no data, return None
         return None
 
 
 def flight_time(tm=None):
+    if tm is None:
+        return live('flight_time')
     return get_db_mod().get_flight_time(tm)
 
 def gps(tm=None):
+    if tm is None:
+        return live('gps')
     return get_db_mod().get_gps(tm)
 
 
 def gps_status(tm=None):
+    if tm is None:
+        return live('gps_status')
     return get_db_mod().get_gps_status(tm)
 
 
+NO_STATUS_TEXT = {'info_text': None, 'warning_text': None, 'error_text': None}
+
+
+def status_text(tm=None):
+    if tm is None:
+        text = get_snapshot().get('status_text')
+    else:
+        text = get_db_mod().get_status_text(tm)
+    return text if text is not None else NO_STATUS_TEXT
+
+
 def mav_info(tm=None):
     try:
-        return get_db_mod().get_status_text()['info_text']
+        return status_text(tm)['info_text']
     except Exception as e:
         traceback.print_exc()
         print (str(e))
 
 
 def mav_warning(tm=None):
-    return get_db_mod().get_status_text()['warning_text']
+    try:
+        return status_text(tm)['warning_text']
+    except Exception as e:
+        traceback.print_exc()
+        print (str(e))
 
 
 def mav_error(tm=None):
-    return get_db_mod().get_status_text()['error_text']
+    try:
+        return status_text(tm)['error_text']
+    except Exception as e:
+        traceback.print_exc()
+        print (str(e))
 
 
 def signal(tm=None):
+    if tm is None:
+        return live('signal')
     return get_db_mod().get_signal(tm)
 
 
 def throttle(tm=None):
     try:
-        return get_db_mod().get_vfr_hud(tm)['throttle']
+        return airspeed(tm)['throttle']
     except TypeError:  # No data, return None
         return None
 
 
 def wind(tm=None):
+    if tm is None:
+        return live('wind')
     return get_db_mod().get_wind(tm)
 
 
 def current_wp(tm=None):
+    if tm is None:
+        return get_snapshot().get('current_wp')
     return get_db_mod().get_current_wp(tm)
 
 
 def mode(tm=None):
+    if tm is None:
+        return get_snapshot().get('mode')
     return get_db_mod().get_mode(tm)
 
 def camera_feedback(tm=None):
@@ -169,6 +221,53 @@ def wp_count(tm=None):
     return int(len(Data.wplist))
 
 
+# Snapshot fields each live status value is built from. Rendered JSON is
+# cached per endpoint until one of these changes.
+STATUS_FIELDS = {
+    'airspeed': ['vfr_hud'],
+    'attitude': ['attitude'],
+    'armed': ['armed'],
+    'battery': ['battery'],
+    'climb': ['vfr_hud'],
+    'current_wp': ['current_wp'],
+    'flight_time': ['flight_time'],
+    'gps': ['gps'],
+    'gps_status': ['gps_status'],
+    'link': ['link'],
+    'mav_info': ['status_text'],
+    'mav_warning': ['status_text'],
+    'mav_error': ['status_text'],
+    'mode': ['mode'],
+    'safe': ['safe'],
+    'signal': ['signal'],
+    'throttle': ['vfr_hud'],
+    'wind': ['wind'],
+    'wp_count': ['wp_count'],
+}
+
+# Snapshot fields behind the cached part of the combined status response.
+# link changes on nearly every request, so it is added to each response
+# rather than cached
+SOFTWARE_STATUS_FIELDS = ['armed', 'attitude', 'battery', 'current_wp', 'gps', 'gps_status',
+                          'mode', 'safe', 'signal', 'status_text', 'vfr_hud', 'wind', 'wp_count']
+
+# Values that aren't mavlink telemetry, copied into the snapshot on request
+# so they get the same change tracking
+REQUEST_FIELDS = {
+    'armed': armed,
+    'link': link,
+    'safe': safe,
+    'wp_count': wp_count,
+}
+
+
+def refresh_request_fields(names):
+    snapshot = get_snapshot()
+    for name in names:
+        if name in REQUEST_FIELDS:
+            snapshot.set(name, REQUEST_FIELDS[name]())
+
+
 ###################
 #
 #
@@ -177,7 +276,29 @@ def wp_count(tm=None):
 #
 ####################
 
+def live_json(func):
+    '''JSON for the live value of func, or None if there is no data yet.
+    Shared by the polled endpoints and the telemetry stream'''
+    def build():
+        result = func()
+        if result is None:
+            return None
+        return json.dumps(result, default=json_serial)
+
+    return get_snapshot().render(func.__name__, STATUS_FIELDS[func.__name__], build, json_serial)
+
+
+def get_live_status_value(func):
+    refresh_request_fields(STATUS_FIELDS[func.__name__])
+    text = live_json(func)
+    if text is None:
+        return "No Content", 204
+    return text
+
+
 def get_historical_status_value(func, t):
+    if t is None and func.__name__ in STATUS_FIELDS:
+        return get_live_status_value(func)
     if t is not None:
         try:
             tm = float(t) / 1000.0
@@ -193,7 +314,7 @@ def get_historical_status_value(func, t):
         else:
             return "No Content", 204
     except Exception as e:
-        if isinstance(x, ValueError) and str(e) == "Database query not supported in AirAPI mode":
+        if isinstance(e, ValueError) and str(e) == "Database query not supported in AirAPI mode":
             return "Database query not supported in AirAPI mode", 400
         logger.error("Error in function: " + func.__name__ + "\n" + str(e))
         return "Mavproxy query error", 500
@@ -336,23 +457,40 @@ def software_status():
     else:
         tm = None
 
-    return json.dumps({'attitude': attitude(tm),
-                       'battery': battery(tm),
-                       'link': link(tm),
-                       'gps': gps(tm),
-                       'airspeed': airspeed(tm),
-                       'wind': wind(tm),
-                       'throttle': throttle(tm),
-                       'wp_count': wp_count(tm),
-                       'current_wp': current_wp(tm),
-                       'mode': mode(tm),
-                       'armed': armed(tm),
-                       'mav_info': mav_info(tm),
-                       'mav_warning': mav_warning(tm),
-                       'mav_error': mav_error(tm),
-                       'gps_status': gps_status(tm),
-                       'signal': signal(tm),
-                       'safe': safe(tm)}, default=json_serial)
+    if tm is None:
+        refresh_request_fields(SOFTWARE_STATUS_FIELDS)
+        text = get_snapshot().render('status', SOFTWARE_STATUS_FIELDS,
+                                     lambda: json.dumps(status_values(None), default=json_serial),
+                                     json_serial)
+        # splice the uncached link into the cached object
+        return text[:-1] + ', "link": ' + json.dumps(link(None), default=json_serial) + '}'
+    return status_json(tm)
+
+
+def status_json(tm):
+    values = status_values(tm)
+    values['link'] = link(tm)
+    return json.dumps(values, default=json_serial)
+
+
+def status_values(tm):
+    '''the combined status response, except for link'''
+    return {'attitude': attitude(tm),
+            'battery': battery(tm),
+            'gps': gps(tm),
+            'airspeed': airspeed(tm),
+            'wind': wind(tm),
+            'throttle': throttle(tm),
+            'wp_count': wp_count(tm),
+            'current_wp': current_wp(tm),
+            'mode': mode(tm),
+            'armed': armed(tm),
+            'mav_info': mav_info(tm),
+            'mav_warning': mav_warning(tm),
+            'mav_error': mav_error(tm),
+            'gps_status': gps_status(tm),
+            'signal': signal(tm),
+            'safe': safe(tm)}
 
 
 @app.route(base_url + '/geotag_data', methods=['GET'])
@@ -378,3 +516,20 @@ def geotag_data():
     #image_data['gps']['lon'] = image_data['lon']
     #image_data['gps']['rel_alt'] = image_data['alt_rel']
     return json.dumps(image_data)
+
+
+# USAGE: Post JSON {'timestamps': [tm1, tm2, ...]} with times in milliseconds.
+# Returns [{'attitude': ..., 'gps': ...}, ...] in the same order as the timestamps,
+# interpolated in one pass rather than one lookup per image.
+@app.route(base_url + '/geotag_data', methods=['POST'])
+@decs.trace_errors(logger, "failed to retrieve batch geotag data")
+@decs.validate_json(logger, schemas.geotag_batch)
+def geotag_data_batch(geotag_request):
+    tms = [float(t) / 1000.0 for t in geotag_request['timestamps']]
+    try:
+        attitudes = get_db_mod().get_attitude_many(tms)
+        gpses = get_db_mod().get_gps_many(tms)
+    except ValueError as e:
+        # times older than the in-memory telemetry, with no database in AirAPI mode
+        return str(e), 400
+    return json.dumps([{'attitude': att, 'gps': pos} for att, pos in zip(attitudes, gpses)])
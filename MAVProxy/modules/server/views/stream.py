@@ -0,0 +1,153 @@
+from modules.server.urls import app
+import math
+import threading
+import time
+
+from flask import request, Response
+import modules.server.views.decorators as decs
+import modules.server.views.status as status
+
+import mavproxy_logging
+
+logger = mavproxy_logging.create_logger("stream")
+
+# USAGE: GET /ground/api/v3/status/stream?fields=attitude:10,battery:1,gps
+# Server-sent events, one event per tick with only the fields that changed:
+#   data: {"time": <unix seconds>, "fields": {"attitude": {...}, ...}}
+# A field without a rate uses DEFAULT_RATES. The first event has every
+# requested field that has data.
+
+# Push rate in Hz for each field when the client doesn't ask for one
+DEFAULT_RATES = {
+    'airspeed': 10,
+    'attitude': 10,
+    'climb': 10,
+    'gps': 10,
+    'throttle': 10,
+    'current_wp': 2,
+    'mode': 2,
+    'wind': 2,
+    'armed': 1,
+    'battery': 1,
+    'flight_time': 1,
+    'gps_status': 1,
+    'link': 1,
+    'mav_error': 1,
+    'mav_info': 1,
+    'mav_warning': 1,
+    'safe': 1,
+    'signal': 1,
+    'wp_count': 1,
+}
+
+MAX_RATE = 50.0
+MIN_RATE = 0.2
+MAX_CLIENTS = 32
+# send a comment when nothing has changed for this long, so dead clients are noticed
+KEEPALIVE_TIME = 5.0
+# a write that blocks longer than this halves the client's rates
+SLOW_WRITE_TIME = 0.5
+# after this many fast writes in a row the rates are doubled again, up to
+# the rates the client asked for
+FAST_WRITES_TO_RESTORE = 20
+
+clients_lock = threading.Lock()
+clients = [0]
+
+
+def parse_fields(arg):
+    '''field name -> rate in Hz from "name[:hz],...", all fields if arg is empty'''
+    if not arg:
+        return dict(DEFAULT_RATES)
+    rates = {}
+    for item in arg.split(','):
+        (name, sep, hz) = item.strip().partition(':')
+        if name not in DEFAULT_RATES:
+            raise ValueError("unknown field '{}'".format(name))
+        if sep:
+            rate = float(hz)
+            if math.isnan(rate) or math.isinf(rate) or rate <= 0:
+                raise ValueError("bad rate for '{}'".format(name))
+            rates[name] = min(max(rate, MIN_RATE), MAX_RATE)
+        else:
+            rates[name] = DEFAULT_RATES[name]
+    return rates
+
+
+def stream_events(rates, addr):
+    '''generator of server-sent events for one client. Every tick reads the
+    latest values, so a client that can't keep up skips intermediate values
+    instead of building a backlog'''
+    funcs = dict((name, getattr(status, name)) for name in rates)
+    requested = dict(rates)
+    fast_writes = 0
+    sent = {}
+    next_due = dict((name, 0) for name in rates)
+    last_write = time.time()
+    while True:
+        now = time.time()
+        due = [name for name in rates if next_due[name] <= now]
+        snapshot_fields = set()
+        for name in due:
+            snapshot_fields.update(status.STATUS_FIELDS[name])
+        status.refresh_request_fields(snapshot_fields)
+
+        parts = []
+        for name in due:
+            next_due[name] = now + 1.0 / rates[name]
+            stamp = status.get_snapshot().stamp(status.STATUS_FIELDS[name])
+            if sent.get(name) == stamp:
+                continue
+            text = status.live_json(funcs[name])
+            if text is None:
+                continue
+            sent[name] = stamp
+            parts.append('"{}":{}'.format(name, text))
+
+        if parts:
+            event = 'data: {"time":%.3f,"fields":{%s}}\n\n' % (now, ','.join(parts))
+        elif now - last_write >= KEEPALIVE_TIME:
+            event = ': keepalive\n\n'
+        else:
+            event = None
+
+        if event is not None:
+            start = time.time()
+            yield event
+            last_write = time.time()
+            if last_write - start > SLOW_WRITE_TIME:
+                fast_writes = 0
+                for name in rates:
+                    rates[name] = max(rates[name] * 0.5, MIN_RATE)
+                logger.debug("slow stream client {}, rates now {}".format(addr, rates))
+            elif rates != requested:
+                fast_writes += 1
+                if fast_writes >= FAST_WRITES_TO_RESTORE:
+                    fast_writes = 0
+                    for name in rates:
+                        rates[name] = min(rates[name] * 2.0, requested[name])
+                    logger.debug("stream client {} caught up, rates now {}".format(addr, rates))
+
+        time.sleep(max(min(next_due.values()) - time.time(), 0))
+
+
+def release_client():
+    with clients_lock:
+        clients[0] -= 1
+
+
+@app.route(status.base_url + '/stream')
+@decs.trace_errors(logger, 'Failed to start telemetry stream')
+def telemetry_stream():
+    try:
+        rates = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return "Error: {}".format(e), 400
+    with clients_lock:
+        if clients[0] >= MAX_CLIENTS:
+            return "Too many stream clients", 503
+        clients[0] += 1
+    response = Response(stream_events(rates, request.remote_addr), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.call_on_close(release_client)
+    return response
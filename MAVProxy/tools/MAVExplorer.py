@@ -7,6 +7,7 @@ log analysis program
 Andrew Tridgell December 2014
 '''
 
+import ast
 import copy
 import sys
 import time
@@ -14,6 +15,7 @@ import os
 import fnmatch
 import threading
 import shlex
+import numpy
 from math import *
 from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.lib import rline
@@ -26,9 +28,12 @@ from pymavlink import mavutil
 from MAVProxy.modules.lib.mp_settings import MPSettings, MPSetting
 from MAVProxy.modules.lib import wxsettings
 from MAVProxy.modules.lib.graphdefinition import GraphDefinition
+from MAVProxy.modules.lib import log_columns
+from MAVProxy.modules.lib import column_expression
 from lxml import objectify
 import pkg_resources
 from builtins import input
+import builtins
 import datetime
 import matplotlib
 
@@ -52,8 +57,12 @@ def xml_escape(e):
 
 def timestring(msg):
     '''return string for msg timestamp'''
-    ts_ms = int(msg._timestamp * 1000.0) % 1000
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(msg._timestamp)) + ".%.03u" % ts_ms
+    return timestamp_string(msg._timestamp)
+
+def timestamp_string(timestamp):
+    '''return string for a timestamp'''
+    ts_ms = int(timestamp * 1000.0) % 1000
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + ".%.03u" % ts_ms
 
 class MEStatus(object):
     '''status object to conform with mavproxy structure for modules'''
@@ -104,6 +113,8 @@ class MEState(object):
             )
 
         self.mlog = None
+        # LogColumns of the log, see loadfile()
+        self.columns = None
         self.filename = None
         self.command_map = command_map
         self.completions = {
@@ -237,14 +248,58 @@ def setup_menus():
 
     mestate.console.set_menu(TopMenu, menu_callback)
 
+def columns_expression_ok(expression, columns):
+    '''return True if the message types, fields and instances an
+    expression uses are all in the log columns'''
+    parts = [expression]
+    if expression[-1] == '}':
+        a2 = expression.rfind('{')
+        if a2 == -1:
+            return False
+        # the condition of EXPRESSION{CONDITION}
+        parts = [expression[:a2], expression[a2+1:-1]]
+    try:
+        trees = [ast.parse(p.strip(), mode='eval') for p in parts]
+    except SyntaxError:
+        return False
+    for node in [n for tree in trees for n in ast.walk(tree)]:
+        if isinstance(node, ast.Attribute):
+            # TYPE.field or TYPE[instance].field
+            target = node.value
+            if isinstance(target, ast.Subscript):
+                target = target.value
+            cols = columns.get(target.id) if isinstance(target, ast.Name) else None
+            if cols is not None and node.attr not in cols.fieldnames:
+                return False
+        elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+            cols = columns.get(node.value.id)
+            if cols is not None:
+                if cols.instance_field is None:
+                    return False
+                index = node.slice
+                if hasattr(ast, 'Index') and isinstance(index, ast.Index):
+                    index = index.value
+                instance = column_expression.constant_value(index)
+                instances = cols.instances()
+                if isinstance(instance, int) and instances is not None and instance not in instances:
+                    return False
+        elif isinstance(node, ast.Name):
+            if node.id not in columns and node.id not in globals() and not hasattr(builtins, node.id):
+                return False
+    return True
+
 def expression_ok(expression, msgs=None):
     '''return True if an expression is OK with current messages'''
     expression_ok = True
     if expression is None:
         return False
     fields = expression.split()
+    columns = None
     if msgs is None:
         msgs = mestate.status.msgs
+        # check against the message types in the log rather than
+        # evaluating the expression
+        columns = mestate.columns
     for f in fields:
         try:
             if f.endswith(">"):
@@ -253,6 +308,10 @@ def expression_ok(expression, msgs=None):
                     f = f[:a2]
             if f.endswith(':2'):
                 f = f[:-2]
+            if columns is not None:
+                if not columns_expression_ok(f, columns):
+                    expression_ok = False
+                continue
             if f[-1] == '}':
                 # avoid passing nocondition unless needed to allow us to work witih older
                 # pymavlink versions
@@ -432,13 +491,12 @@ def cmd_fft(args):
     '''display fft from log'''
 
     from MAVProxy.modules.lib import mav_fft
-    if len(args) > 0:
-        condition = args[0]
-    else:
-        condition = None
+    # "fft welch" averages the power spectra of windowed batches
+    welch = 'welch' in args
     global fft_tool, xlimits
     fft_tool = mav_fft.MavFFT(mlog=mestate.mlog,
-                              xlimits=xlimits)
+                              xlimits=xlimits,
+                              welch=welch)
     fft_tool.start()
 
 msgstats_tool = None
@@ -466,6 +524,8 @@ def cmd_dump(args):
         for t in mlog.name_to_id.keys():
             if fnmatch.fnmatch(t, p):
                 types.extend([t])
+    if dump_columns(types):
+        return
     while True:
         msg = mlog.recv_match(type=types)
         if msg is None:
@@ -478,6 +538,33 @@ def cmd_dump(args):
         print("%s %s" % (timestring(msg), msg))
     mlog.rewind()
 
+def dump_columns(types):
+    '''dump messages from the log columns, if every type was stored in
+    full. Returns False if the log has to be read instead'''
+    if mestate.columns is None:
+        return False
+    cols = [mestate.columns.get(t) for t in types]
+    cols = [c for c in cols if c is not None]
+    if not all([c.complete for c in cols]):
+        return False
+    # merge the types into the order they are in the log
+    if len(cols) == 0:
+        return True
+    timestamps = numpy.concatenate([c.timestamps() for c in cols])
+    sequence = numpy.concatenate([c.sequence() for c in cols])
+    which = numpy.concatenate([numpy.full(len(c), i) for (i, c) in enumerate(cols)])
+    index = numpy.concatenate([numpy.arange(len(c)) for c in cols])
+    keep = numpy.ones(len(timestamps), dtype=bool)
+    if xlimits.xlim_low is not None:
+        keep &= timestamps >= xlimits.xlim_low
+    if xlimits.xlim_high is not None:
+        keep &= timestamps <= xlimits.xlim_high
+    order = numpy.nonzero(keep)[0]
+    order = order[numpy.argsort(sequence[order], kind='stable')]
+    for j in order:
+        print("%s %s" % (timestamp_string(timestamps[j]), cols[which[j]].format(index[j])))
+    return True
+
 mfit_tool = None
 
 def cmd_magfit(args):
@@ -830,17 +917,18 @@ def loadfile(args):
     t1 = time.time()
     mestate.console.write("\ndone (%u messages in %.1fs)\n" % (mestate.mlog._count, t1-t0))
 
-    # evaluate graph expressions before finding flightmode list as
-    # flightmode_list does a rewind(), and that clears the DFReader
-    # object.  While we do take a copy of mestate.status.msgs above,
-    # that is a shallow copy, so does not allow
-    # DFMessage.parent.messages to function, which is vital for
-    # instance-number-indexing to work - and the graph expression
-    # evaluation requires that to function.
+    # read the log into columns, or map them from the sidecar cache. The
+    # graphs are then checked against the message types in the columns,
+    # and the columns also give the flight modes without another pass
+    # over the log
+    t0 = time.time()
+    mestate.columns = log_columns.open_columns(args, mlog)
+    mestate.console.write("columns ready in %.1fs\n" % (time.time() - t0))
     load_graphs()
 
     global flightmodes
-    flightmodes = mlog.flightmode_list()
+    flightmodes = mestate.columns.flightmodes
+    mlog._flightmodes = flightmodes
 
     setup_menus()
 
@@ -944,7 +1032,7 @@ command_map = {
     'messages'   : (cmd_messages,  'show messages'),
     'devid'      : (cmd_devid,     'show device IDs'),
     'map'        : (cmd_map,       'show map view'),
-    'fft'        : (cmd_fft,       'show a FFT (if available)'),
+    'fft'        : (cmd_fft,       'show a FFT (if available), "fft welch" for Welch averaging'),
     'loadLog'    : (cmd_loadfile,  'load a log file'),
     'stats'      : (cmd_stats,     'show statistics on the log'),
     'magfit'     : (cmd_magfit,    'fit mag parameters to WMM'),
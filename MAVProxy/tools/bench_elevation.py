@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+'''
+benchmark elevation lookups, comparing GetElevation called per point with
+one GetElevationArray call. Uses a synthetic SRTM tile so no download is
+needed
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import zipfile
+
+import numpy
+
+# the map modules import each other as modules.*, relative to MAVProxy/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from modules.mavproxy_map import mp_elevation
+from modules.mavproxy_map import srtm
+
+
+def make_tile(directory, lat, lon, size):
+    '''a random-walk terrain tile, written the way the SRTM server has them'''
+    name = "%s%02u%s%03u.hgt" % ('N' if lat >= 0 else 'S', abs(lat), 'E' if lon >= 0 else 'W', abs(lon))
+    heights = numpy.cumsum(numpy.random.randint(-3, 4, size*size)) % 3000
+    path = os.path.join(directory, name + ".zip")
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr(name, heights.astype('>i2').tobytes())
+    return srtm.SRTMTile(path, lat, lon)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser("bench_elevation.py [options]")
+    parser.add_option("--points", type=int, default=896, help="points per lookup, 896 is one TERRAIN_REQUEST")
+    parser.add_option("--tiles", type=int, default=1, help="number of tiles the points are spread over")
+    parser.add_option("--size", type=int, default=1201, help="tile size, 1201 for SRTM3 or 3601 for SRTM1")
+    parser.add_option("--time", type=float, default=2.0, help="seconds per test")
+    (opts, args) = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        model = mp_elevation.ElevationModel(offline=1)
+        for i in range(opts.tiles):
+            model.cacheTile((-36.0, 149.0 + i), make_tile(tmpdir, -36, 149 + i, opts.size))
+        lats = -36 + numpy.random.random(opts.points)
+        lons = 149 + numpy.random.random(opts.points) * opts.tiles
+
+        scalar = numpy.array([model.GetElevation(lat, lon) for (lat, lon) in zip(lats, lons)])
+        vector = model.GetElevationArray(lats, lons)
+        print("max difference %g m" % numpy.max(numpy.abs(scalar - vector)))
+
+        def per_point():
+            for (lat, lon) in zip(lats, lons):
+                model.GetElevation(lat, lon)
+
+        def array():
+            model.GetElevationArray(lats, lons)
+
+        print("%u points over %u tile(s)" % (opts.points, opts.tiles))
+        for (name, fn) in [('GetElevation', per_point), ('GetElevationArray', array)]:
+            calls = 0
+            t0 = time.time()
+            while time.time() - t0 < opts.time:
+                fn()
+                calls += 1
+            rate = calls * opts.points / (time.time() - t0)
+            print("  %-18s %10.0f points/s" % (name, rate))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+'''
+benchmark packet forwarding throughput, comparing the per-packet path
+with the fastfwd path (one write per read for each output, and raw
+forwarding from UDP slaves)
+'''
+
+import time
+import socket
+
+from pymavlink import mavutil
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+
+
+class NullFile(object):
+    '''write target for the encoder, we only want the packed bytes'''
+    def write(self, buf):
+        pass
+
+
+def make_stream(count):
+    '''a typical telemetry mix, packed and parsed the way process_master sees it'''
+    mav = mavlink.MAVLink(NullFile(), srcSystem=1, srcComponent=1)
+    packed = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            m = mav.attitude_encode(i, 0.1, 0.2, 0.3, 0.01, 0.02, 0.03)
+        elif kind == 1:
+            m = mav.global_position_int_encode(i, 424400000, -764800000, 100000, 50000, 100, 200, 0, 9000)
+        elif kind == 2:
+            m = mav.vfr_hud_encode(20.0, 21.0, 90, 50, 100.0, 1.0)
+        else:
+            m = mav.sys_status_encode(0, 0, 0, 500, 12000, 1000, 90, 0, 0, 0, 0, 0, 0)
+        packed.append(m.pack(mav))
+    parser = mavlink.MAVLink(NullFile())
+    msgs = parser.parse_buffer(bytearray().join(packed))
+    return packed, msgs
+
+
+def make_outputs(count):
+    '''udp outputs, each with a bound socket so the writes go somewhere'''
+    sinks = []
+    outputs = []
+    for i in range(count):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sinks.append(sink)
+        outputs.append(mavutil.mavlink_connection('udpout:127.0.0.1:%u' % sink.getsockname()[1], input=False))
+    return sinks, outputs
+
+
+def bench(fn, seconds):
+    '''returns calls of fn per second'''
+    calls = 0
+    t0 = time.time()
+    while time.time() - t0 < seconds:
+        fn()
+        calls += 1
+    return calls / (time.time() - t0)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser("bench_forwarding.py [options]")
+    parser.add_option("--outputs", type=int, default=4, help="number of outputs")
+    parser.add_option("--per-read", type=int, default=20, help="packets per read from the master")
+    parser.add_option("--time", type=float, default=2.0, help="seconds per test")
+    (opts, args) = parser.parse_args()
+
+    packed, msgs = make_stream(opts.per_read)
+    sinks, outputs = make_outputs(opts.outputs)
+    nbytes = sum(len(p) for p in packed)
+
+    def per_packet():
+        for m in msgs:
+            for r in outputs:
+                r.write(m.get_msgbuf())
+
+    def batched():
+        pending = []
+        for m in msgs:
+            pending.append(m.get_msgbuf())
+        buf = bytearray().join(pending)
+        for r in outputs:
+            r.write(buf)
+
+    print("master -> %u outputs, %u packets (%u bytes) per read" % (opts.outputs, opts.per_read, nbytes))
+    for (name, fn) in [('per packet', per_packet), ('fastfwd', batched)]:
+        rate = bench(fn, opts.time) * opts.per_read
+        print("  %-10s %9.0f packets/s" % (name, rate))
+
+    # a GCS sends one packet per datagram
+    master = outputs[0]
+    slave_parser = mavlink.MAVLink(NullFile())
+
+    def slave_parsed():
+        for buf in packed:
+            for m in slave_parser.parse_buffer(buf):
+                master.write(m.get_msgbuf())
+
+    def slave_raw():
+        for buf in packed:
+            master.write(buf)
+
+    print("slave -> master")
+    for (name, fn) in [('per packet', slave_parsed), ('fastfwd', slave_raw)]:
+        rate = bench(fn, opts.time) * len(packed)
+        print("  %-10s %9.0f packets/s" % (name, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+'''
+benchmark reading a DataFlash log into columns, comparing the message by
+message reader with the parallel decoder MAVExplorer uses. Reports MB/s
+and checks both give the same columns, and that graph expressions
+evaluated over the columns match per-message evaluation
+'''
+
+import os
+import re
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from pymavlink import mavutil
+from MAVProxy.modules.lib import column_expression
+from MAVProxy.modules.lib import log_columns
+from MAVProxy.modules.lib import multiproc
+
+
+def same_columns(a, b):
+    '''True if two sets of columns hold the same data'''
+    if set(a.types.keys()) != set(b.types.keys()):
+        return False
+    for (name, ca) in a.types.items():
+        cb = b.types[name]
+        if ca.fields != cb.fields or ca.data.shape != cb.data.shape:
+            return False
+        if not numpy.array_equal(numpy.isnan(ca.data), numpy.isnan(cb.data)):
+            return False
+        if not numpy.array_equal(numpy.nan_to_num(ca.data), numpy.nan_to_num(cb.data)):
+            return False
+    return True
+
+
+def same_expression(mlog, columns, expression):
+    '''True if an expression gives the same samples over the columns as
+    evaluating it message by message, the way MavGraph does. The log is
+    read without a type filter, as with one DFReader times untimed
+    messages by whichever message it last read'''
+    sample_types = set(re.findall('[A-Z_][A-Z0-9_]+', expression))
+    (t, v) = column_expression.compile_expression(expression).evaluate(columns, sample_types)
+    condition = None
+    if expression.endswith('}'):
+        start = expression.rfind('{')
+        condition = expression[start+1:-1]
+        expression = expression[:start]
+    times = []
+    values = []
+    all_messages = {}
+    mlog.rewind()
+    while True:
+        m = mlog.recv_match()
+        if m is None:
+            break
+        if m.get_type() not in sample_types:
+            continue
+        all_messages[m.get_type()] = m
+        if condition is not None and not mavutil.evaluate_condition(condition, all_messages):
+            continue
+        value = mavutil.evaluate_expression(expression, all_messages)
+        if value is None:
+            continue
+        times.append(m._timestamp)
+        values.append(value)
+    mlog.rewind()
+    return (numpy.array_equal(t, numpy.array(times)) and
+            numpy.allclose(v, numpy.array(values, dtype=float), equal_nan=True))
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser("bench_logload.py [options] <LOGFILE>")
+    parser.add_option("--processes", type=int, default=None, help="decoding processes, default one per core")
+    parser.add_option("--no-serial", action='store_true', default=False, help="skip the message by message reader")
+    parser.add_option("--expression", action='append', default=[], help="graph expression to check against per-message evaluation")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    filename = args[0]
+    megabytes = os.path.getsize(filename) / (1024.0 * 1024.0)
+    processes = opts.processes
+    if processes is None:
+        processes = multiproc.cpu_count()
+
+    def report(name, seconds):
+        print("  %-28s %7.2fs %9.1f MB/s" % (name, seconds, megabytes / max(seconds, 1.0e-6)))
+
+    print("%s: %.1f MB" % (filename, megabytes))
+    t0 = time.time()
+    mlog = mavutil.mavlink_connection(filename, zero_time_base=False, notimestamps=False)
+    report("mavlink_connection", time.time() - t0)
+
+    parallel = {}
+    for n in sorted(set([1, processes])):
+        t0 = time.time()
+        parallel[n] = log_columns.read_dataflash(mlog, None, n)
+        if parallel[n] is None:
+            print("log can't be decoded in parallel")
+            sys.exit(1)
+        report("parallel, %u process%s" % (n, "" if n == 1 else "es"), time.time() - t0)
+
+    if not opts.no_serial:
+        t0 = time.time()
+        serial = log_columns.read_messages(mlog, None)
+        report("message by message", time.time() - t0)
+        for (n, columns) in parallel.items():
+            if not same_columns(serial, columns):
+                print("MISMATCH with %u process(es)" % n)
+                sys.exit(1)
+        print("columns match")
+
+    columns = parallel[processes]
+    for expression in opts.expression:
+        t0 = time.time()
+        if not same_expression(mlog, columns, expression):
+            print("MISMATCH evaluating %s" % expression)
+            sys.exit(1)
+        print("  %s matches (%.2fs)" % (expression, time.time() - t0))
+
+
+if __name__ == '__main__':
+    multiproc.freeze_support()
+    main()
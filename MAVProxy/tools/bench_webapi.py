@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+'''
+load test the web API with concurrent keep-alive clients, the way a room of
+GCS browsers polls it, and report requests/s and latency percentiles
+'''
+
+import threading
+import time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+DEFAULT_PATHS = '/ground/api/v3/status,/ground/api/v3/status/attitude,/ground/api/v3/status/gps'
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = min(int(len(sorted_values) * p / 100.0), len(sorted_values) - 1)
+    return sorted_values[i]
+
+
+class Client(threading.Thread):
+    def __init__(self, host, port, paths, deadline, rate):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.paths = paths
+        self.deadline = deadline
+        self.rate = rate
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+    def connect(self):
+        return httplib.HTTPConnection(self.host, self.port, timeout=10)
+
+    def run(self):
+        conn = self.connect()
+        i = 0
+        next_time = time.time()
+        while time.time() < self.deadline:
+            path = self.paths[i % len(self.paths)]
+            i += 1
+            t0 = time.time()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+                if response.getheader('connection', '').lower() == 'close':
+                    conn.close()
+                    conn = self.connect()
+            except Exception:
+                self.errors += 1
+                conn.close()
+                conn = self.connect()
+                continue
+            self.latencies.append(time.time() - t0)
+            if self.rate > 0:
+                next_time += 1.0 / self.rate
+                delay = next_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        conn.close()
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser("bench_webapi.py [options]")
+    parser.add_option("--host", default="127.0.0.1", help="web API host")
+    parser.add_option("--port", type=int, default=8001, help="web API port")
+    parser.add_option("--clients", type=int, default=20, help="concurrent clients")
+    parser.add_option("--paths", default=DEFAULT_PATHS, help="comma separated paths, requested in turn")
+    parser.add_option("--rate", type=float, default=0, help="requests/s per client, 0 for as fast as possible")
+    parser.add_option("--time", type=float, default=10.0, help="seconds to run for")
+    (opts, args) = parser.parse_args()
+
+    paths = opts.paths.split(',')
+    deadline = time.time() + opts.time
+    clients = [Client(opts.host, opts.port, paths, deadline, opts.rate) for i in range(opts.clients)]
+    t0 = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - t0
+
+    latencies = sorted(sum([c.latencies for c in clients], []))
+    statuses = {}
+    for c in clients:
+        for (status, count) in c.statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    errors = sum([c.errors for c in clients])
+
+    print("%u clients for %.1fs against %s:%u" % (opts.clients, elapsed, opts.host, opts.port))
+    print("  requests  %u (%.0f/s)" % (len(latencies), len(latencies) / elapsed))
+    print("  errors    %u" % errors)
+    print("  status    %s" % ', '.join(['%s: %u' % (s, statuses[s]) for s in sorted(statuses)]))
+    for p in [50, 90, 99]:
+        print("  p%-8u %.1fms" % (p, percentile(latencies, p) * 1000))
+    if latencies:
+        print("  max       %.1fms" % (latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
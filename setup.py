@@ -100,7 +100,7 @@ on how to use MAVProxy.''',
       install_requires=requirements,
       extras_require={
         # restserver module
-        'server': ['flask'],
+        'server': ['flask', 'waitress'],
       },
       scripts=['MAVProxy/mavproxy.py',
                'MAVProxy/tools/mavflightview.py',